@@ -0,0 +1,236 @@
+import contextlib
+import gc
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated, Any, Callable
+
+import typer
+
+from download_schemes.manifest import HashingWriter
+from download_schemes.minimizer_index import MINIMIZER_INDEX_FILE, MinimizerIndexStage
+from download_schemes.normalise_alleles import normalise_fasta, read_normalised_fasta
+from download_schemes.pipeline import SchemeWriter
+
+BASELINES_FILE = Path(__file__).parent / "baselines.json"
+# Upstream FASTA files are wrapped, the normalised files are not.
+LINE_WIDTH = 60
+
+
+def wrap(sequence: str) -> str:
+    return "\n".join(sequence[i: i + LINE_WIDTH] for i in range(0, len(sequence), LINE_WIDTH))
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choices("ACGT", k=length))
+
+
+def synthetic_locus(
+    rng: random.Random, alleles: int, length: int, variation: float = 0.02
+) -> str:
+    """A locus FASTA of `alleles` related sequences of around `length` bases, as a host would serve it."""
+    reference = random_sequence(rng, length)
+    records = []
+    for allele_id in range(1, alleles + 1):
+        sequence = list(reference)
+        for _ in range(int(length * variation)):
+            sequence[rng.randrange(length)] = rng.choice("ACGT")
+        records.append(f">abcZ_{allele_id}\n{wrap(''.join(sequence))}\n")
+    return "".join(records)
+
+
+def edge_case_locus(rng: random.Random, alleles: int, length: int) -> str:
+    """A locus where a fifth of the alleles are skipped by `normalise_fasta`, plus lower case and decimal IDs."""
+    records = []
+    for allele_id in range(1, alleles + 1):
+        sequence = random_sequence(rng, length)
+        kind = allele_id % 10
+        if kind == 0:
+            records.append(f">abcZ_{allele_id}_variant\n{wrap(sequence)}\n")  # Malformed name
+        elif kind == 1:
+            records.append(f">abcZ_{allele_id}\n{wrap(sequence[:100] + 'NNRY' + sequence[100:])}\n")  # Bad chars
+        elif kind == 2:
+            records.append(f">abcZ_{allele_id}\n\n")  # Empty
+        elif kind == 3:
+            records.append(f">abcZ-{allele_id}.1\n{wrap(sequence.lower())}\n")
+        else:
+            records.append(f">abcZ_{allele_id}\n{wrap(sequence)}\n")
+    return "".join(records)
+
+
+# Realistic loci sizes: (alleles, sequence length). Scaled by --scale.
+CASES: dict[str, Callable[[random.Random, float], str]] = {
+    "mlst": lambda rng, scale: synthetic_locus(rng, max(1, int(500 * scale)), 450),
+    "cgmlst": lambda rng, scale: synthetic_locus(rng, max(1, int(50000 * scale)), 900),
+    "long": lambda rng, scale: synthetic_locus(rng, max(1, int(200 * scale)), 20000),
+    "edge": lambda rng, scale: edge_case_locus(rng, max(1, int(5000 * scale)), 450),
+}
+
+
+def normalise(fasta: str, _normalised: str, _work_dir: Path) -> None:
+    normalise_fasta(fasta, io.StringIO())
+
+
+def gzip_write(_fasta: str, normalised: str, _work_dir: Path) -> None:
+    # The same stack SchemeWriter writes locus files through, minus the disk.
+    with open(os.devnull, "wb") as raw_f:
+        with gzip.GzipFile(fileobj=HashingWriter(raw_f), mode="wb", mtime=0) as gzip_f:
+            with io.TextIOWrapper(gzip_f, encoding="utf-8") as out_f:
+                out_f.write(normalised)
+
+
+def write_locus(fasta: str, _normalised: str, work_dir: Path) -> None:
+    writer = SchemeWriter(work_dir, "cgmlst")
+    writer.write_locus("abcZ", fasta)
+    writer.close({"last_updated": "2025-01-01", "genes": ["abcZ"]})
+
+
+def minimizer_index(_fasta: str, normalised: str, work_dir: Path) -> dict[str, int]:
+    stage = MinimizerIndexStage(work_dir, "cgmlst")
+    for allele_id, sequence in read_normalised_fasta(io.StringIO(normalised)):
+        stage.add_allele("abcZ", allele_id, sequence)
+    stage.finish({})
+    return {"index_bytes": stage.files[MINIMIZER_INDEX_FILE]["size"]}
+
+
+# Each benchmark may return the sizes of what it wrote, which are reported alongside its throughput.
+BENCHMARKS: dict[str, Callable[[str, str, Path], dict[str, int] | None]] = {
+    "normalise": normalise,
+    "gzip": gzip_write,
+    "locus": write_locus,
+    "minimizer-index": minimizer_index,
+}
+
+
+def time_benchmark(
+    benchmark: Callable[[str, str, Path], dict[str, int] | None], fasta: str, normalised: str, repeat: int
+) -> tuple[float, dict[str, int]]:
+    """The best of `repeat` runs, in seconds, which is the least disturbed by anything else on the machine.
+
+    As with `timeit`, the garbage collector is off while timing, so that collections triggered by earlier work do not
+    land in the measurement.
+    """
+    best = float("inf")
+    sizes = {}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir:
+            # normalise_fasta prints every allele it skips.
+            with contextlib.redirect_stdout(io.StringIO()):
+                gc.collect()
+                gc.disable()
+                try:
+                    start = time.perf_counter()
+                    sizes = benchmark(fasta, normalised, Path(work_dir)) or {}
+                    best = min(best, time.perf_counter() - start)
+                finally:
+                    gc.enable()
+    return best, sizes
+
+
+def read_baselines(baselines_file: Path) -> dict[str, dict[str, Any]]:
+    if not baselines_file.exists():
+        return {}
+    with open(baselines_file, "r") as f:
+        return json.load(f)["results"]
+
+
+def write_baselines(baselines_file: Path, results: dict[str, dict[str, Any]]) -> None:
+    with open(baselines_file, "w") as f:
+        json.dump(
+            {
+                "machine": f"{platform.machine()} {platform.processor() or platform.system()}",
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+
+
+def run_benchmarks(
+    benchmarks: Annotated[
+        list[str], typer.Option("-b", "--benchmark", help="Benchmarks to run (default: all)")
+    ] = None,
+    cases: Annotated[
+        list[str], typer.Option("-c", "--case", help="Synthetic loci to run them on (default: all)")
+    ] = None,
+    scale: Annotated[
+        float, typer.Option(help="Scale the number of alleles in each synthetic locus")
+    ] = 1.0,
+    repeat: Annotated[int, typer.Option(help="Runs of each benchmark, of which the fastest counts")] = 5,
+    threshold: Annotated[
+        float, typer.Option(help="Fail if throughput drops by more than this fraction of the baseline")
+    ] = 0.2,
+    baselines_file: Annotated[Path, typer.Option("--baselines", help="Stored baselines")] = BASELINES_FILE,
+    update_baselines: Annotated[
+        bool, typer.Option(help="Store the results as the new baselines instead of comparing")
+    ] = False,
+    seed: Annotated[int, typer.Option(help="Seed for the synthetic loci")] = 1,
+):
+    """Time allele normalisation, locus compression, whole-locus processing and index building on synthetic loci.
+
+    Throughput is measured in MB of upstream FASTA per second. Results are compared with the stored baselines, and
+    the run fails if any benchmark has slowed down by more than the threshold. Baselines depend on the machine, so
+    regenerate them with --update-baselines when moving to a different one.
+    """
+    benchmarks = benchmarks or list(BENCHMARKS)
+    cases = cases or list(CASES)
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise typer.BadParameter(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+    for name in cases:
+        if name not in CASES:
+            raise typer.BadParameter(f"Unknown case '{name}'. Available: {', '.join(CASES)}")
+
+    baselines = read_baselines(baselines_file)
+    results = dict(baselines) if update_baselines else {}
+    regressions = []
+    print(f"{'benchmark':<24}{'MB/s':>10}{'alleles/s':>12}{'baseline':>10}{'change':>9}", file=sys.stderr)
+    for case in cases:
+        fasta = CASES[case](random.Random(seed), scale)
+        with contextlib.redirect_stdout(io.StringIO()):
+            normalised_f = io.StringIO()
+            alleles = len(normalise_fasta(fasta, normalised_f))
+        megabytes = len(fasta) / 1e6
+        for name in benchmarks:
+            key = f"{name}/{case}"
+            seconds, sizes = time_benchmark(BENCHMARKS[name], fasta, normalised_f.getvalue(), repeat)
+            result = {
+                "mb_per_s": round(megabytes / seconds, 3),
+                "alleles_per_s": round(alleles / seconds),
+                "scale": scale,
+                **sizes,
+            }
+            results[key] = result
+            line = f"{key:<24}{result['mb_per_s']:>10.2f}{result['alleles_per_s']:>12}"
+            baseline = baselines.get(key)
+            if baseline is not None and baseline.get("scale") == scale:
+                change = result["mb_per_s"] / baseline["mb_per_s"] - 1
+                line += f"{baseline['mb_per_s']:>10.2f}{change:>+9.1%}"
+                if change < -threshold:
+                    regressions.append(key)
+                    line += "  REGRESSION"
+            for size_name, size in sizes.items():
+                line += f"  {size_name}={size}"
+            print(line, file=sys.stderr)
+
+    if update_baselines:
+        write_baselines(baselines_file, results)
+        print(f"Baselines written to {baselines_file}", file=sys.stderr)
+    elif regressions:
+        print(
+            f"{len(regressions)} benchmarks slowed by more than {threshold:.0%}: {', '.join(regressions)}",
+            file=sys.stderr,
+        )
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(run_benchmarks)
@@ -7,11 +7,19 @@
 # ]
 # ///
 
+import hashlib
 import json
+import os
+import shlex
+import shutil
+import subprocess
 import sys
-from datetime import datetime
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Annotated, Any
+from typing import Annotated, Any, Iterator
 
 import toml
 import typer
@@ -21,6 +29,10 @@ from python_on_whales import DockerClient
 docker = DockerClient(host="unix:///var/run/docker.sock")
 
 datestamp_format = "%Y-%m-%d"
+# How often to check the download's results stream for newly finished schemes, in seconds.
+results_poll_interval = 2.0
+# Everything the `code` stage of the Dockerfile is built from.
+code_inputs = ["Dockerfile", "pyproject.toml", "uv.lock", "LICENSE.md", "README.md", "src"]
 
 app = typer.Typer(pretty_exceptions_show_locals=False,pretty_exceptions_short=False)
 
@@ -65,8 +77,401 @@ def build_image(
     return tag
 
 
-@app.command()
+def download_all(
+    schemes: list[dict[str, Any]],
+    work_dir: Path,
+    config_dir: Path,
+    cache_dir: Path,
+    secrets_file: Path,
+    jobs: int,
+    downloader: str,
+) -> Iterator[dict[str, Any]]:
+    """Start one host-side download of every selected scheme.
+
+    Returns an iterator over the schemes' results as they finish, so that packaging can start while the remaining
+    schemes are still downloading.
+    """
+    schemes_file = work_dir / "selected_schemes.json"
+    results_file = work_dir / "selected_schemes.jsonl"
+    # Make sure the results of an earlier run are not mistaken for this one's.
+    results_file.unlink(missing_ok=True)
+    command = [
+        *shlex.split(downloader),
+        "-C", str(config_dir),
+        "-o", str(work_dir / "db"),
+        "-f", str(schemes_file),
+        "-s", str(secrets_file),
+        "-c", str(cache_dir / "secrets_cache.json"),
+        "-j", str(jobs),
+        "--run-stats", str(work_dir / "run_stats.jsonl"),
+        "--results-file", str(results_file),
+    ]
+    for scheme in schemes:
+        command.extend(["-S", scheme["shortname"]])
+    print(f"Running {' '.join(command)}", file=sys.stderr)
+    # Keep STDOUT for the image CSV.
+    process = subprocess.Popen(command, stdout=sys.stderr)
+    return follow_results(process, results_file)
+
+
+def follow_results(
+    process: subprocess.Popen, results_file: Path
+) -> Iterator[dict[str, Any]]:
+    """Yield each result appended to the results stream until the download process exits."""
+    position = 0
+    buffer = ""
+    try:
+        while True:
+            finished = process.poll() is not None
+            if results_file.exists():
+                with open(results_file, "r") as f:
+                    f.seek(position)
+                    buffer += f.read()
+                    position = f.tell()
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    yield json.loads(line)
+            if finished:
+                break
+            time.sleep(results_poll_interval)
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def build_code_image(image_name: str, version: str) -> str:
+    """Build the `code` stage of the Dockerfile to use as the base of the packaged images."""
+    tag = f"{image_name}:code-{version}"
+    docker.build(
+        ".",
+        tags=[tag],
+        target="code",
+        build_args={"VERSION": version},
+        progress="plain",
+        load=True,
+    )
+    return tag
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def stage_scheme_context(
+    record: dict[str, Any], work_dir: Path, config_dir: Path
+) -> Path:
+    """Lay out a build context holding only what the image for one scheme needs."""
+    context = work_dir / "contexts" / record["shortname"]
+    if context.exists():
+        shutil.rmtree(context)
+    shutil.copytree(
+        work_dir / "db" / record["db_path"],
+        context / "db" / record["db_path"],
+        copy_function=link_or_copy,
+    )
+    (context / "config").mkdir()
+    for config_file in ["host_config.json", "schemes.json"]:
+        shutil.copy2(config_dir / config_file, context / "config" / config_file)
+    with open(context / "selected_schemes.json", "w") as f_out:
+        json.dump({"schemes": [record]}, f_out)
+    return context
+
+
+def package_image(
+    image_name: str,
+    tag_base: str,
+    record: dict[str, Any],
+    context: Path,
+    base_image: str,
+) -> str:
+    tag = f"{image_name}:{tag_base}-{record['shortname']}"
+    result = docker.build(
+        context,
+        file=Path("Dockerfile.package").absolute(),
+        tags=[tag],
+        build_args={
+            "BASE_IMAGE": base_image,
+            "SCHEME": f'-S {record["shortname"]}',
+            "BUILD_DATE": datetime.now().strftime(datestamp_format),
+        },
+        progress="plain",
+        load=True,
+    )
+    print(result, file=sys.stderr)
+    return tag
+
+
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER = "application/vnd.oci.image.layer.v1.tar"
+DOCKER_MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+REF_NAME = "org.opencontainers.image.ref.name"
+
+
+class HashingWriter:
+    """A write-only file object that hashes and counts what passes through it."""
+
+    def __init__(self, out_f):
+        self.out_f = out_f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.out_f.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+
+def read_blob(layout: Path, digest: str) -> dict[str, Any]:
+    algorithm, encoded = digest.split(":")
+    with open(layout / "blobs" / algorithm / encoded, "r") as f:
+        return json.load(f)
+
+
+def write_json_blob(layout: Path, media_type: str, content: dict[str, Any]) -> dict[str, Any]:
+    data = json.dumps(content, separators=(",", ":")).encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    with open(layout / "blobs" / "sha256" / digest, "wb") as f:
+        f.write(data)
+    return {"mediaType": media_type, "digest": f"sha256:{digest}", "size": len(data)}
+
+
+def find_image_manifest(layout: Path) -> dict[str, Any]:
+    """Find the descriptor of the (first runnable) image manifest in an OCI layout."""
+    with open(layout / "index.json", "r") as f:
+        manifests = json.load(f)["manifests"]
+    while True:
+        # BuildKit adds attestation manifests with an "unknown" platform alongside the image.
+        candidates = [
+            m for m in manifests if m.get("platform", {}).get("os") != "unknown"
+        ]
+        if not candidates:
+            raise ValueError(f"No image manifest found in {layout}")
+        descriptor = candidates[0]
+        if descriptor["mediaType"] not in [OCI_INDEX, DOCKER_MANIFEST_LIST]:
+            return descriptor
+        manifests = read_blob(layout, descriptor["digest"])["manifests"]
+
+
+def write_data_layer(context: Path, layout: Path, mtime: int) -> tuple[dict[str, Any], str]:
+    """Stream the build context into an uncompressed tar layer, returning its descriptor and diff ID.
+
+    Entries are sorted and have fixed ownership, permissions and timestamps, so the same data always produces the
+    same layer digest.
+    """
+    blobs = layout / "blobs" / "sha256"
+
+    def tar_info(name: str, path: Path) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.mtime = mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        if path.is_dir():
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = path.stat().st_size
+            info.mode = 0o644
+        return info
+
+    with tempfile.NamedTemporaryFile(dir=blobs, delete=False) as tmp_f:
+        writer = HashingWriter(tmp_f)
+        with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for root, dirs, files in os.walk(context):
+                dirs.sort()
+                root_path = Path(root)
+                for name in sorted(dirs + files):
+                    path = root_path / name
+                    info = tar_info(path.relative_to(context).as_posix(), path)
+                    if info.isdir():
+                        tar.addfile(info)
+                    else:
+                        with open(path, "rb") as in_f:
+                            tar.addfile(info, in_f)
+    digest = f"sha256:{writer.sha256.hexdigest()}"
+    os.replace(tmp_f.name, blobs / writer.sha256.hexdigest())
+    return {"mediaType": OCI_LAYER, "digest": digest, "size": writer.size}, digest
+
+
+def write_oci_image(
+    base_layout: Path,
+    context: Path,
+    out_layout: Path,
+    ref_name: str,
+    env: dict[str, str],
+    labels: dict[str, str],
+    created: datetime,
+) -> str:
+    """Add an image made of the base image plus one layer holding `context` to the OCI layout in `out_layout`.
+
+    The configuration mirrors `Dockerfile.package`: the extra environment variables and labels are merged into the
+    base configuration and the entrypoint prints `/selected_schemes.json`. Blobs are shared between the images in
+    `out_layout`, and any earlier image with the same `ref_name` is replaced. Returns the manifest digest.
+    """
+    blobs = out_layout / "blobs" / "sha256"
+    blobs.mkdir(parents=True, exist_ok=True)
+    with open(out_layout / "oci-layout", "w") as f:
+        json.dump({"imageLayoutVersion": "1.0.0"}, f)
+
+    base_descriptor = find_image_manifest(base_layout)
+    base_manifest = read_blob(base_layout, base_descriptor["digest"])
+    config = read_blob(base_layout, base_manifest["config"]["digest"])
+    for layer in base_manifest["layers"]:
+        algorithm, encoded = layer["digest"].split(":")
+        target = out_layout / "blobs" / algorithm / encoded
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(str(base_layout / "blobs" / algorithm / encoded), str(target))
+
+    layer, diff_id = write_data_layer(context, out_layout, int(created.timestamp()))
+
+    image_config = config.setdefault("config", {})
+    image_env = [
+        variable
+        for variable in image_config.get("Env") or []
+        if variable.split("=", 1)[0] not in env
+    ]
+    image_config["Env"] = image_env + [f"{key}={value}" for key, value in env.items()]
+    image_config["Labels"] = (image_config.get("Labels") or {}) | labels
+    image_config["Entrypoint"] = ["cat", "/selected_schemes.json"]
+    # As in a Dockerfile, setting the entrypoint clears any command inherited from the base image.
+    image_config["Cmd"] = None
+    config["created"] = created.strftime("%Y-%m-%dT%H:%M:%SZ")
+    config.setdefault("rootfs", {"type": "layers", "diff_ids": []})["diff_ids"].append(diff_id)
+    config.setdefault("history", []).append(
+        {"created": config["created"], "created_by": "build.py: COPY scheme data"}
+    )
+    config_descriptor = write_json_blob(out_layout, OCI_CONFIG, config)
+
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": OCI_MANIFEST,
+        "config": config_descriptor,
+        "layers": base_manifest["layers"] + [layer],
+    }
+    manifest_descriptor = write_json_blob(out_layout, OCI_MANIFEST, manifest)
+    if "platform" in base_descriptor:
+        manifest_descriptor["platform"] = base_descriptor["platform"]
+    manifest_descriptor["annotations"] = {REF_NAME: ref_name}
+
+    index_file = out_layout / "index.json"
+    index = {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": []}
+    if index_file.exists():
+        with open(index_file, "r") as f:
+            index = json.load(f)
+    index["manifests"] = [
+        m for m in index["manifests"] if m.get("annotations", {}).get(REF_NAME) != ref_name
+    ] + [manifest_descriptor]
+    with open(index_file, "w") as f:
+        json.dump(index, f, indent=2)
+    return manifest_descriptor["digest"]
+
+
+def code_hash() -> str:
+    """Hash the files the `code` stage is built from, so that a code change without a version bump is noticed."""
+    sha256 = hashlib.sha256()
+    for name in code_inputs:
+        path = Path(name)
+        if path.is_dir():
+            files = sorted(
+                file for file in path.rglob("*") if file.is_file() and "__pycache__" not in file.parts
+            )
+        else:
+            files = [path] if path.exists() else []
+        for file in files:
+            data = file.read_bytes()
+            sha256.update(f"{file.as_posix()}\0{len(data)}\0".encode("utf-8"))
+            sha256.update(data)
+    return sha256.hexdigest()[:16]
+
+
+def build_code_layout(work_dir: Path, version: str) -> Path:
+    """Export the `code` stage of the Dockerfile as an OCI layout to build the scheme images on.
+
+    The export is kept in the work directory and reused for as long as the code it was built from is unchanged.
+    """
+    layout = work_dir / f"code-{version}-{code_hash()}"
+    if not (layout / "index.json").exists():
+        docker.buildx.build(
+            ".",
+            target="code",
+            build_args={"VERSION": version},
+            output={"type": "oci", "dest": str(layout), "tar": "false"},
+            progress="plain",
+        )
+    return layout
+
+
+def package_oci_image(
+    image_name: str,
+    tag_base: str,
+    record: dict[str, Any],
+    context: Path,
+    base_layout: Path,
+    out_layout: Path,
+) -> str:
+    tag = f"{image_name}:{tag_base}-{record['shortname']}"
+    build_date = datetime.now().strftime(datestamp_format)
+    digest = write_oci_image(
+        base_layout,
+        context,
+        out_layout,
+        f"{tag_base}-{record['shortname']}",
+        env={"SCHEME": f'-S {record["shortname"]}'},
+        labels={"build_data": build_date},
+        created=datetime.strptime(build_date, datestamp_format).replace(tzinfo=timezone.utc),
+    )
+    print(f"Wrote {tag} ({digest}) to {out_layout}", file=sys.stderr)
+    return tag
+
+
+def shard_schemes(
+    schemes: list[dict[str, Any]],
+    shard: str,
+    config_dir: Path,
+    shard_costs_file: Path | None,
+    downloader: str,
+) -> list[dict[str, Any]]:
+    """Keep the schemes in one shard, as split by `download_schemes shard`.
+
+    Costs come from the config and the shared costs file, if given, so that every node computes the same split.
+    """
+    command = [*shlex.split(downloader), "shard", shard, "-C", str(config_dir)]
+    if shard_costs_file is not None:
+        command.extend(["--shard-costs", str(shard_costs_file)])
+    for scheme in schemes:
+        command.extend(["-S", scheme["shortname"]])
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    selected = set(result.stdout.split())
+    return [scheme for scheme in schemes if scheme["shortname"] in selected]
+
+
+def select_schemes(
+    scheme_file: Path, selection: list[str] | None, scheme_type: list[str] | None
+) -> list[dict[str, Any]]:
+    with open(scheme_file, "r") as sf:
+        return [
+            scheme
+            for scheme in json.load(sf)["schemes"]
+            if (
+                (selection is not None and scheme["shortname"] in selection)
+                or (scheme_type is not None and scheme["type"] in scheme_type)
+                or (selection is None and scheme_type is None)
+            )
+        ]
+
+
+@app.callback(invoke_without_command=True)
 def build(
+    ctx: typer.Context,
     scheme_file: Annotated[
         Path,
         typer.Option(
@@ -112,38 +517,302 @@ def build(
     secrets_file: Annotated[
         Path,
         typer.Option(
-            "-S", "--secrets-file", exists=True, file_okay=True, dir_okay=False
+            "-S", "--secrets-file", file_okay=True, dir_okay=False
         ),
     ] = Path("secrets.json"),
     cache_dir: Annotated[
         Path, typer.Option("-C", "--cache-dir", file_okay=False, dir_okay=True)
     ] = Path("cache_dir"),
+    download_once: Annotated[
+        bool,
+        typer.Option(
+            "--download-once",
+            help="Download all the selected schemes in a single run on this machine, then package each "
+            "scheme directory into its own image without network access.",
+        ),
+    ] = False,
+    jobs: Annotated[
+        int,
+        typer.Option(
+            "-j",
+            "--jobs",
+            help="Number of schemes to download at the same time with --download-once",
+        ),
+    ] = 4,
+    work_dir: Annotated[
+        Path,
+        typer.Option(
+            "-w",
+            "--work-dir",
+            help="Where --download-once keeps the downloaded data and build contexts",
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = Path("build_data"),
+    downloader: Annotated[
+        str,
+        typer.Option(
+            "--downloader",
+            help="Command used to run the downloader with --download-once",
+        ),
+    ] = "download_schemes",
+    oci_layout: Annotated[
+        Path,
+        typer.Option(
+            "--oci-layout",
+            help="With --download-once, write the images into this OCI image layout directory instead of "
+            "building them with Docker",
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = None,
+    base_layout: Annotated[
+        Path,
+        typer.Option(
+            "--base-layout",
+            help="OCI layout of the `code` image to build on with --oci-layout. If not given, it is exported "
+            "once with `docker buildx`.",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = None,
+    shard: Annotated[
+        str,
+        typer.Option(
+            "--shard",
+            help="Only build shard i of N (e.g. '2/4') of the selected schemes, split by estimated duration. "
+            "Combine the shards' selected_schemes.json files with `download_schemes merge`.",
+        ),
+    ] = None,
+    shard_costs_file: Annotated[
+        Path,
+        typer.Option(
+            "--shard-costs",
+            help="Run stats file shared by every node, used to balance the shards (see `download_schemes "
+            "--shard-costs`)",
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = None,
 ) -> None:
+    """Build an image per selected scheme."""
+    if ctx.invoked_subcommand is not None:
+        return
+    # Checked here rather than by typer so that subcommands do not need a secrets file.
+    if not secrets_file.is_file():
+        raise typer.BadParameter(
+            f"File '{secrets_file}' does not exist.", param_hint="'-S' / '--secrets-file'"
+        )
     cache_dir.mkdir(parents=True, exist_ok=True)
     
     version = get_version_from_pyproject()
-    
-    with open(scheme_file, "r") as sf:
-        for scheme in json.load(sf)["schemes"]:
-            if (
-                (selection is not None and scheme["shortname"] in selection)
-                or (scheme_type is not None and scheme["type"] in scheme_type)
-                or (selection is None and scheme_type is None)
-            ):
-                print(f"Building scheme {scheme['shortname']}", file=sys.stderr)
-                image_name = build_image(
-                    image_base_name,
-                    image_tag,
-                    scheme,
-                    cache_dir,
-                    secrets_file,
-                    version
-                )
+
+    schemes = select_schemes(scheme_file, selection, scheme_type)
+    if shard is not None:
+        schemes = shard_schemes(
+            schemes, shard, scheme_file.parent, shard_costs_file, downloader
+        )
+        print(f"Shard {shard}: {len(schemes)} schemes", file=sys.stderr)
+    if oci_layout is not None and not download_once:
+        raise typer.BadParameter("--oci-layout requires --download-once")
+
+    if download_once:
+        work_dir.mkdir(parents=True, exist_ok=True)
+        results = download_all(
+            schemes,
+            work_dir,
+            scheme_file.parent,
+            cache_dir,
+            secrets_file,
+            jobs,
+            downloader,
+        )
+        if oci_layout is not None:
+            base_layout = base_layout or build_code_layout(work_dir, version)
+        else:
+            base_image = build_code_image(image_base_name, version)
+        for result in results:
+            if result["status"] != "ok":
                 print(
-                    f"{scheme['shortname']},{image_tag},{image_name}",
-                    file=sys.stdout,
-                    end="\n",
+                    f"Not packaging {result['shortname']}: {result['error']}",
+                    file=sys.stderr,
                 )
+                continue
+            record = result["scheme"]
+            print(f"Packaging scheme {record['shortname']}", file=sys.stderr)
+            context = stage_scheme_context(record, work_dir, scheme_file.parent)
+            if oci_layout is not None:
+                image_name = package_oci_image(
+                    image_base_name, image_tag, record, context, base_layout, oci_layout
+                )
+            else:
+                image_name = package_image(
+                    image_base_name, image_tag, record, context, base_image
+                )
+            print(
+                f"{record['shortname']},{image_tag},{image_name}",
+                file=sys.stdout,
+                end="\n",
+                flush=True,
+            )
+        return
+
+    for scheme in schemes:
+        print(f"Building scheme {scheme['shortname']}", file=sys.stderr)
+        image_name = build_image(
+            image_base_name,
+            image_tag,
+            scheme,
+            cache_dir,
+            secrets_file,
+            version
+        )
+        print(
+            f"{scheme['shortname']},{image_tag},{image_name}",
+            file=sys.stdout,
+            end="\n",
+        )
+
+
+def write_check_base_layout(layout: Path) -> None:
+    """Write a tiny stand-in for the `code` image, nested in an index with an attestation as BuildKit exports it."""
+    blobs = layout / "blobs" / "sha256"
+    blobs.mkdir(parents=True)
+    base_context = layout.parent / "base_context"
+    (base_context / "usr" / "bin").mkdir(parents=True)
+    (base_context / "usr" / "bin" / "download_schemes").write_text("#!/bin/sh\n")
+    layer, diff_id = write_data_layer(base_context, layout, 0)
+    config = write_json_blob(layout, OCI_CONFIG, {
+        "architecture": "amd64",
+        "os": "linux",
+        "config": {"Env": ["PATH=/usr/bin", "SCHEME="], "Cmd": ["python3"]},
+        "rootfs": {"type": "layers", "diff_ids": [diff_id]},
+        "history": [{"created_by": "check-oci base"}],
+    })
+    manifest = write_json_blob(
+        layout, OCI_MANIFEST, {"schemaVersion": 2, "mediaType": OCI_MANIFEST, "config": config, "layers": [layer]}
+    )
+    attestation = write_json_blob(
+        layout, OCI_MANIFEST, {"schemaVersion": 2, "mediaType": OCI_MANIFEST, "config": config, "layers": []}
+    )
+    nested = write_json_blob(layout, OCI_INDEX, {
+        "schemaVersion": 2,
+        "mediaType": OCI_INDEX,
+        "manifests": [
+            attestation | {"platform": {"architecture": "unknown", "os": "unknown"}},
+            manifest | {"platform": {"architecture": "amd64", "os": "linux"}},
+        ],
+    })
+    with open(layout / "index.json", "w") as f:
+        json.dump({"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": [nested]}, f)
+
+
+def write_check_context(context: Path) -> None:
+    """Write a scheme build context like the one `stage_scheme_context` lays out."""
+    scheme_dir = context / "db" / "mlst_schemes" / "check_1"
+    scheme_dir.mkdir(parents=True)
+    (scheme_dir / "abcZ.fa.gz").write_bytes(os.urandom(4096))
+    (scheme_dir / "metadata.json").write_text('{"last_updated": "2025-01-01", "genes": ["abcZ"]}')
+    (context / "config").mkdir()
+    for config_file in ["host_config.json", "schemes.json"]:
+        (context / "config" / config_file).write_text("{}")
+    (context / "selected_schemes.json").write_text('{"schemes": [{"shortname": "check"}]}')
+
+
+def check_oci_image(
+    layout: Path, ref_name: str, context: Path, env: dict[str, str], labels: dict[str, str]
+) -> list[str]:
+    """Check one image in an OCI layout against the blobs it references and the context it was written from."""
+    problems = []
+    with open(layout / "index.json", "r") as f:
+        descriptors = [
+            m for m in json.load(f)["manifests"] if m.get("annotations", {}).get(REF_NAME) == ref_name
+        ]
+    if len(descriptors) != 1:
+        return [f"Expected one manifest named {ref_name} in index.json, found {len(descriptors)}"]
+    manifest = read_blob(layout, descriptors[0]["digest"])
+    for descriptor in [descriptors[0], manifest["config"], *manifest["layers"]]:
+        algorithm, encoded = descriptor["digest"].split(":")
+        blob = layout / "blobs" / algorithm / encoded
+        if not blob.exists():
+            problems.append(f"Missing blob {descriptor['digest']}")
+            continue
+        data = blob.read_bytes()
+        if len(data) != descriptor["size"] or hashlib.sha256(data).hexdigest() != encoded:
+            problems.append(f"Blob {descriptor['digest']} does not match its descriptor")
+    if problems:
+        return problems
+
+    config = read_blob(layout, manifest["config"]["digest"])
+    image_config = config["config"]
+    diff_ids = config["rootfs"]["diff_ids"]
+    if len(diff_ids) != len(manifest["layers"]) or diff_ids[-1] != manifest["layers"][-1]["digest"]:
+        problems.append("The config's diff_ids do not match the manifest's layers")
+    if image_config.get("Entrypoint") != ["cat", "/selected_schemes.json"] or image_config.get("Cmd") is not None:
+        problems.append(f"Unexpected entrypoint {image_config.get('Entrypoint')} and command {image_config.get('Cmd')}")
+    image_env = dict(variable.split("=", 1) for variable in image_config.get("Env") or [])
+    for key, value in env.items():
+        if image_env.get(key) != value:
+            problems.append(f"Expected {key}={value} in the environment, found {image_env.get(key)}")
+    for key, value in labels.items():
+        if (image_config.get("Labels") or {}).get(key) != value:
+            problems.append(f"Expected label {key}={value}")
+
+    expected = sorted(path.relative_to(context).as_posix() for path in context.rglob("*"))
+    algorithm, encoded = manifest["layers"][-1]["digest"].split(":")
+    with tarfile.open(layout / "blobs" / algorithm / encoded, "r:") as tar:
+        members = tar.getmembers()
+        if sorted(member.name for member in members) != expected:
+            problems.append("The data layer does not hold exactly the files of the context")
+        for member in members:
+            if member.isfile() and tar.extractfile(member).read() != (context / member.name).read_bytes():
+                problems.append(f"{member.name} differs in the data layer")
+    return problems
+
+
+@app.command("check-oci")
+def check_oci(
+    base_layout: Annotated[
+        Path,
+        typer.Option(
+            "--base-layout",
+            help="OCI layout of the `code` image to build on. A small stand-in image is used if not given.",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = None,
+) -> None:
+    """Check the daemonless OCI image writer offline against a local scheme directory layout.
+
+    A scheme build context is written to a temporary directory and packaged twice, into two layouts and again into
+    the first. The images must reference only blobs whose digests and sizes match, carry the entrypoint, environment
+    and labels of `Dockerfile.package`, hold exactly the context's files, and be byte-for-byte reproducible.
+    """
+    env = {"SCHEME": "-S check"}
+    labels = {"build_data": "2025-01-01"}
+    created = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        if base_layout is None:
+            base_layout = tmp_dir / "base"
+            write_check_base_layout(base_layout)
+        context = tmp_dir / "context"
+        write_check_context(context)
+        digests = [
+            write_oci_image(base_layout, context, tmp_dir / layout, "check", env, labels, created)
+            for layout in ["first", "second", "first"]
+        ]
+        problems = check_oci_image(tmp_dir / "first", "check", context, env, labels)
+    if len(set(digests)) != 1:
+        problems.append(f"Packaging the same context gave different manifests: {', '.join(digests)}")
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        raise typer.Exit(code=1)
+    print(f"OCI image writer produced {digests[0]} as expected", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,8 @@
+import time
+
+# When the package was first imported, so that the run summary can report how long start-up took.
+imported_at = time.monotonic()
+
 if __name__ == "__main__":
     from download_schemes.download_schemes import app
     app()
\ No newline at end of file
@@ -0,0 +1,114 @@
+import gzip
+from pathlib import Path
+from typing import Any
+
+from download_schemes.manifest import HashingWriter
+from download_schemes.pipeline import Stage
+
+ARCHIVE_FILE = "alleles.archive.fa.gz"
+ARCHIVE_INDEX = "alleles.archive.idx"
+BLOCK_SIZE = 1 << 16
+
+
+class ArchiveStage(Stage):
+    """Packs the whole scheme into one block-compressed FASTA file with an allele offset index.
+
+    Alleles are written as unwrapped FASTA records into independent gzip members of about `BLOCK_SIZE`
+    uncompressed bytes, and each locus starts a new member. The file as a whole is still a valid gzip stream, but a
+    locus is a contiguous run of members and an allele lives in exactly one member, so either can be read with a
+    single seek without decompressing anything else. The index is tab-delimited with one line per allele:
+    locus, allele ID, member offset, member size, offset within the member and record length.
+    """
+
+    def __init__(self, scheme_dir: Path, scheme_type: str):
+        super().__init__(scheme_dir, scheme_type)
+        self.archive_file = open(scheme_dir / ARCHIVE_FILE, "wb")
+        self.index_file = open(scheme_dir / ARCHIVE_INDEX, "wb")
+        self.archive = HashingWriter(self.archive_file)
+        self.index = HashingWriter(self.index_file)
+        self.locus = None
+        self.records: list[str] = []
+        self.entries: list[tuple[str, str, int, int]] = []
+        self.block_length = 0
+        self.alleles = 0
+        self.loci = 0
+
+    def add_allele(self, locus: str, allele_id: str, sequence: str) -> None:
+        if locus != self.locus:
+            self.__flush()
+            self.locus = locus
+            self.loci += 1
+        record = f">{allele_id}\n{sequence}\n"
+        self.records.append(record)
+        self.entries.append((locus, allele_id, self.block_length, len(record)))
+        self.block_length += len(record)
+        self.alleles += 1
+        if self.block_length >= BLOCK_SIZE:
+            self.__flush()
+
+    def __flush(self) -> None:
+        if not self.records:
+            return
+        block = gzip.compress("".join(self.records).encode("ascii"), mtime=0)
+        offset = self.archive.size
+        self.archive.write(block)
+        self.index.write(
+            "".join(
+                f"{locus}\t{allele_id}\t{offset}\t{len(block)}\t{start}\t{length}\n"
+                for locus, allele_id, start, length in self.entries
+            ).encode("utf-8")
+        )
+        self.records = []
+        self.entries = []
+        self.block_length = 0
+
+    def finish(self, metadata: dict[str, Any]) -> None:
+        self.__flush()
+        self.archive_file.close()
+        self.index_file.close()
+        self.files[ARCHIVE_FILE] = self.archive.entry(alleles=self.alleles)
+        self.files[ARCHIVE_INDEX] = self.index.entry(alleles=self.alleles)
+        metadata["archive"] = {
+            "file": ARCHIVE_FILE,
+            "index": ARCHIVE_INDEX,
+            "block_size": BLOCK_SIZE,
+            "loci": self.loci,
+            "alleles": self.alleles,
+        }
+
+
+class SchemeArchive:
+    """Random access to the loci and alleles in a scheme archive."""
+
+    def __init__(self, scheme_dir: Path):
+        self.path = scheme_dir / ARCHIVE_FILE
+        self.alleles: dict[str, dict[str, tuple[int, int, int, int]]] = {}
+        self.loci: dict[str, tuple[int, int]] = {}
+        with open(scheme_dir / ARCHIVE_INDEX, "r") as index:
+            for line in index:
+                locus, allele_id, offset, size, start, length = line.rstrip("\n").split("\t")
+                offset, size = int(offset), int(size)
+                self.alleles.setdefault(locus, {})[allele_id] = (
+                    offset,
+                    size,
+                    int(start),
+                    int(length),
+                )
+                first = self.loci.get(locus, (offset, 0))[0]
+                self.loci[locus] = (first, offset + size)
+
+    def __read(self, offset: int, size: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(size))
+
+    def read_locus(self, locus: str) -> str:
+        """Return all the alleles of a locus as FASTA text."""
+        start, end = self.loci[locus]
+        return self.__read(start, end - start).decode("ascii")
+
+    def read_allele(self, locus: str, allele_id: str) -> str:
+        """Return the sequence of a single allele."""
+        offset, size, start, length = self.alleles[locus][allele_id]
+        record = self.__read(offset, size)[start : start + length].decode("ascii")
+        return record.split("\n")[1]
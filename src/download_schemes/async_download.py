@@ -0,0 +1,472 @@
+import asyncio
+import contextlib
+import dataclasses
+import gzip
+import io
+import logging
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Executor
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, TypeVar
+from urllib.parse import parse_qsl, urlsplit
+
+import aiohttp
+from rauth.oauth import HmacSha1Signature
+
+from download_schemes import memory, registry
+from download_schemes.downloaders import EnterobaseFtpDownloader, PubmlstDownloader
+from download_schemes.keycache import KeyCache
+from download_schemes.pipeline import PipelineOptions, SchemeWriter
+from download_schemes.profiles import CHUNK_SIZE, iter_chunks, write_profiles
+
+T = TypeVar("T")
+
+USER_AGENT = "download_schemes (asyncio)"
+# Requests in flight to each host at once, shared by all the schemes being downloaded.
+HOST_REQUEST_LIMITS: dict[str, int] = {
+    "pubmlst": 8,
+    "pasteur": 8,
+    "enterobase": 8,
+}
+DEFAULT_REQUEST_LIMIT = 4
+# Loci of one scheme fetched ahead of the one being written.
+LOCUS_CONCURRENCY = 16
+CONNECT_TIMEOUT = 60.0
+# Longest wait for the next bytes of a response.
+REQUEST_TIMEOUT = 300.0
+RETRY_ATTEMPTS = 5
+RETRY_MAX_WAIT = 60.0
+
+
+class HttpError(Exception):
+    def __init__(self, response: aiohttp.ClientResponse):
+        super().__init__(f"GET '{response.url}' returned {response.status}")
+        self.status = response.status
+
+
+def check_status(response: aiohttp.ClientResponse) -> None:
+    """Raise for anything but a 2xx, including redirects that were not followed."""
+    if not 200 <= response.status < 300:
+        raise HttpError(response)
+
+
+def content_length(response: aiohttp.ClientResponse) -> int | None:
+    """The expected body size, as `downloaders.content_length` gives it for `requests`."""
+    if "Content-Encoding" in response.headers:
+        # aiohttp transparently decodes compressed bodies, so the declared length no longer applies.
+        return None
+    return response.content_length
+
+
+def oauth1_params(url: str, consumer_key: tuple[str, str], access_key: tuple[str, str]) -> dict[str, str]:
+    """The OAuth 1.0a parameters signing a GET of `url`, which `rauth.OAuth1Session` would add to the query."""
+    signature = HmacSha1Signature()
+    params = {
+        "oauth_consumer_key": consumer_key[0],
+        "oauth_nonce": uuid.uuid4().hex,
+        "oauth_signature_method": signature.NAME,
+        "oauth_timestamp": str(int(time.time())),
+        "oauth_token": access_key[0],
+        "oauth_version": "1.0",
+    }
+    query = dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
+    params["oauth_signature"] = signature.sign(
+        consumer_key[1], access_key[1], "GET", url, params, {"params": query}
+    )
+    return params
+
+
+def blocking_chunks(response: aiohttp.ClientResponse, loop: asyncio.AbstractEventLoop) -> Iterator[bytes]:
+    """Read a response body from an executor thread, as it arrives on the event loop."""
+    while True:
+        chunk = asyncio.run_coroutine_threadsafe(response.content.readany(), loop).result()
+        if not chunk:
+            return
+        yield chunk
+
+
+class ChunkReader(io.RawIOBase):
+    """A binary file over an iterator of chunks, for readers such as `gzip.GzipFile` that want a file."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self.pending:
+            self.pending = next(self.chunks, b"")
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+@dataclasses.dataclass
+class DownloadEvent:
+    """Progress of an async download.
+
+    `kind` is `scheme_started`, `locus` (one locus written, with its allele count), `scheme_finished` (with the
+    scheme's `db_path`, `last_updated` and `seconds` taken) or `scheme_failed` (with the `error`).
+    """
+
+    kind: str
+    shortname: str
+    locus: str = None
+    alleles: int = None
+    db_path: str = None
+    last_updated: str = None
+    seconds: float = None
+    error: str = None
+
+
+class AsyncSession:
+    """State shared by the async downloads: the HTTP client, per-host request limits and the executor for blocking
+    work.
+
+    Normalising, compressing and writing alleles, and minting BIGSdb keys, all block, so they are run in the
+    executor (the event loop's default thread pool if none is given) while the event loop gets on with the requests.
+    The client keeps connections alive between requests and takes proxies from the environment, as `requests` does.
+    """
+
+    def __init__(self, keycache: KeyCache, executor: Executor = None, host_limits: dict[str, int] = None):
+        self.keycache = keycache
+        self.executor = executor
+        self.host_limits = HOST_REQUEST_LIMITS if host_limits is None else host_limits
+        self.__semaphores: dict[str, asyncio.Semaphore] = {}
+        self.__client: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self) -> "AsyncSession":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self.__client is not None:
+            await self.__client.close()
+            self.__client = None
+
+    def __semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self.__semaphores:
+            self.__semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, DEFAULT_REQUEST_LIMIT))
+        return self.__semaphores[host]
+
+    @property
+    def client(self) -> aiohttp.ClientSession:
+        # Created on first use, as it must be made inside the running event loop.
+        if self.__client is None:
+            self.__client = aiohttp.ClientSession(
+                headers={"User-Agent": USER_AGENT},
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=REQUEST_TIMEOUT),
+                trust_env=True,
+            )
+        return self.__client
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def __request(
+        self,
+        url: str,
+        params: Callable[[], dict[str, str]] = None,
+        allow_redirects: bool = True,
+        verify: bool = True,
+    ) -> aiohttp.ClientResponse:
+        """Send a GET, retrying connection errors and server errors until the response headers arrive.
+
+        Once the body is being read a failure is not retried, as part of it may already have been consumed. `params`
+        is called for each attempt, so that a signed request gets a fresh nonce.
+        """
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                response = await self.client.get(
+                    url,
+                    params=params() if params else None,
+                    allow_redirects=allow_redirects,
+                    ssl=None if verify else False,
+                )
+                if response.status < 500 and response.status != 429:
+                    return response
+                response.release()
+                error: Exception = HttpError(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt == RETRY_ATTEMPTS:
+                raise error
+            wait = min(RETRY_MAX_WAIT, 2**attempt)
+            logging.debug(f"Retrying {url} in {wait}s after: {error!r}")
+            await asyncio.sleep(wait)
+        raise AssertionError("unreachable")
+
+    @contextlib.asynccontextmanager
+    async def get(self, host: str, url: str, verify: bool = True) -> AsyncIterator[aiohttp.ClientResponse]:
+        """GET a URL, holding one of the host's request slots until the body has been read within the context.
+
+        A body that ends before its declared length, or mid-chunk, raises `aiohttp.ClientPayloadError` as it is read.
+        """
+        async with self.__semaphore(host):
+            response = await self.__request(url, verify=verify)
+            try:
+                check_status(response)
+                yield response
+            finally:
+                response.release()
+
+    @contextlib.asynccontextmanager
+    async def oauth_get(self, host: str, database: str, url: str) -> AsyncIterator[aiohttp.ClientResponse]:
+        """GET from BIGSdb with the cached session key, replacing the key once if it has been revoked."""
+        for attempt in range(2):
+            consumer_key = self.keycache.get_consumer_key(host)
+            session_key = await self.run(self.keycache.get_session_key, host, database)
+            async with self.__semaphore(host):
+                # BIGSdb answers a bad session key with a redirect, so redirects are not followed.
+                response = await self.__request(
+                    url, partial(oauth1_params, url, consumer_key, session_key), allow_redirects=False
+                )
+                try:
+                    denied = response.status in (301, 401) and attempt == 0
+                    if not denied:
+                        check_status(response)
+                        yield response
+                        return
+                finally:
+                    response.release()
+            logging.error(f"Session access denied. Attempting to regenerate keys as needed for {host}")
+            await self.run(self.keycache.delete_key, "session", host)
+        raise AssertionError("unreachable")
+
+    async def buffer(self, response: aiohttp.ClientResponse) -> memory.Payload:
+        """Read a response body within the memory budget, returning it positioned at the start.
+
+        Unlike `MemoryBudget.buffer` this never waits for room: a body that does not fit goes to disk, since a locus
+        fetched ahead waiting for room could hold up the locus the writer is waiting on.
+        """
+        payload = memory.budget.payload(content_length(response), wait=False)
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                payload.write(chunk)
+            payload.file.seek(0)
+        except BaseException:
+            payload.close()
+            raise
+        return payload
+
+    async def write_streamed(self, response: aiohttp.ClientResponse, write: Callable[[Iterator[bytes]], T]) -> T:
+        """Run `write` in the executor over the response body's chunks as they arrive."""
+        return await self.run(write, blocking_chunks(response, asyncio.get_running_loop()))
+
+
+async def locus_events(
+    loci: list[str],
+    fetch_locus: Callable[[str], Awaitable[memory.Payload]],
+    write_locus: Callable[[str, memory.Payload], Awaitable[DownloadEvent]],
+) -> AsyncIterator[DownloadEvent]:
+    """Fetch up to `LOCUS_CONCURRENCY` loci ahead while writing them one at a time, in the order given.
+
+    Writing in order keeps the scheme's files identical to those of the blocking downloaders. The loci fetched ahead
+    are held within the memory budget, and `write_locus` closes each one once written.
+    """
+    window: deque[tuple[str, asyncio.Future]] = deque()
+    remaining = iter(loci)
+    try:
+        while True:
+            while len(window) < LOCUS_CONCURRENCY:
+                locus = next(remaining, None)
+                if locus is None:
+                    break
+                window.append((locus, asyncio.ensure_future(fetch_locus(locus))))
+            if not window:
+                break
+            locus, fetched = window.popleft()
+            yield await write_locus(locus, await fetched)
+    finally:
+        for _, fetched in window:
+            fetched.cancel()
+        for result in await asyncio.gather(*(fetched for _, fetched in window), return_exceptions=True):
+            if isinstance(result, memory.Payload):
+                result.close()
+
+
+async def download_bigsdb(
+    metadata: dict[str, Any], output_dir: Path, session: AsyncSession, options: PipelineOptions = None
+) -> AsyncIterator[DownloadEvent]:
+    downloader = PubmlstDownloader.from_metadata(metadata, session.keycache)
+    shortname = metadata["shortname"]
+
+    def get(url: str) -> contextlib.AbstractAsyncContextManager[aiohttp.ClientResponse]:
+        if downloader.authenticate:
+            return session.oauth_get(downloader.host, downloader.database, url)
+        return session.get(downloader.host, url)
+
+    async def get_text(url: str) -> str:
+        async with get(url) as response:
+            return await response.text("utf-8")
+
+    scheme_subdir = Path(f"{downloader.type}_schemes") / downloader.name
+    scheme_dir = output_dir / scheme_subdir
+    scheme_dir.mkdir(parents=True, exist_ok=True)
+    writer = await session.run(SchemeWriter, scheme_dir, downloader.type, options)
+    last_updated = PubmlstDownloader.parse_timestamp(await get_text(downloader.scheme_url))
+    loci = downloader.parse_loci(await get_text(downloader.loci_url))
+    # PubMLST puts an apostrophe in front of RNA genes.
+    scheme_metadata = {"last_updated": last_updated, "genes": [locus.replace("'", "") for locus in loci]}
+
+    async def fetch_locus(locus: str) -> memory.Payload:
+        async with get(f"{downloader.alleles_url}/{locus}/alleles_fasta") as response:
+            return await session.buffer(response)
+
+    def write_buffered(locus: str, payload: memory.Payload) -> list[str]:
+        with payload:
+            return writer.write_locus(locus, io.TextIOWrapper(payload.file, encoding="utf-8"))
+
+    async def write_locus(locus: str, payload: memory.Payload) -> DownloadEvent:
+        clean_locus = locus.replace("'", "")
+        allele_ids = await session.run(write_buffered, clean_locus, payload)
+        return DownloadEvent("locus", shortname, locus=clean_locus, alleles=len(allele_ids))
+
+    async for event in locus_events(loci, fetch_locus, write_locus):
+        yield event
+    if downloader.type != "cgmlst":
+        async with get(f"{downloader.scheme_url}/profiles_csv") as response:
+            write = partial(
+                write_profiles, out_file=scheme_dir / "profiles.tsv", expected_size=content_length(response)
+            )
+            scheme_metadata["profiles"] = await session.write_streamed(response, write)
+    await session.run(writer.close, scheme_metadata)
+    yield DownloadEvent("scheme_finished", shortname, db_path=str(scheme_subdir), last_updated=last_updated)
+
+
+async def download_enterobase(
+    metadata: dict[str, Any], output_dir: Path, session: AsyncSession, options: PipelineOptions = None
+) -> AsyncIterator[DownloadEvent]:
+    downloader = EnterobaseFtpDownloader.from_metadata(metadata, session.keycache)
+    shortname = metadata["shortname"]
+    scheme_subdir = Path(f"{downloader.type}_schemes") / downloader.name
+    scheme_dir = output_dir / scheme_subdir
+    scheme_dir.mkdir(parents=True, exist_ok=True)
+    writer = await session.run(SchemeWriter, scheme_dir, downloader.type, options)
+    # The same relaxed TLS settings `downloaders.download` uses for Enterobase.
+    async with session.get("enterobase", downloader.scheme_url, verify=False) as response:
+        listing = await response.read()
+    last_updated = downloader.parse_timestamp(listing.splitlines())
+    # Only the header line of the (possibly very large) profiles file is needed, which the blocking downloader reads
+    # without fetching the rest.
+    loci = await session.run(downloader.download_loci_list)
+    scheme_metadata = {"last_updated": last_updated, "genes": loci}
+
+    async def fetch_locus(locus: str) -> memory.Payload:
+        url = f"{downloader.scheme_url}/{locus}.fasta.gz"
+        async with session.get("enterobase", url, verify=False) as response:
+            return await session.buffer(response)
+
+    def decompress_and_write(locus: str, payload: memory.Payload) -> list[str]:
+        with payload, gzip.open(payload.file, "rt") as fasta:
+            return writer.write_locus(locus, fasta)
+
+    async def write_locus(locus: str, payload: memory.Payload) -> DownloadEvent:
+        allele_ids = await session.run(decompress_and_write, locus, payload)
+        return DownloadEvent("locus", shortname, locus=locus, alleles=len(allele_ids))
+
+    def write_compressed_profiles(chunks: Iterator[bytes]) -> dict[str, Any]:
+        with gzip.GzipFile(fileobj=io.BufferedReader(ChunkReader(chunks))) as rz:
+            return write_profiles(iter_chunks(rz), scheme_dir / "profiles.tsv")
+
+    async for event in locus_events(loci, fetch_locus, write_locus):
+        yield event
+    if downloader.type != "cgmlst":
+        async with session.get("enterobase", downloader.profiles_url, verify=False) as response:
+            scheme_metadata["profiles"] = await session.write_streamed(response, write_compressed_profiles)
+    await session.run(writer.close, scheme_metadata)
+    yield DownloadEvent("scheme_finished", shortname, db_path=str(scheme_subdir), last_updated=last_updated)
+
+
+async def download_blocking(
+    metadata: dict[str, Any], output_dir: Path, session: AsyncSession, options: PipelineOptions = None
+) -> AsyncIterator[DownloadEvent]:
+    """Run a downloader without an async implementation in the executor.
+
+    Ridom and NG-STAR schemes are each a handful of large requests, so there is little to gain from doing them
+    asynchronously.
+    """
+    downloader = await session.run(registry.initialise, metadata, session.keycache)
+    db_path, last_updated = await session.run(downloader.download, output_dir, options)
+    yield DownloadEvent(
+        "scheme_finished", metadata["shortname"], db_path=str(db_path), last_updated=last_updated
+    )
+
+
+ASYNC_DOWNLOADERS = {
+    "pubmlst": download_bigsdb,
+    "pasteur": download_bigsdb,
+    "enterobase": download_enterobase,
+}
+
+
+async def download_scheme_async(
+    metadata: dict[str, Any], output_dir: Path, session: AsyncSession, options: PipelineOptions = None
+) -> AsyncIterator[DownloadEvent]:
+    """The asyncio counterpart of `download_scheme`, yielding progress events as the scheme is downloaded.
+
+    Failures are reported as a `scheme_failed` event rather than raised.
+    """
+    shortname = metadata["shortname"]
+    start = time.monotonic()
+    yield DownloadEvent("scheme_started", shortname)
+    download = ASYNC_DOWNLOADERS.get(metadata.get("host"), download_blocking)
+    try:
+        async for event in download(metadata, output_dir, session, options):
+            if event.kind == "scheme_finished":
+                event.seconds = time.monotonic() - start
+            yield event
+    except Exception as e:
+        logging.error(f"Error downloading {shortname}: {str(e)}")
+        yield DownloadEvent("scheme_failed", shortname, seconds=time.monotonic() - start, error=str(e))
+
+
+async def download_schemes_async(
+    output_dir: Path,
+    schemes: list[dict[str, Any]],
+    keycache: KeyCache,
+    options: PipelineOptions = None,
+    max_schemes: int = 4,
+    executor: Executor = None,
+    host_limits: dict[str, int] = None,
+) -> AsyncIterator[DownloadEvent]:
+    """The asyncio counterpart of `download_schemes`, yielding the events of up to `max_schemes` schemes at once.
+
+    Unlike `download_schemes`, no schemes file is written: the `scheme_finished` events carry each scheme's
+    `db_path` and `last_updated` for the caller to record.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    session = AsyncSession(keycache, executor, host_limits)
+    events: asyncio.Queue[DownloadEvent | None] = asyncio.Queue()
+    scheme_limit = asyncio.Semaphore(max_schemes)
+
+    async def run_scheme(scheme: dict[str, Any]) -> None:
+        try:
+            async with scheme_limit:
+                async for event in download_scheme_async(scheme, output_dir, session, options):
+                    await events.put(event)
+        finally:
+            await events.put(None)
+
+    tasks = [asyncio.ensure_future(run_scheme(scheme)) for scheme in schemes]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await events.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await session.close()
@@ -1,12 +1,32 @@
 import json
 import logging
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Annotated, Any, Optional
 
 import typer
 
-from download_schemes import downloaders
-from download_schemes.keycache import KeyCache
+from download_schemes import imported_at, memory, registry
+from download_schemes.keycache import KeyCache, bigsdb_database
+from download_schemes.pipeline import STAGES, PipelineOptions, load_stage
+from download_schemes.results import (
+    ResultsStream,
+    read_results,
+    scheme_result,
+    schemes_from_results,
+    write_schemes_file,
+)
+from download_schemes.run_stats import (
+    append_run_stats,
+    directory_size,
+    expected_durations,
+    longest_first,
+    read_run_stats,
+    scheme_record,
+)
+from download_schemes.scheduler import plan_with_host_limits, run_with_host_limits
+from download_schemes.sharding import merge_schemes_files, parse_shard, select_shard
 
 app = typer.Typer(pretty_exceptions_show_locals=False, pretty_exceptions_short=False)
 
@@ -21,8 +41,93 @@ def setup_logging(log_level: str):
     logging.debug(f"Logging set up {logging.getLevelName(logging.getLogger().level)}")
 
 
-@app.command()
+def validate_shard(shard: str | None) -> str | None:
+    if shard is not None:
+        try:
+            parse_shard(shard)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    return shard
+
+
+def validate_size(size: str | None) -> str | None:
+    if size is not None:
+        try:
+            memory.parse_size(size)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    return size
+
+
+# Options shared by the main command and `watch`, so that both write schemes the same way.
+StagesOption = Annotated[
+    Optional[list[str]],
+    typer.Option(
+        "--stage",
+        help=f"Optional processing stage to run for each scheme ({', '.join(STAGES)}). Can be repeated.",
+    ),
+]
+OutputFormatOption = Annotated[
+    str,
+    typer.Option(
+        "--output-format",
+        help="Write alleles as one `<locus>.fa.gz` file per locus ('files'), a single indexed "
+        "archive per scheme ('archive') or both ('both').",
+        case_sensitive=False,
+    ),
+]
+MaxMemoryOption = Annotated[
+    Optional[str],
+    typer.Option(
+        "--max-memory",
+        help="Memory budget for downloaded files held in memory across all jobs (e.g. '1G'). Downloads wait "
+        "for room when it is nearly used, and large files are spooled to disk instead.",
+        callback=validate_size,
+    ),
+]
+DeduplicateAllelesOption = Annotated[
+    bool,
+    typer.Option(
+        "--deduplicate-alleles",
+        help="Leave out alleles whose sequence repeats another allele of the same locus. The duplicate IDs "
+        "are listed under `duplicate_alleles` in each scheme's metadata.json.",
+    ),
+]
+CanonicalOrderOption = Annotated[
+    bool,
+    typer.Option(
+        "--canonical-order",
+        help="Write the alleles of each locus in numeric ID order rather than the order the host serves them.",
+    ),
+]
+
+
+def pipeline_options(
+    stages: list[str] | None, output_format: str, deduplicate_alleles: bool, canonical_order: bool
+) -> PipelineOptions:
+    """Check the options that control how each scheme is written, and turn them into `PipelineOptions`."""
+    output_format = output_format.lower()
+    if output_format not in ["files", "archive", "both"]:
+        raise typer.BadParameter(
+            f"Unknown output format '{output_format}'", param_hint="--output-format"
+        )
+    stages = list(stages or [])
+    if output_format != "files" and "archive" not in stages:
+        stages.append("archive")
+    for stage in stages:
+        # Fail on a typo before anything is downloaded.
+        load_stage(stage)
+    return PipelineOptions(
+        stages,
+        locus_files=output_format != "archive",
+        deduplicate=deduplicate_alleles,
+        canonical_order=canonical_order,
+    )
+
+
+@app.callback(invoke_without_command=True)
 def main(
+    ctx: typer.Context,
     only: Annotated[
         Optional[list[str]],
         typer.Option(
@@ -37,7 +142,6 @@ def main(
             "-C",
             "--config-dir",
             help="Path to the config directory containing the `schemes.json` and `host_config.json` files",
-            exists=True,
             file_okay=False,
             dir_okay=True,
         ),
@@ -91,8 +195,87 @@ def main(
             case_sensitive=False,
         ),
     ] = "INFO",
+    stages: StagesOption = None,
+    output_format: OutputFormatOption = "files",
+    jobs: Annotated[
+        int,
+        typer.Option(
+            "-j",
+            "--jobs",
+            help="Number of schemes to download at the same time. Downloads from each host are "
+            "further limited to stay polite.",
+        ),
+    ] = 1,
+    shard: Annotated[
+        Optional[str],
+        typer.Option(
+            "--shard",
+            help="Only download shard i of N (e.g. '2/4'). Schemes are split deterministically, balancing the "
+            "estimated duration of each scheme (see --shard-costs).",
+            callback=validate_shard,
+        ),
+    ] = None,
+    shard_costs_file: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--shard-costs",
+            help="Run stats file shared by every node (e.g. all the nodes' run stats from the previous release, "
+            "concatenated), used to balance the shards. Without it, schemes are balanced by type alone.",
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = None,
+    run_stats_file: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--run-stats",
+            help="File recording how long each scheme took to download. Each run appends to it, and the "
+            "longest schemes are started first. (default: run_stats.jsonl in the output directory)",
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = None,
+    results_file: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--results-file",
+            help="JSON lines file that each scheme's result is appended to as soon as it finishes "
+            "(default: the name of the output schemes file with a .jsonl suffix, in the output directory)",
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = None,
+    mirror: Annotated[
+        Optional[str],
+        typer.Option(
+            "--mirror",
+            help="Copy the schemes from another node running `download_schemes serve` (e.g. "
+            "'http://build-1:8000') instead of from their hosts. Only changed files are transferred.",
+        ),
+    ] = None,
+    max_memory: MaxMemoryOption = None,
+    deduplicate_alleles: DeduplicateAllelesOption = False,
+    canonical_order: CanonicalOrderOption = False,
+    plan: Annotated[
+        bool,
+        typer.Option(
+            "--plan",
+            help="Print the predicted download order and finish time, without downloading anything.",
+        ),
+    ] = False,
 ) -> None:
+    """Download the typing schemes into the output directory."""
+    if ctx.invoked_subcommand is not None:
+        return
+    startup_seconds = time.monotonic() - imported_at
+    # Checked here rather than by typer so that subcommands do not need a config directory.
+    if not config_dir.is_dir():
+        raise typer.BadParameter(
+            f"Directory '{config_dir}' does not exist.", param_hint="'-C' / '--config-dir'"
+        )
     setup_logging(log_level)
+    options = pipeline_options(stages, output_format, deduplicate_alleles, canonical_order)
 
     schemes_file = config_dir / "schemes.json"
 
@@ -108,6 +291,22 @@ def main(
             if any(wanted_scheme == scheme["shortname"] for wanted_scheme in only)
         ]
 
+    if shard:
+        schemes = select_shard(schemes, shard, shard_costs_file)
+        logging.info(
+            f"Shard {shard}: {', '.join(scheme['shortname'] for scheme in schemes)}"
+        )
+
+    # Kept with the output rather than in the working directory, which for the Docker build is the image root.
+    if run_stats_file is None:
+        run_stats_file = output_dir / "run_stats.jsonl"
+    if plan:
+        print_plan(schemes, read_run_stats(run_stats_file), jobs)
+        return
+
+    if max_memory is not None:
+        memory.set_memory_limit(memory.parse_size(max_memory))
+
     keycache = KeyCache(
         secrets_file=secrets_file,
         host_config_file=config_dir / "host_config.json",
@@ -115,17 +314,406 @@ def main(
     )
     logging.debug(f"Keycache: {keycache}")
     logging.info(f"Downloading {len(schemes)} schemes")
-    download_schemes(output_dir, schemes, keycache, output_schemes_file)
+    download_schemes(
+        output_dir,
+        schemes,
+        keycache,
+        output_schemes_file,
+        options,
+        jobs,
+        run_stats_file,
+        results_file,
+        mirror,
+        startup_seconds,
+    )
+
+
+def print_plan(
+    schemes: list[dict[str, Any]],
+    history: dict[str, list[dict[str, Any]]],
+    jobs: int,
+) -> None:
+    durations = expected_durations(schemes, history)
+    schedule = plan_with_host_limits(
+        longest_first(schemes, durations),
+        lambda s: s.get("host"),
+        lambda s: durations[s["shortname"]],
+        jobs,
+    )
+    print("start\texpected\thost\tscheme")
+    for scheme, start, end in schedule:
+        note = "" if scheme["shortname"] in history else "\t(no previous runs)"
+        print(
+            f"{timedelta(seconds=round(start))}\t{timedelta(seconds=round(end - start))}\t"
+            f"{scheme.get('host')}\t{scheme['shortname']}{note}"
+        )
+    total = max((end for _, _, end in schedule), default=0.0)
+    finish = datetime.now() + timedelta(seconds=total)
+    print(
+        f"Estimated total time {timedelta(seconds=round(total))} with {jobs} jobs, "
+        f"finishing around {finish:%Y-%m-%d %H:%M}"
+    )
+
+
+@app.command()
+def verify(
+    output_dir: Annotated[
+        Path,
+        typer.Argument(
+            help="Output directory of a completed run",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ],
+    schemes_file: Annotated[
+        Optional[Path],
+        typer.Option(
+            "-f",
+            "--schemes-file",
+            help="The `selected_schemes.json` written by the run. Without it, every scheme directory found in "
+            "the output directory is checked.",
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = None,
+    workers: Annotated[
+        Optional[int],
+        typer.Option(
+            "-j",
+            "--workers",
+            help="Number of processes to check allele files with (default: one per CPU)",
+        ),
+    ] = None,
+    log_level: Annotated[
+        str,
+        typer.Option(
+            "-l",
+            "--log-level",
+            help="Set the logging level",
+            case_sensitive=False,
+        ),
+    ] = "INFO",
+) -> None:
+    """Check the integrity of a completed output directory."""
+    from download_schemes.verify import verify_output
+
+    setup_logging(log_level)
+    problems = verify_output(output_dir, schemes_file, workers)
+    for problem in problems:
+        logging.error(problem)
+    if problems:
+        logging.error(f"Found {len(problems)} problems in {output_dir}")
+        raise typer.Exit(code=1)
+    logging.info(f"No problems found in {output_dir}")
+
+
+@app.command()
+def serve(
+    output_dir: Annotated[
+        Path,
+        typer.Argument(
+            help="Output directory of a completed run",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ],
+    schemes_file: Annotated[
+        Path,
+        typer.Option(
+            "-f",
+            "--schemes-file",
+            help="The `selected_schemes.json` written by the run, served as /selected_schemes.json",
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = Path("selected_schemes.json"),
+    bind: Annotated[
+        str,
+        typer.Option("--bind", help="Address to listen on"),
+    ] = "0.0.0.0",
+    port: Annotated[
+        int,
+        typer.Option("-p", "--port", help="Port to listen on"),
+    ] = 8000,
+    log_level: Annotated[
+        str,
+        typer.Option(
+            "-l",
+            "--log-level",
+            help="Set the logging level",
+            case_sensitive=False,
+        ),
+    ] = "INFO",
+) -> None:
+    """Serve a completed output directory over HTTP for other nodes to mirror with `--mirror`."""
+    from download_schemes.serve import serve_output
+
+    setup_logging(log_level)
+    serve_output(output_dir, schemes_file, bind, port)
+
+
+@app.command()
+def watch(
+    only: Annotated[
+        Optional[list[str]],
+        typer.Option(
+            "-S",
+            "--scheme",
+            help="Filter schemes by 'shortname'.",
+        ),
+    ] = None,
+    config_dir: Annotated[
+        Path,
+        typer.Option(
+            "-C",
+            "--config-dir",
+            help="Path to the config directory containing the `schemes.json` and `host_config.json` files",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = Path("config"),
+    secrets_file: Annotated[
+        Path,
+        typer.Option(
+            "-s",
+            "--secrets-file",
+            help="Path to the secrets file containing (at least) the user credentials and consumer key+secret",
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = Path("secrets.json"),
+    secrets_cache_file: Annotated[
+        Path,
+        typer.Option(
+            "-c",
+            "--secrets-cache-file",
+            help="Path to the secrets cache file (default: secrets_cache.json)",
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = Path("secrets_cache.json"),
+    output_dir: Annotated[
+        Path,
+        typer.Option(
+            "-o",
+            "--output-dir",
+            help="Path to the output directory to keep up to date",
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = Path("."),
+    output_schemes_file: Annotated[
+        Path,
+        typer.Option(
+            "-f",
+            "--output-schemes-file",
+            help="Path to the output schemes.json file, rewritten after each refresh",
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = Path("selected_schemes.json"),
+    interval: Annotated[
+        float,
+        typer.Option(
+            "--interval",
+            help="Seconds between checks of each scheme for changes",
+        ),
+    ] = 6 * 60 * 60,
+    jitter: Annotated[
+        float,
+        typer.Option(
+            "--jitter",
+            help="Vary each interval randomly by up to this fraction of it",
+        ),
+    ] = 0.1,
+    jobs: Annotated[
+        int,
+        typer.Option(
+            "-j",
+            "--jobs",
+            help="Number of schemes to check or download at the same time, within the per-host limits",
+        ),
+    ] = 1,
+    stages: StagesOption = None,
+    output_format: OutputFormatOption = "files",
+    max_memory: MaxMemoryOption = None,
+    deduplicate_alleles: DeduplicateAllelesOption = False,
+    canonical_order: CanonicalOrderOption = False,
+    once: Annotated[
+        bool,
+        typer.Option(
+            "--once",
+            help="Check every scheme once, refresh the changed ones and exit",
+        ),
+    ] = False,
+    log_level: Annotated[
+        str,
+        typer.Option(
+            "-l",
+            "--log-level",
+            help="Set the logging level",
+            case_sensitive=False,
+        ),
+    ] = "INFO",
+) -> None:
+    """Keep an output directory up to date, refreshing schemes as their hosts update them.
+
+    Changed schemes are downloaded into a staging directory, verified, and swapped into the output directory
+    atomically, so readers never see a partly written scheme.
+    """
+    from download_schemes.watch import watch_schemes
+
+    setup_logging(log_level)
+    options = pipeline_options(stages, output_format, deduplicate_alleles, canonical_order)
+    if max_memory is not None:
+        memory.set_memory_limit(memory.parse_size(max_memory))
+    with open(config_dir / "schemes.json", "r") as f:
+        schemes = json.load(f)["schemes"]
+    if only:
+        schemes = [scheme for scheme in schemes if scheme["shortname"] in only]
+    keycache = KeyCache(
+        secrets_file=secrets_file,
+        host_config_file=config_dir / "host_config.json",
+        cache_file=secrets_cache_file,
+    )
+    logging.info(f"Watching {len(schemes)} schemes in {output_dir}")
+    try:
+        watch_schemes(
+            output_dir,
+            schemes,
+            keycache,
+            output_schemes_file,
+            options,
+            interval,
+            jitter,
+            jobs,
+            once,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+@app.command()
+def diff(
+    old_dir: Annotated[
+        Path,
+        typer.Argument(
+            help="Output directory of the earlier build",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ],
+    new_dir: Annotated[
+        Path,
+        typer.Argument(
+            help="Output directory of the later build",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ],
+) -> None:
+    """List the files that changed between two builds, using only their manifests.
+
+    Prints one tab-delimited line per added (A), deleted (D) or modified (M) file.
+    """
+    from download_schemes.manifest import diff_trees
+
+    for status, path, details in diff_trees(old_dir, new_dir):
+        print(f"{status}\t{path}\t{details}")
+
+
+@app.command()
+def shard(
+    shard: Annotated[
+        str,
+        typer.Argument(
+            help="The shard to list, as i/N (e.g. '2/4')", callback=validate_shard
+        ),
+    ],
+    only: Annotated[
+        Optional[list[str]],
+        typer.Option(
+            "-S",
+            "--scheme",
+            help="Only split these schemes, by 'shortname'.",
+        ),
+    ] = None,
+    config_dir: Annotated[
+        Path,
+        typer.Option(
+            "-C",
+            "--config-dir",
+            help="Path to the config directory containing the `schemes.json` file",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = Path("config"),
+    shard_costs_file: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--shard-costs",
+            help="Run stats file shared by every node (e.g. all the nodes' run stats from the previous release, "
+            "concatenated), used to balance the shards. Without it, schemes are balanced by type alone.",
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = None,
+) -> None:
+    """Print the short names of the schemes in a shard, one per line."""
+    with open(config_dir / "schemes.json", "r") as f:
+        schemes = json.load(f)["schemes"]
+    if only:
+        schemes = [scheme for scheme in schemes if scheme["shortname"] in only]
+    for scheme in select_shard(schemes, shard, shard_costs_file):
+        print(scheme["shortname"])
+
+
+@app.command()
+def merge(
+    schemes_files: Annotated[
+        list[Path],
+        typer.Argument(
+            help="The `selected_schemes.json` files written by each shard",
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ],
+    output_schemes_file: Annotated[
+        Path,
+        typer.Option(
+            "-f",
+            "--output-schemes-file",
+            help="Path to write the combined schemes file to",
+            file_okay=True,
+            dir_okay=False,
+        ),
+    ] = Path("selected_schemes.json"),
+) -> None:
+    """Combine the schemes files from a sharded run."""
+    merged = merge_schemes_files(schemes_files)
+    with open(output_schemes_file, "w") as f_out:
+        json.dump(merged, f_out)
 
 
 def download_scheme(
     metadata: dict[str, Any],
     output_dir: Path,
     keycache: KeyCache,
+    options: PipelineOptions = None,
 ) -> tuple[str, str]:
-    downloader = downloaders.initialise(metadata, keycache)
+    downloader = registry.initialise(metadata, keycache)
     logging.debug("Downloader initialised.")
-    download_path, timestamp = downloader.download(output_dir)
+    download_path, timestamp = downloader.download(output_dir, options)
     logging.debug(f"Downloaded {metadata['shortname']} to {download_path}")
     return str(download_path), timestamp
 
@@ -135,28 +723,94 @@ def download_schemes(
     schemes: list[dict[str, Any]],
     keycache: KeyCache,
     output_schemes_file: Path = None,
+    options: PipelineOptions = None,
+    jobs: int = 1,
+    run_stats_file: Path = None,
+    results_file: Path = None,
+    mirror: str = None,
+    startup_seconds: float = None,
 ):
+    output_schemes_file = Path(output_schemes_file)
+    if results_file is None:
+        results_file = output_dir / output_schemes_file.with_suffix(".jsonl").name
     host_names = {"pubmlst": "PubMLST", "pasteur": "Pasteur"}
     output_dir.mkdir(parents=True, exist_ok=True)
+    auth_databases: dict[str, str] = {}
+    # Copying from a mirror needs no credentials for the original hosts.
     for scheme in schemes:
-        logging.info(f"Downloading {scheme['shortname']}")
-        host = scheme.get("host")
-        if host in host_names and not keycache.can_authenticate(host):
+        host = None if mirror is not None else scheme.get("host")
+        if host in host_names and keycache.can_authenticate(host):
+            auth_databases.setdefault(host, bigsdb_database(scheme["host_path"]))
+        elif host in host_names:
             logging.warning(
                 f"Downloading {scheme['shortname']} from {host_names[host]} without "
                 "authentication. This scheme will only include public, "
                 "redistributable records."
             )
-        try:
-            download_path, timestamp = download_scheme(scheme, output_dir, keycache)
-            scheme["db_path"] = download_path
-            scheme["last_updated"] = timestamp
-        except Exception as e:
-            logging.error(f"Error downloading {scheme['shortname']}: {str(e)}")
-            raise e
-    with open(output_schemes_file, "w") as f_out:
-        json.dump({"schemes": schemes}, f_out)
-        logging.debug(json.dumps({"schemes": schemes}))
+
+    if auth_databases:
+        # Authenticate with every host at once, rather than each host's first scheme paying for it in turn.
+        start = time.monotonic()
+        for host, seconds in keycache.warm_up(auth_databases).items():
+            logging.info(f"Authenticated with {host_names[host]} in {seconds:.1f}s")
+        logging.info(f"Authentication took {time.monotonic() - start:.1f}s")
+
+    started: dict[str, float] = {}
+
+    def download_task(scheme: dict[str, Any]) -> tuple[str, str, float]:
+        logging.info(f"Downloading {scheme['shortname']}")
+        started[scheme["shortname"]] = time.monotonic()
+        if mirror is not None:
+            # Download a copy of the record, so that the schemes file keeps the original host.
+            scheme = scheme | {"host": "mirror", "mirror_url": mirror}
+        download_path, timestamp = download_scheme(scheme, output_dir, keycache, options)
+        return download_path, timestamp, time.monotonic() - started[scheme["shortname"]]
+
+    # Start the schemes expected to take longest first, so that a big scheme does not run on alone at the end.
+    # The schemes file keeps the config file order.
+    durations = expected_durations(schemes, read_run_stats(run_stats_file))
+    error = None
+    run_start = time.monotonic()
+    completed = 0
+    # Each scheme is recorded as soon as it finishes, so that progress can be followed and nothing is lost on a
+    # crash. The schemes file is then built from these records once every scheme has been downloaded.
+    with ResultsStream(results_file) as results:
+        for scheme, result in run_with_host_limits(
+            longest_first(schemes, durations),
+            lambda s: "mirror" if mirror is not None else s.get("host"),
+            download_task,
+            jobs,
+        ):
+            try:
+                download_path, timestamp, seconds = result.result()
+                scheme["db_path"] = download_path
+                scheme["last_updated"] = timestamp
+                size = directory_size(output_dir / download_path)
+                results.write(scheme_result(scheme, "ok", seconds, size))
+                completed += 1
+                if run_stats_file is not None:
+                    append_run_stats(
+                        run_stats_file, scheme_record(scheme["shortname"], seconds, size)
+                    )
+            except Exception as e:
+                logging.error(f"Error downloading {scheme['shortname']}: {str(e)}")
+                error = error or e
+                seconds = time.monotonic() - started.get(scheme["shortname"], time.monotonic())
+                results.write(scheme_result(scheme, "failed", seconds, error=str(e)))
+    # Start-up and downloader imports are paid again by every container build.py starts, so they are reported too.
+    imports = f"downloader imports {sum(registry.load_seconds.values()):.2f}s"
+    if startup_seconds is not None:
+        imports = f"start-up {startup_seconds:.2f}s, {imports}"
+    logging.info(
+        f"Downloaded {completed} of {len(schemes)} schemes in {time.monotonic() - run_start:.1f}s ({imports}): "
+        f"{memory.budget.summary()}"
+    )
+    if error is not None:
+        logging.error(f"Not writing {output_schemes_file}. The completed schemes are listed in {results_file}")
+        raise error
+    write_schemes_file(
+        output_schemes_file, schemes_from_results(read_results(results_file), schemes)
+    )
 
 
 def read_access_keys(key_file: Path) -> dict[str, tuple[str, str]]:
@@ -7,30 +7,42 @@ import os
 import shutil
 import socket
 import ssl
+import tempfile
+import urllib.parse
 import urllib.request
 import uuid
 import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from pathlib import Path
-from typing import Any, Callable, IO, Iterable
+from typing import IO, TYPE_CHECKING, Any, Callable, Iterable
 
-import requests
-from openpyxl import load_workbook
-from rauth import OAuth1Session
 from tenacity import (
     retry,
     stop_after_attempt,
+    stop_after_delay,
     wait_exponential,
 )
 
-from download_schemes.keycache import KeyCache
-from download_schemes.normalise_alleles import normalise_fasta
+from download_schemes import memory
+from download_schemes.keycache import KeyCache, bigsdb_database
+from download_schemes.pipeline import PipelineOptions, SchemeWriter
+from download_schemes.profiles import CHUNK_SIZE, iter_chunks, write_profiles
+from download_schemes.serve import SCHEMES_PATH, file_etag
+
+# Only the BIGSdb downloader uses requests and rauth, and only NG-STAR uses openpyxl, so they are imported where they
+# are used rather than here.
+if TYPE_CHECKING:
+    import requests
 
 
 def oauth_fetch(
-    host: str, keycache: KeyCache, database: str, url: str
-) -> requests.Response:
+    host: str, keycache: KeyCache, database: str, url: str, stream: bool = False
+) -> "requests.Response":
+    from rauth import OAuth1Session
+
     logging.debug(f"Fetching data from authenticated {host} - {database}...")
     consumer_key = keycache.get_consumer_key(host)
     session_key = keycache.get_session_key(host, database)
@@ -40,13 +52,13 @@ def oauth_fetch(
         access_token=session_key[0],
         access_token_secret=session_key[1],
     )
-    response = session.get(url)
+    response = session.get(url, stream=stream)
     if response.status_code == 301 or response.status_code == 401:
         logging.error(
             f"Session access denied. Attempting to regenerate keys as needed for {host}"
         )
         keycache.delete_key("session", host)
-        response = oauth_fetch(host, keycache, database, url)
+        response = oauth_fetch(host, keycache, database, url, stream)
     else:
         response.raise_for_status()
     return response
@@ -55,10 +67,14 @@ def oauth_fetch(
 @retry(
     stop=stop_after_attempt(10), wait=wait_exponential(multiplier=1, min=1, max=1200)
 )
-def retry_fetch(url: str, headers: dict[str, str] = None) -> requests.Response:
+def retry_fetch(
+    url: str, headers: dict[str, str] = None, stream: bool = False
+) -> "requests.Response":
+    import requests
+
     if headers is None:
         headers = {}
-    r = requests.get(url, headers=headers)
+    r = requests.get(url, headers=headers, stream=stream)
     if r.status_code != 200:
         logging.error(f"Failed to fetch {url}: {r.status_code}")
         r.raise_for_status()
@@ -91,6 +107,19 @@ def download(url, timeout=10) -> urllib.request.urlopen:
     return r
 
 
+def content_length(response: "requests.Response") -> int | None:
+    """The expected body size, if the server declared one for the body as delivered."""
+    if "Content-Encoding" in response.headers or "Content-Length" not in response.headers:
+        # requests transparently decodes compressed bodies, so the declared length no longer applies.
+        return None
+    return int(response.headers["Content-Length"])
+
+
+def enterobase_page_url(url: str, filters: dict[str, str], limit: int, offset: int) -> str:
+    query = filters | {"limit": str(limit), "offset": str(offset)}
+    return f"{url}?{urllib.parse.urlencode(query)}"
+
+
 def enterobase_api_download(
     url: str,
     api_key: str,
@@ -98,32 +127,71 @@ def enterobase_api_download(
     offset: int = 0,
     limit: int = 10000,
     safety_valve: int = 1000000,
+    window: int = 4,
+    progress_file: Path = None,
 ) -> Iterable[dict[str, Any]]:
+    """Page through an Enterobase API endpoint, yielding each page of results in order.
+
+    The first page gives the total number of records. The remaining pages are then requested up to `window` at a
+    time, while earlier pages are being consumed. If `progress_file` is given, the offset of the next page is saved
+    to it once the caller has finished with each page. A later call with the same file starts from there instead of
+    from `offset`. The file is removed once the last page has been consumed, so the next full pull starts afresh.
+    """
     if filters is None:
         filters = {}
-    combined_filters = "&".join(
-        [
-            f"{field[0]}={field[1]}"
-            for field in (
-                filters | {"limit": str(limit), "offset": str(offset)}
-            ).items()
-        ]
-    )
-    while offset < safety_valve:
-        r = retry_fetch(
-            f"{url}?{combined_filters}",
-            {"Authorization": f"Basic {api_key}"},
-        )
-        json_r = r.json()
-        if r.json() is None:
-            break
-        offset += limit
-        logging.debug(
-            f"{datetime.now()},{offset},{json_r['links']['total____records']}"
-        )
-        yield json_r
-        if json_r["links"]["total____records"] < offset:
-            break
+    if progress_file is not None and progress_file.exists():
+        offset = int(progress_file.read_text().strip())
+        logging.info(f"Resuming {url} from offset {offset}")
+    headers = {"Authorization": f"Basic {api_key}"}
+
+    def fetch_page(page_offset: int) -> dict[str, Any] | None:
+        return retry_fetch(enterobase_page_url(url, filters, limit, page_offset), headers).json()
+
+    def completed(next_offset: int) -> None:
+        if progress_file is not None:
+            partial_file = progress_file.with_name(f"{progress_file.name}.partial")
+            partial_file.write_text(f"{next_offset}\n")
+            os.replace(partial_file, progress_file)
+
+    def finished() -> None:
+        if progress_file is not None:
+            progress_file.unlink(missing_ok=True)
+
+    if offset >= safety_valve:
+        finished()
+        return
+    first_page = fetch_page(offset)
+    if first_page is None:
+        finished()
+        return
+    total = first_page["links"]["total____records"]
+    logging.debug(f"{datetime.now()},{offset},{total}")
+    yield first_page
+    completed(offset + limit)
+
+    remaining = iter(range(offset + limit, min(total, safety_valve), limit))
+    with ThreadPoolExecutor(max_workers=max(1, window)) as executor:
+        pages: deque[tuple[int, Future]] = deque()
+        try:
+            while True:
+                while len(pages) < max(1, window):
+                    page_offset = next(remaining, None)
+                    if page_offset is None:
+                        break
+                    pages.append((page_offset, executor.submit(fetch_page, page_offset)))
+                if not pages:
+                    break
+                page_offset, fetched = pages.popleft()
+                page = fetched.result()
+                if page is None:
+                    break
+                logging.debug(f"{datetime.now()},{page_offset + limit},{total}")
+                yield page
+                completed(page_offset + limit)
+        finally:
+            for _, fetched in pages:
+                fetched.cancel()
+    finished()
 
 
 @dataclasses.dataclass
@@ -136,56 +204,72 @@ class PubmlstDownloader:
     authenticate: bool = True
 
     def __post_init__(self):
-        self.database = (
-            f"{self.host_path.replace('pubmlst_', '').replace('_seqdef','')}"
-        )
+        self.database = bigsdb_database(self.host_path)
         self.name = f"{self.host_path.replace('_seqdef','')}_{self.scheme_id}"
         self.base_url = f"{self.keycache.get_rest_url(self.host)}/{self.host_path}"
         self.scheme_url = f"{self.base_url}/schemes/{self.scheme_id}"
         self.loci_url = f"{self.scheme_url}/loci"
         self.alleles_url = f"{self.base_url}/loci"
         if self.authenticate:
-            self.__fetch: Callable[[str], requests.Response] = partial(
+            self.__fetch: Callable[[str], "requests.Response"] = partial(
                 oauth_fetch, self.host, self.keycache, self.database
             )
         else:
             self.__fetch = retry_fetch
 
-    def download_loci(self) -> list[str]:
-        logging.debug(f"Downloading loci for {self.name}...")
-        r = self.__fetch(self.loci_url)
-        loci: list[str] = []
-        stem = f"{self.alleles_url}/"
-        for locus in json.loads(r.text)["loci"]:
-            loci.append(locus.replace(stem, ""))
-        return loci
-
-    def download_profiles(self, out_dir: Path):
-        response = self.__fetch(f"{self.scheme_url}/profiles_csv")
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, Any], keycache: KeyCache = None) -> "PubmlstDownloader":
+        return cls(
+            metadata["host"],
+            metadata["host_path"],
+            metadata["scheme_id"],
+            metadata["type"],
+            keycache=keycache,
+            authenticate=keycache.can_authenticate(metadata["host"]),
+        )
 
-        if response.status_code == 200:
-            with open(out_dir / "profiles.tsv", "wb") as out_file:
-                out_file.write(response.content)
-        else:
-            raise Exception(
-                f"Failed to download profiles: HTTP status {response.status_code}"
-            )
+    def parse_loci(self, loci_json: str) -> list[str]:
+        stem = f"{self.alleles_url}/"
+        return [locus.replace(stem, "") for locus in json.loads(loci_json)["loci"]]
 
-    def fetch_timestamp(self):
-        logging.debug(f"Fetching timestamp for {self.name}...")
-        url = self.scheme_url
-        r = self.__fetch(url)
-        scheme_metadata = json.loads(r.text)
+    @staticmethod
+    def parse_timestamp(scheme_json: str) -> str:
+        scheme_metadata = json.loads(scheme_json)
         return (
             scheme_metadata["last_updated"]
             if "last_updated" in scheme_metadata
             else datetime.today().strftime("%Y-%m-%d")
         )
 
-    def download(self, out_dir: Path) -> tuple[Path, str]:
+    def download_loci(self) -> list[str]:
+        logging.debug(f"Downloading loci for {self.name}...")
+        r = self.__fetch(self.loci_url)
+        return self.parse_loci(r.text)
+
+    def download_profiles(self, out_dir: Path) -> dict[str, Any]:
+        response = self.__fetch(f"{self.scheme_url}/profiles_csv", stream=True)
+
+        with response:
+            if response.status_code != 200:
+                raise Exception(
+                    f"Failed to download profiles: HTTP status {response.status_code}"
+                )
+            return write_profiles(
+                response.iter_content(CHUNK_SIZE),
+                out_dir / "profiles.tsv",
+                content_length(response),
+            )
+
+    def fetch_timestamp(self):
+        logging.debug(f"Fetching timestamp for {self.name}...")
+        r = self.__fetch(self.scheme_url)
+        return PubmlstDownloader.parse_timestamp(r.text)
+
+    def download(self, out_dir: Path, options: PipelineOptions = None) -> tuple[Path, str]:
         scheme_subdir = Path(f"{self.type}_schemes") / f"{self.name}"
         scheme_dir: Path = out_dir / scheme_subdir
         scheme_dir.mkdir(parents=True, exist_ok=True)
+        writer = SchemeWriter(scheme_dir, self.type, options)
         scheme_metadata = {"last_updated": self.fetch_timestamp(), "genes": []}
 
         logging.debug(f"Downloading alleles for {self.name} from {self.host}")
@@ -196,19 +280,17 @@ class PubmlstDownloader:
             # PubMLST puts an apostrophe in front of RNA genes.
             clean_locus = locus.replace("'", "")
             scheme_metadata["genes"].append(clean_locus)
-            allele_file = Path(f"{scheme_dir}/{clean_locus}.fa.gz")
-            # Remove any existing file to deal with failed downloads.
-            allele_file.unlink(missing_ok=True)
-            with gzip.open(allele_file, "wt") as out_f:
-                response = self.__fetch(alleles_url)
-                normalise_fasta(response.text, out_f)
+            response = self.__fetch(alleles_url, stream=True)
+            with response, memory.budget.buffer(
+                response.iter_content(CHUNK_SIZE), content_length(response)
+            ) as payload:
+                writer.write_locus(clean_locus, io.TextIOWrapper(payload, encoding="utf-8"))
 
         if self.type != "cgmlst":
             logging.debug(f"Downloading profiles for {self.name}")
-            self.download_profiles(scheme_dir)
+            scheme_metadata["profiles"] = self.download_profiles(scheme_dir)
         logging.debug(f"Writing metadata for {self.name}")
-        with open(f"{scheme_dir}/metadata.json", "w") as out_f:
-            json.dump(scheme_metadata, out_f, indent=4)
+        writer.close(scheme_metadata)
         return scheme_subdir, scheme_metadata["last_updated"]
 
 
@@ -223,6 +305,10 @@ class EnterobaseFtpDownloader:
         self.name = f"enterobase_{self.scheme_id}"
         self.profiles_url = f"{self.scheme_url}/profiles.list.gz"
 
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, Any], keycache: KeyCache = None) -> "EnterobaseFtpDownloader":
+        return cls(metadata["scheme_id"], metadata["type"])
+
     def download_loci_list(self) -> list[str]:
         r = download(self.profiles_url)
         rz = gzip.GzipFile(fileobj=r)
@@ -234,32 +320,29 @@ class EnterobaseFtpDownloader:
             raise Exception(f"Unable to download the list of loci for {self.scheme_id}")
         return loci
 
-    def download_profiles(self, out_dir: Path):
+    def download_profiles(self, out_dir: Path) -> dict[str, Any]:
         r = download(self.profiles_url)
-        rz = gzip.GzipFile(fileobj=r)
-        with open(out_dir / "profiles.tsv", "wb") as out_file:
-            shutil.copyfileobj(rz, out_file)
+        # The gzip trailer carries its own CRC and length, so a truncated stream raises while reading.
+        with gzip.GzipFile(fileobj=r) as rz:
+            return write_profiles(iter_chunks(rz), out_dir / "profiles.tsv")
 
-    def download_alleles(self, loci: list[str], out_dir: Path):
+    def download_alleles(self, loci: list[str], writer: SchemeWriter):
         for locus in loci:
             url = f"{self.scheme_url}/{locus}.fasta.gz"
             r = download(url)
 
-            # Create a file-like object from the response content
-            gzip_file = io.BytesIO(r.read())
-
-            # Open the gzip file and read its content
-            with gzip.open(gzip_file, "rt") as gz_content, gzip.open(
-                f"{out_dir}/{locus}.fa.gz", "wt"
-            ) as out_f:
-                normalise_fasta(gz_content.read(), out_f)
+            # The compressed file is held in memory (or spooled to disk) within the memory budget, and decompressed
+            # as it is normalised.
+            with memory.budget.buffer(iter_chunks(r), r.length) as payload:
+                with gzip.open(payload, "rt") as gz_content:
+                    writer.write_locus(locus, gz_content)
 
             logging.debug(f"Downloaded and normalized alleles for {locus}")
 
-    def fetch_timestamp(self):
-        r = download(self.scheme_url)
+    def parse_timestamp(self, listing: Iterable[bytes]) -> str:
+        """Take the date of the first allele file in the scheme's directory listing."""
         date = None
-        for line in r:
+        for line in listing:
             if ".fasta.gz" in line.decode("utf-8"):
                 date = line.decode("utf-8").strip().split()[2]
                 break
@@ -267,18 +350,21 @@ class EnterobaseFtpDownloader:
             raise Exception(f"Unable to download the timestamp for {self.scheme_id}")
         return datetime.strptime(date, "%d-%b-%Y").strftime("%Y-%m-%d")
 
-    def download(self, out_dir: Path) -> tuple[Path, str]:
+    def fetch_timestamp(self):
+        return self.parse_timestamp(download(self.scheme_url))
+
+    def download(self, out_dir: Path, options: PipelineOptions = None) -> tuple[Path, str]:
         scheme_subdir = Path(f"{self.type}_schemes") / self.name
         scheme_dir = out_dir / scheme_subdir
         scheme_dir.mkdir(parents=True, exist_ok=True)
+        writer = SchemeWriter(scheme_dir, self.type, options)
         logging.info(f"Downloading alleles for {self.scheme_id} to {scheme_dir}")
         loci = self.download_loci_list()
         metadata = {"last_updated": self.fetch_timestamp(), "genes": loci}
-        self.download_alleles(loci, scheme_dir)
+        self.download_alleles(loci, writer)
         if self.type != "cgmlst":
-            self.download_profiles(scheme_dir)
-        with open(f"{scheme_dir}/metadata.json", "w") as out_f:
-            json.dump(metadata, out_f, indent=4)
+            metadata["profiles"] = self.download_profiles(scheme_dir)
+        writer.close(metadata)
         return scheme_subdir, metadata["last_updated"]
 
 
@@ -294,72 +380,74 @@ class RidomCgmlstDownloader:
         self.alleles_url = f"{self.scheme_url}/alleles"
         self.name = f"ridom_{self.short_name.split('_')[0]}_{self.scheme_id}"
 
-    def fetch_timestamp(self):
-        logging.warning(
-            f"Unable to fetch timestamp for Ridom schemes: {self.short_name}"
-        )
-        return datetime.now().strftime("%Y-%m-%d")
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, Any], keycache: KeyCache = None) -> "RidomCgmlstDownloader":
+        return cls(metadata["scheme_id"], metadata["shortname"])
+
+    @staticmethod
+    def member_date(info: zipfile.ZipInfo) -> str:
+        year, month, day = info.date_time[:3]
+        return f"{year:04d}-{month:02d}-{day:02d}"
 
-    def download(self, out_dir: Path):
-        # Download as a zip file
-        alleles_zip_file = "alleles.zip"
-        urllib.request.urlretrieve(self.alleles_url, alleles_zip_file)
+    def download(self, out_dir: Path, options: PipelineOptions = None):
+        # Each download gets its own scratch directory so that schemes can be fetched concurrently.
         temp_dir = Path(f"scratch_{uuid.uuid4()}")
+        temp_dir.mkdir()
+        alleles_zip_file = temp_dir / "alleles.zip"
         scheme_subdir = Path(f"{self.type}_schemes") / self.name
         scheme_dir: Path = out_dir / scheme_subdir
         scheme_dir.mkdir(parents=True, exist_ok=True)
+        writer = SchemeWriter(scheme_dir, self.type, options)
+        # Ridom has no timestamp for the scheme, but the zip records the CRC, size and date of every locus file, so
+        # loci that match the previous build are kept as they are.
+        previous_members = writer.previous_metadata.get("zip_members", {})
 
-        # Extract to a scratch directory
-        with zipfile.ZipFile(alleles_zip_file, "r") as zip_ref:
-            zip_ref.extractall(temp_dir)
-
-        metadata = {"last_updated": self.fetch_timestamp(), "genes": []}
-        # Normalise the files into the correct directory.
-        for fasta_file in temp_dir.glob("*.fasta"):
-            metadata["genes"].append(fasta_file.stem)
-            with gzip.open(f"{scheme_dir}/{fasta_file.stem}.fa.gz", "wt") as out_file:
-                with open(fasta_file, "rt") as in_file:
-                    normalise_fasta(in_file.read(), out_file)
-
-        # Clean up
-        os.unlink(alleles_zip_file)
-        shutil.rmtree(temp_dir)
-        with open(f"{scheme_dir}/metadata.json", "w") as out_f:
-            json.dump(metadata, out_f, indent=4)
-        return scheme_subdir, metadata["last_updated"]
-
+        try:
+            # Download as a zip file
+            urllib.request.urlretrieve(self.alleles_url, alleles_zip_file)
+
+            metadata = {"last_updated": None, "genes": [], "zip_members": {}}
+            changed_dates = []
+            with zipfile.ZipFile(alleles_zip_file, "r") as zip_ref:
+                for info in zip_ref.infolist():
+                    if "/" in info.filename or not info.filename.endswith(".fasta"):
+                        continue
+                    locus = Path(info.filename).stem
+                    member = {
+                        "crc": info.CRC,
+                        "size": info.file_size,
+                        "date": RidomCgmlstDownloader.member_date(info),
+                    }
+                    metadata["genes"].append(locus)
+                    metadata["zip_members"][locus] = member
+                    previous = previous_members.get(locus, {})
+                    if (
+                        previous.get("crc") == member["crc"]
+                        and previous.get("size") == member["size"]
+                        and writer.reuse_locus(locus)
+                    ):
+                        continue
+                    changed_dates.append(member["date"])
+                    # Streamed from the zip on disk, so no locus is ever held in memory whole.
+                    with zip_ref.open(info) as locus_file:
+                        writer.write_locus(locus, io.TextIOWrapper(locus_file, encoding="utf-8"))
+        finally:
+            # Clean up
+            shutil.rmtree(temp_dir)
 
-def initialise(
-    metadata: dict[str, Any],
-    keycache: KeyCache = None,
-) -> Any:
-    if "host" in metadata.keys() and metadata["host"] in ["pubmlst", "pasteur"]:
-        return PubmlstDownloader(
-            metadata["host"],
-            metadata["host_path"],
-            metadata["scheme_id"],
-            metadata["type"],
-            keycache=keycache,
-            authenticate=keycache.can_authenticate(metadata["host"]),
-        )
-    elif "host" in metadata.keys() and metadata["host"] == "enterobase":
-        return EnterobaseFtpDownloader(
-            metadata["scheme_id"],
-            metadata["type"],
-        )
-    elif "host" in metadata.keys() and metadata["host"] == "ridom":
-        return RidomCgmlstDownloader(
-            metadata["scheme_id"],
-            metadata["shortname"],
+        removed = previous_members.keys() - metadata["zip_members"].keys()
+        logging.info(
+            f"{len(changed_dates)} of {len(metadata['genes'])} loci changed and {len(removed)} removed "
+            f"for {self.short_name}"
         )
-    elif "host" in metadata.keys() and metadata["host"] == "ngstar":
-        return NgstarDownloader(
-            metadata["shortname"],
-            metadata["type"],
-        )
-    else:
-        logging.info(f"Skipping {metadata['shortname']}")
-        raise ValueError(f"Unsupported host: {metadata['host']}")
+        if changed_dates:
+            metadata["last_updated"] = max(changed_dates)
+        elif removed or "last_updated" not in writer.previous_metadata:
+            metadata["last_updated"] = datetime.now().strftime("%Y-%m-%d")
+        else:
+            metadata["last_updated"] = writer.previous_metadata["last_updated"]
+        writer.close(metadata)
+        return scheme_subdir, metadata["last_updated"]
 
 
 @dataclasses.dataclass
@@ -367,87 +455,229 @@ class NgstarDownloader:
     short_name: str
     type: str
     genes = ["penA", "mtrR", "porB", "ponA", "gyrA", "parC", "23S"]
+    profiles_url = "https://ngstar.canada.ca/sequence_types/download?lang=en"
+    profiles_timeout = 180
+    # The profiles workbook is a few MB; anything larger than this is spooled to a private temporary file.
+    max_workbook_memory = 64 * 1024 * 1024
+    # `download` retries for up to hours, which is right for the big hosts but not for one small scheme. NG-STAR
+    # requests give up after a few attempts or 10 minutes, whichever comes first.
+    fetch = staticmethod(
+        download.retry_with(
+            stop=stop_after_attempt(3) | stop_after_delay(600),
+            wait=wait_exponential(multiplier=1, min=1, max=30),
+        )
+    )
+
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, Any], keycache: KeyCache = None) -> "NgstarDownloader":
+        return cls(metadata["shortname"], metadata["type"])
 
     @staticmethod
-    def fetch_timestamp():
-        # NGStar does not provide a method to get the last updated date.
-        return datetime.now().strftime("%Y-%m-%d")
+    def fetch_timestamp() -> None:
+        # NGStar does not provide a method to get the last updated date, so it can only be found by downloading.
+        return None
 
-    def download(self, out_dir: Path):
+    def download(self, out_dir: Path, options: PipelineOptions = None):
         scheme_subdir = Path(f"{self.type}_schemes") / self.short_name
         scheme_dir: Path = out_dir / scheme_subdir
         scheme_dir.mkdir(parents=True, exist_ok=True)
-
-        for gene in self.genes:
-            out_file_name = scheme_dir / f"{gene}.fa.gz"
-            with gzip.open(out_file_name, "wt") as out_file:
-                alleles_ids = NgstarDownloader.download_alleles(gene, out_file)
-            logging.debug(f"Downloaded {len(alleles_ids)} alleles for {gene}")
-        with open(scheme_dir / "profiles.tsv", "w") as out_file:
-            NgstarDownloader.download_profiles(alleles_ids, out_file)
+        writer = SchemeWriter(scheme_dir, self.type, options)
+
+        # The workbook is by far the slowest request, so fetch it alongside the alleles rather than after them.
+        with ThreadPoolExecutor(max_workers=len(self.genes) + 1) as executor:
+            workbook = executor.submit(NgstarDownloader.fetch_profiles)
+            fastas = {
+                gene: executor.submit(NgstarDownloader.fetch_alleles, gene)
+                for gene in self.genes
+            }
+            allele_ids: dict[str, set[str]] = {}
+            for gene in self.genes:
+                allele_ids[gene] = set(writer.write_locus(gene, fastas[gene].result()))
+                logging.debug(f"Downloaded {len(allele_ids[gene])} alleles for {gene}")
+            with workbook.result() as profiles_workbook:
+                profiles = NgstarDownloader.download_profiles(
+                    allele_ids, profiles_workbook, scheme_dir / "profiles.tsv"
+                )
         logging.info(f"Downloaded profiles for {self.short_name}")
 
+        # NGStar has no timestamp, so the scheme is dated by the first download that differs from the previous one.
+        previous_files = writer.previous_files
+        unchanged = (
+            "last_updated" in writer.previous_metadata
+            and all(previous_files.get(name) == entry for name, entry in writer.files.items())
+            and previous_files.get(profiles["file"], {}).get("sha256") == profiles["sha256"]
+        )
         # Need to write the metadata and return the scheme directory + last updated date
-        metadata = {"last_updated": NgstarDownloader.fetch_timestamp(), "genes": self.genes}
-        with open(f"{scheme_dir}/metadata.json", "w") as out_f:
-            json.dump(metadata, out_f, indent=4)
+        metadata = {
+            "last_updated": (
+                writer.previous_metadata["last_updated"] if unchanged else datetime.now().strftime("%Y-%m-%d")
+            ),
+            "genes": self.genes,
+            "profiles": profiles,
+        }
+        writer.close(metadata)
 
         return scheme_subdir, metadata["last_updated"]
 
     @staticmethod
-    def download_alleles(gene, out_file: IO[str]):
+    def fetch_alleles(gene) -> str:
         url = f"https://ngstar.canada.ca/alleles/download?lang=en&loci_name={gene}"
         logging.debug(f"Downloading {gene} from {url}.")
-        r = download(url)
+        r = NgstarDownloader.fetch(url)
         fasta = r.read().decode('utf-8')
-        fasta = fasta.replace(f"{gene}_", "")
-        alleles_ids = normalise_fasta(fasta, out_file)
         logging.debug(f"Downloaded alleles for {gene}")
-        return alleles_ids
+        return fasta.replace(f"{gene}_", "")
 
     @staticmethod
-    def download_profiles(allele_names, out_file):
-        input_profiles = download(
-            "https://ngstar.canada.ca/sequence_types/download?lang=en", timeout=180
+    def fetch_profiles() -> IO[bytes]:
+        r = NgstarDownloader.fetch(
+            NgstarDownloader.profiles_url, timeout=NgstarDownloader.profiles_timeout
         )
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=NgstarDownloader.max_workbook_memory
+        )
+        shutil.copyfileobj(r, spool)
+        spool.seek(0)
+        return spool
 
-        rows = NgstarDownloader.parse_profiles(input_profiles)
+    @staticmethod
+    def download_profiles(
+        allele_ids: dict[str, set[str]], profile_file: IO[bytes], out_file: Path
+    ) -> dict[str, Any]:
+        rows = NgstarDownloader.parse_profiles(profile_file)
+        summary = write_profiles(
+            NgstarDownloader.format_profiles(allele_ids, rows), out_file
+        )
+        logging.debug(f"Written profiles for ng_star to {out_file}")
+        return summary
+
+    @staticmethod
+    def format_profiles(allele_ids: dict[str, set[str]], rows) -> Iterable[bytes]:
         header_row = next(rows)
-        print("\t".join(header_row), file=out_file)
+        # A renamed gene would otherwise leave profiles that reference no alleles, so every gene must have a column.
+        # Other columns (e.g. a clonal complex) are copied through as they are.
+        missing = [gene for gene in allele_ids if gene not in header_row]
+        if missing:
+            raise ValueError(f"NG-STAR profiles have no column for genes {missing}")
+        extra = [column for column in header_row if column != "ST" and column not in allele_ids]
+        if extra:
+            logging.warning(f"Copying NG-STAR profile columns that are not genes unchecked: {extra}")
+        yield ("\t".join(header_row) + "\n").encode("utf-8")
         for row in rows:
             out_row = [""]*(len(header_row))
             for i, (column, value) in enumerate(zip(header_row, row)):
                 if column == "ST":
                     out_row[i] = str(int(value))
-                elif column not in allele_names:
-                    out_row[i] = str(value)
-                elif str(value).encode("utf8") in allele_names[column]:
+                elif column not in allele_ids:
                     out_row[i] = str(value)
-                elif str(int(value)).encode("utf8") in allele_names[column]:
-                    out_row[i] = str(int(value))
                 else:
-                    raise ValueError(f"{value} is not recognised for {column}")
-            print("\t".join(out_row), file=out_file)
-        logging.debug(f"Written profiles for ng_star to {out_file}")
+                    out_row[i] = NgstarDownloader.match_allele(
+                        value, allele_ids[column], column
+                    )
+            yield ("\t".join(out_row) + "\n").encode("utf-8")
+
+    @staticmethod
+    def match_allele(value, known_ids: set[str], column: str) -> str:
+        """Map a workbook cell onto an allele ID from the FASTA, e.g. `2.0` -> `2`."""
+        if str(value) in known_ids:
+            return str(value)
+        try:
+            integer_value = str(int(value))
+        except (TypeError, ValueError):
+            integer_value = None
+        if integer_value in known_ids:
+            return integer_value
+        raise ValueError(f"{value} is not recognised for {column}")
 
     @staticmethod
-    def parse_profiles(profile_file):
-        # with tempfile.NamedTemporaryFile("wb", delete=False) as _tmp:
-        with open("tempfile.xlsx", "wb") as fh:
-            shutil.copyfileobj(profile_file, fh)
-            profile_path = fh.name
+    def parse_profiles(profile_file: IO[bytes]):
+        from openpyxl import load_workbook
 
+        workbook = load_workbook(filename=profile_file, read_only=True)
         try:
-            workbook = load_workbook(filename=profile_path, read_only=True)
             sheet = workbook.active
             rows = sheet.iter_rows(values_only=True)
-            
+
             header = next(rows)
             header = list(header)
             header[0] = "ST"
             yield header
-            
+
             for row in rows:
                 yield row
         finally:
-            os.remove(profile_path)
+            workbook.close()
+
+
+@dataclasses.dataclass
+class MirrorDownloader:
+    """Copies scheme directories from another node running `download_schemes serve`.
+
+    Only files that differ from the local copy are transferred, and interrupted transfers are resumed with a range
+    request. Schemes are copied as they were written by the serving node, so local pipeline options do not apply.
+    """
+
+    mirror_url: str
+    short_name: str
+    timeout = 60
+
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, Any], keycache: KeyCache = None) -> "MirrorDownloader":
+        return cls(metadata["mirror_url"].rstrip("/"), metadata["shortname"])
+
+    @retry(
+        stop=stop_after_attempt(10), wait=wait_exponential(multiplier=1, min=1, max=1200)
+    )
+    def __open(self, url: str, headers: dict[str, str] = None):
+        request = urllib.request.Request(url, headers=headers or {})
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def fetch_record(self) -> dict[str, Any]:
+        with self.__open(f"{self.mirror_url}{SCHEMES_PATH}") as r:
+            for scheme in json.load(r)["schemes"]:
+                if scheme["shortname"] == self.short_name:
+                    return scheme
+        raise Exception(f"{self.short_name} is not available from {self.mirror_url}")
+
+    def fetch_file(self, url: str, local_file: Path, entry: dict[str, Any]) -> None:
+        partial_file = local_file.with_name(f"{local_file.name}.partial")
+        offset = partial_file.stat().st_size if partial_file.exists() else 0
+        headers = {}
+        if 0 < offset < entry["size"]:
+            # Resume, unless the file has changed on the server since the partial copy was started.
+            headers = {"Range": f"bytes={offset}-", "If-Range": entry["etag"]}
+        with self.__open(url, headers) as r:
+            mode = "ab" if r.status == 206 else "wb"
+            with open(partial_file, mode) as out_f:
+                shutil.copyfileobj(r, out_f, CHUNK_SIZE)
+        if partial_file.stat().st_size != entry["size"]:
+            raise Exception(f"Copy of {url} is {partial_file.stat().st_size} bytes, expected {entry['size']}")
+        # Keep the server's modification time so that the file's ETag matches on the next sync.
+        os.utime(partial_file, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        os.replace(partial_file, local_file)
+
+    def download(self, out_dir: Path, options: PipelineOptions = None) -> tuple[Path, str]:
+        record = self.fetch_record()
+        scheme_subdir = Path(record["db_path"])
+        scheme_dir: Path = out_dir / scheme_subdir
+        scheme_dir.mkdir(parents=True, exist_ok=True)
+        scheme_url = f"{self.mirror_url}/{urllib.parse.quote(scheme_subdir.as_posix())}/"
+        with self.__open(scheme_url) as r:
+            files = json.load(r)["files"]
+        # Copy metadata.json last, so that a scheme directory with an up-to-date metadata.json is complete.
+        files.sort(key=lambda entry: entry["name"] == "metadata.json")
+
+        names = {entry["name"] for entry in files}
+        for local_file in scheme_dir.iterdir():
+            if local_file.is_file() and local_file.name not in names and not local_file.name.endswith(".partial"):
+                logging.debug(f"Removing {local_file}, which is no longer on the mirror")
+                local_file.unlink()
+        copied = 0
+        for entry in files:
+            local_file = scheme_dir / entry["name"]
+            if local_file.exists() and file_etag(local_file.stat()) == entry["etag"]:
+                continue
+            self.fetch_file(scheme_url + urllib.parse.quote(entry["name"]), local_file, entry)
+            copied += 1
+        logging.info(f"Copied {copied} of {len(files)} files for {self.short_name} from {self.mirror_url}")
+        return scheme_subdir, record["last_updated"]
@@ -0,0 +1,139 @@
+import dataclasses
+import hashlib
+import json
+import logging
+from array import array
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from download_schemes.manifest import HashingWriter
+from download_schemes.pipeline import Stage
+from download_schemes.profiles import encode_allele
+
+HASH_INDEX_FILE = "allele_hashes.bin"
+MAX_REPORTED = 100
+
+# Records are sorted by (key, check). Together they are the 128-bit BLAKE2b digest of the normalised sequence; the
+# key alone is what is binary searched and the check resolves any 64-bit collisions.
+RECORD_DTYPE = np.dtype(
+    [("key", "<u8"), ("check", "<u8"), ("locus", "<u4"), ("allele", "<i4")]
+)
+
+
+def sequence_digest(sequence: str) -> tuple[int, int]:
+    digest = hashlib.blake2b(sequence.encode("ascii"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class HashIndexStage(Stage):
+    """Builds a sorted, memory-mappable sequence hash -> (locus, allele) index for the scheme."""
+
+    def __init__(self, scheme_dir: Path, scheme_type: str):
+        super().__init__(scheme_dir, scheme_type)
+        self.loci: dict[str, int] = {}
+        self.allele_table: dict[str, int] = {}
+        self.keys = array("Q")
+        self.checks = array("Q")
+        self.locus_ids = array("I")
+        self.allele_ids = array("i")
+
+    def add_allele(self, locus: str, allele_id: str, sequence: str) -> None:
+        key, check = sequence_digest(sequence)
+        self.keys.append(key)
+        self.checks.append(check)
+        self.locus_ids.append(self.loci.setdefault(locus, len(self.loci)))
+        self.allele_ids.append(encode_allele(allele_id, self.allele_table))
+
+    def finish(self, metadata: dict[str, Any]) -> None:
+        records = np.empty(len(self.keys), dtype=RECORD_DTYPE)
+        records["key"] = np.frombuffer(self.keys, dtype=np.uint64)
+        records["check"] = np.frombuffer(self.checks, dtype=np.uint64)
+        records["locus"] = np.frombuffer(self.locus_ids, dtype=np.uint32)
+        records["allele"] = np.frombuffer(self.allele_ids, dtype=np.int32)
+        records.sort(order=["key", "check", "locus", "allele"])
+        with open(self.scheme_dir / HASH_INDEX_FILE, "wb") as raw_f:
+            out_f = HashingWriter(raw_f)
+            out_f.write(records.data)
+        self.files[HASH_INDEX_FILE] = out_f.entry(alleles=len(records))
+
+        loci = list(self.loci)
+        allele_table = list(self.allele_table)
+        duplicates, collisions = self.__find_clashes(records, loci, allele_table)
+        if duplicates:
+            logging.warning(
+                f"{len(duplicates)} alleles in {self.scheme_dir} share a sequence with another allele"
+            )
+        if collisions:
+            logging.warning(
+                f"{len(collisions)} 64-bit hash collisions between different sequences in {self.scheme_dir}"
+            )
+        metadata["allele_hash_index"] = {
+            "file": HASH_INDEX_FILE,
+            "hash": "blake2b-128",
+            "records": len(records),
+            "record_dtype": [list(field) for field in RECORD_DTYPE.descr],
+            "loci": loci,
+            "allele_table": allele_table,
+            "duplicates": {"count": len(duplicates), "examples": duplicates[:MAX_REPORTED]},
+            "collisions": {"count": len(collisions), "examples": collisions[:MAX_REPORTED]},
+        }
+
+    @staticmethod
+    def __find_clashes(
+        records: np.ndarray, loci: list[str], allele_table: list[str]
+    ) -> tuple[list[list[str]], list[list[str]]]:
+        """Compare each record with its predecessor in sort order.
+
+        The same (key, check) means the same sequence is listed under more than one allele; the same key with a
+        different check is a collision on the searchable half of the digest.
+        """
+        same_key = np.flatnonzero(records["key"][1:] == records["key"][:-1]) + 1
+        duplicates = []
+        collisions = []
+
+        def describe(record) -> str:
+            allele = int(record["allele"])
+            allele_id = str(allele) if allele >= 0 else allele_table[-allele - 1]
+            return f"{loci[record['locus']]}_{allele_id}"
+
+        for i in same_key:
+            pair = [describe(records[i - 1]), describe(records[i])]
+            if records["check"][i] == records["check"][i - 1]:
+                duplicates.append(pair)
+            else:
+                collisions.append(pair)
+        return duplicates, collisions
+
+
+@dataclasses.dataclass
+class AlleleHashIndex:
+    """Exact sequence lookups against a scheme's `allele_hashes.bin`, without touching the allele files."""
+
+    records: np.ndarray
+    loci: list[str]
+    allele_table: list[str]
+
+    @classmethod
+    def load(cls, scheme_dir: Path) -> "AlleleHashIndex":
+        with open(scheme_dir / "metadata.json", "r") as f:
+            layout = json.load(f)["allele_hash_index"]
+        dtype = np.dtype([tuple(field) for field in layout["record_dtype"]])
+        records = np.memmap(scheme_dir / layout["file"], dtype=dtype, mode="r")
+        return cls(records, layout["loci"], layout["allele_table"])
+
+    def lookup(self, sequence: str) -> list[tuple[str, str]]:
+        """Return every (locus, allele ID) whose normalised sequence is exactly `sequence`."""
+        key, check = sequence_digest(sequence.upper())
+        keys = self.records["key"]
+        start = int(np.searchsorted(keys, np.uint64(key), side="left"))
+        end = int(np.searchsorted(keys, np.uint64(key), side="right"))
+        matches = []
+        for record in self.records[start:end]:
+            if int(record["check"]) != check:
+                continue
+            allele = int(record["allele"])
+            allele_id = str(allele) if allele >= 0 else self.allele_table[-allele - 1]
+            matches.append((self.loci[record["locus"]], allele_id))
+        return matches
@@ -3,14 +3,23 @@ import hashlib
 import json
 import logging
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import requests
-from bs4 import BeautifulSoup
-from rauth import OAuth1Service, OAuth1Session
+# The HTTP, HTML and OAuth libraries are only imported once a key actually has to be fetched, which keeps start-up
+# fast for runs that use cached keys or no BIGSdb hosts at all.
+if TYPE_CHECKING:
+    import requests
+    from rauth import OAuth1Service
 
 logger = logging.getLogger(__name__)
 
+# How long a confirmed web UI login is trusted for before it is checked again, in seconds.
+LOGIN_CHECK_TTL = 600.0
+
 
 @dataclasses.dataclass
 class KeyCache:
@@ -18,11 +27,16 @@ class KeyCache:
     host_config_file: Path
     cache_file: Path
 
-    __logged_in_session: dict[str, requests.Session] = dataclasses.field(
+    __logged_in_session: dict[str, "requests.Session"] = dataclasses.field(
         default_factory=dict
     )
 
     def __post_init__(self):
+        # Schemes may be downloaded concurrently, so keys for a host are minted by one thread at a time, and the
+        # cache is changed and saved by one thread at a time.
+        self.__lock = threading.RLock()
+        self.__host_locks: dict[str, threading.RLock] = {}
+        self.__login_checked: dict[str, float] = {}
         self.__secrets: dict[str, dict[str, dict[str, str]]] = self.load_secrets()
         self.__host_config: dict[str, dict[str, str | dict[str, str]]] = self.load_config(self.host_config_file)
         self.__cache: dict[str, dict[str, dict[str, str]]] = self.load_cache()
@@ -63,8 +77,12 @@ class KeyCache:
         with open(self.cache_file, "r") as f:
             return json.load(f)
 
+    def __host_lock(self, host: str) -> threading.RLock:
+        with self.__lock:
+            return self.__host_locks.setdefault(host, threading.RLock())
+
     def save_cache(self) -> None:
-        with open(self.cache_file, "w") as f:
+        with self.__lock, open(self.cache_file, "w") as f:
             json.dump(self.__cache, f, indent=2)
 
     def get_key(self, key_type: str, host: str) -> tuple[str, str] | None:
@@ -102,19 +120,21 @@ class KeyCache:
         if key_type in ["user", "consumer"]:
             logger.warning(f"Attempt to set {key_type} token for {host} ignored.")
             return
-        if host not in self.__cache:
-            self.__cache[host] = {}
-        self.__cache[host][key_type] = {"TOKEN": token, "TOKEN SECRET": token_secret}
-        self.save_cache()
+        with self.__lock:
+            if host not in self.__cache:
+                self.__cache[host] = {}
+            self.__cache[host][key_type] = {"TOKEN": token, "TOKEN SECRET": token_secret}
+            self.save_cache()
 
     def delete_key(self, key_type: str, host: str) -> None:
         if key_type in ["user", "consumer"]:
             logger.warning(f"Attempt to delete {key_type} token for {host} ignored.")
             return
         else:
-            if host in self.__cache and key_type in self.__cache[host]:
-                del self.__cache[host][key_type]
-                self.save_cache()
+            with self.__lock:
+                if host in self.__cache and key_type in self.__cache[host]:
+                    del self.__cache[host][key_type]
+                    self.save_cache()
 
     def get_user_credentials(self, host: str) -> tuple[str, str]:
         return self.get_key("user", host)
@@ -123,28 +143,72 @@ class KeyCache:
         return self.get_key("consumer", host)
 
     def get_request_key(self, host: str, database: str) -> tuple[str, str] | None:
-        key = self.get_key("request", host)
-        if key is None:
-            key = self.fetch_request_key(host, database)
-            if key:
-                self.set_key("request", host, key[0], key[1])
-        return key
+        with self.__host_lock(host):
+            key = self.get_key("request", host)
+            if key is None:
+                key = self.fetch_request_key(host, database)
+                if key:
+                    self.set_key("request", host, key[0], key[1])
+            return key
 
     def get_session_key(self, host: str, database: str) -> tuple[str, str] | None:
-        key = self.get_key("session", host)
-        if key is None:
-            key = self.fetch_session_key(host, database)
-            if key:
-                self.set_key("session", host, key[0], key[1])
-        return key
+        with self.__host_lock(host):
+            key = self.get_key("session", host)
+            if key is None:
+                key = self.fetch_session_key(host, database)
+                if key:
+                    self.set_key("session", host, key[0], key[1])
+            return key
 
     def get_access_key(self, host: str, database: str) -> tuple[str, str] | None:
-        key = self.get_key("access", host)
-        if key is None:
-            key = self.fetch_access_key(host, database)
-            if key:
-                self.set_key("access", host, key[0], key[1])
-        return key
+        with self.__host_lock(host):
+            key = self.get_key("access", host)
+            if key is None:
+                key = self.fetch_access_key(host, database)
+                if key:
+                    self.set_key("access", host, key[0], key[1])
+            return key
+
+    def validate_session_key(self, host: str, database: str) -> None:
+        """Make sure there is a working session key for the host, replacing a cached one that has expired."""
+        from rauth import OAuth1Session
+
+        with self.__host_lock(host):
+            session_key = self.get_session_key(host, database)
+            consumer_key = self.get_consumer_key(host)
+            session = OAuth1Session(
+                consumer_key[0],
+                consumer_key[1],
+                access_token=session_key[0],
+                access_token_secret=session_key[1],
+            )
+            r = session.get(f"{self.__host_config[host]['REST_URL']}/pubmlst_{database}_seqdef")
+            if r.status_code == 301 or r.status_code == 401:
+                logger.info(f"Cached session key for {host} is no longer valid, fetching a new one")
+                self.delete_key("session", host)
+                self.get_session_key(host, database)
+            else:
+                r.raise_for_status()
+
+    def warm_up(self, databases: dict[str, str]) -> dict[str, float]:
+        """Validate or mint the session keys for several hosts at once, before any downloads start.
+
+        Takes a database to authenticate against for each host and returns the seconds spent on each host. A host
+        that fails is logged and left to authenticate lazily, where the error will be reported against its schemes.
+        """
+
+        def warm(host: str) -> float:
+            start = time.monotonic()
+            try:
+                self.validate_session_key(host, databases[host])
+            except Exception as e:
+                logger.warning(f"Failed to authenticate with {host} up front: {e}")
+            return time.monotonic() - start
+
+        if not databases:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+            return dict(zip(databases, executor.map(warm, databases)))
 
     def fetch_request_key(self, host: str, database: str) -> tuple[str, str]:
         logger.debug(f"Fetching request key for {host}...")
@@ -175,6 +239,8 @@ class KeyCache:
             raise Exception(f"Error getting request token for {host}")
 
     def fetch_session_key(self, host, database) -> tuple[str, str]:
+        from rauth import OAuth1Session
+
         logger.debug(f"Fetching session key for {host}...")
         access_key = self.get_access_key(host, database)
         consumer_key = self.get_consumer_key(host)
@@ -204,6 +270,8 @@ class KeyCache:
     def fetch_access_key(self, host: str, database: str) -> tuple[str, str]:
         """Fetch an access key for the specified host and database. This will log in at the host as the user
         and get a verification code"""
+        from bs4 import BeautifulSoup
+
         logger.debug(f"Fetching access key for {host}...")
         request_key: tuple[str, str] = self.get_request_key(host, database)
         consumer_key = self.get_consumer_key(host)
@@ -211,7 +279,7 @@ class KeyCache:
         """Automatically authorize the application."""
         logger.info(f"Authorising application for {host} - {database}...")
         session = self.__get_bigsdb_session(host)
-        if not KeyCache.__logged_in(session, self.__host_config[host]['WEB_URL']):
+        if not self.__is_logged_in(host):
             raise Exception(f"Failed to log in to {host}")
         authorise_url = f"{self.__host_config[host]['WEB_URL']}?db=pubmlst_{database}_seqdef&page=authorizeClient&oauth_token={request_key[0]}"
         logger.debug(f"Authorise client URL: {authorise_url}")
@@ -284,19 +352,33 @@ class KeyCache:
             return json.load(f)
 
     @staticmethod
-    def __logged_in(session: requests.Session, url: str) -> bool:
+    def __logged_in(session: "requests.Session", url: str) -> bool:
         """Check if the current session is logged in."""
         response = session.get(url)
         return "Log out" in response.text
 
+    def __is_logged_in(self, host: str) -> bool:
+        """Check the host's web UI session is logged in, trusting a recent successful check."""
+        checked = self.__login_checked.get(host)
+        if checked is not None and time.monotonic() - checked < LOGIN_CHECK_TTL:
+            return True
+        if KeyCache.__logged_in(self.__logged_in_session[host], self.__host_config[host]["WEB_URL"]):
+            self.__login_checked[host] = time.monotonic()
+            return True
+        self.__login_checked.pop(host, None)
+        return False
+
     def __get_bigsdb_session(self, host):
-        if host not in self.__logged_in_session or not KeyCache.__logged_in(
-            self.__logged_in_session[host], self.__host_config[host]["WEB_URL"]
-        ):
+        if host not in self.__logged_in_session or not self.__is_logged_in(host):
             self.__logged_in_session[host] = self.__login_to_bigsdb(host)
+            # The login raises if it fails, so a fresh session needs no check of its own.
+            self.__login_checked[host] = time.monotonic()
         return self.__logged_in_session[host]
 
     def __login_to_bigsdb(self, host):
+        import requests
+        from bs4 import BeautifulSoup
+
         session = requests.Session()
         login_response = session.get(self.__host_config[host]["WEB_URL"])
         login_form = BeautifulSoup(login_response.text, "html.parser").find("form")
@@ -347,10 +429,17 @@ class KeyCache:
         return self.__host_config[host]["REST_URL"]
 
 
+def bigsdb_database(host_path: str) -> str:
+    """The database name used in BIGSdb OAuth URLs, e.g. `saureus` for `pubmlst_saureus_seqdef`."""
+    return host_path.replace("pubmlst_", "").replace("_seqdef", "")
+
+
 def create_oauth_service(
     consumer_key: tuple[str, str], rest_url: str, database: str
-) -> OAuth1Service:
+) -> "OAuth1Service":
     """Create and return an OAuth1Service instance."""
+    from rauth import OAuth1Service
+
     return OAuth1Service(
         name="BIGSdb",
         consumer_key=consumer_key[0],
@@ -0,0 +1,80 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+
+MANIFEST_FILE = "manifest.json"
+
+
+class HashingWriter:
+    """Wraps a binary file, computing the SHA-256 and size of everything written through it."""
+
+    def __init__(self, out_f):
+        self.out_f = out_f
+        self.checksum = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.out_f.write(data)
+        self.checksum.update(data)
+        size = memoryview(data).nbytes
+        self.size += size
+        return size
+
+    def flush(self) -> None:
+        self.out_f.flush()
+
+    def entry(self, **counts: int) -> dict[str, Any]:
+        """The manifest entry for the file written so far, with any counts (e.g. alleles) to record."""
+        return {"size": self.size, "sha256": self.checksum.hexdigest(), **counts}
+
+
+def write_manifest(scheme_dir: Path, files: dict[str, dict[str, Any]]) -> None:
+    with open(scheme_dir / MANIFEST_FILE, "w") as out_f:
+        json.dump({"files": dict(sorted(files.items()))}, out_f, indent=4)
+
+
+def read_manifest(scheme_dir: Path) -> dict[str, dict[str, Any]]:
+    manifest_file = scheme_dir / MANIFEST_FILE
+    if not manifest_file.exists():
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)["files"]
+
+
+def load_manifests(output_dir: Path) -> dict[str, dict[str, dict[str, Any]]]:
+    """Read every scheme manifest in an output tree, keyed by file path relative to the tree."""
+    files = {}
+    for manifest_file in sorted(output_dir.glob(f"*_schemes/*/{MANIFEST_FILE}")):
+        scheme_subdir = manifest_file.parent.relative_to(output_dir)
+        with open(manifest_file, "r") as f:
+            for name, entry in json.load(f)["files"].items():
+                files[(scheme_subdir / name).as_posix()] = entry
+    return files
+
+
+def describe_change(old: dict[str, Any] | None, new: dict[str, Any]) -> str:
+    keys = [key for key in ["alleles", "profiles", "size"] if key in new]
+    if old is None:
+        return ", ".join(f"{key} {new[key]}" for key in keys)
+    return ", ".join(
+        f"{key} {old.get(key)} -> {new[key]}" for key in keys if old.get(key) != new[key]
+    )
+
+
+def diff_trees(old_dir: Path, new_dir: Path) -> list[tuple[str, str, str]]:
+    """Compare two output trees by their manifests alone.
+
+    Returns (status, path, details) for every file that was added (`A`), deleted (`D`) or modified (`M`).
+    """
+    old = load_manifests(old_dir)
+    new = load_manifests(new_dir)
+    changes = []
+    for path in sorted(old.keys() | new.keys()):
+        if path not in old:
+            changes.append(("A", path, describe_change(None, new[path])))
+        elif path not in new:
+            changes.append(("D", path, ""))
+        elif old[path]["sha256"] != new[path]["sha256"]:
+            changes.append(("M", path, describe_change(old[path], new[path])))
+    return changes
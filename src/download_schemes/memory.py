@@ -0,0 +1,173 @@
+import contextlib
+import io
+import logging
+import re
+import sys
+import tempfile
+import threading
+from typing import IO, Iterable, Iterator
+
+# Reserved for a payload whose size is not declared up front. Anything beyond it is spooled to disk.
+DEFAULT_RESERVATION = 8 * 1024 * 1024
+# Payloads larger than this share of the budget are spooled to disk rather than waiting for room in memory.
+SPOOL_FRACTION = 0.25
+
+size_pattern = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", re.IGNORECASE)
+size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size such as `512M`, `2G` or `1.5GiB` into bytes."""
+    match = size_pattern.match(value)
+    if match is None:
+        raise ValueError(f"Invalid size '{value}'. Expected e.g. '512M' or '2G'")
+    return int(float(match[1]) * size_units[match[2].upper()])
+
+
+def format_size(size: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    raise AssertionError("unreachable")
+
+
+def peak_rss() -> int | None:
+    """The peak resident set size of this process so far, in bytes, where the platform reports it."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryBudget:
+    """Bounds the downloaded payloads held in memory at once, across every download thread.
+
+    Each payload reserves its declared size (or `DEFAULT_RESERVATION`) before its body is read. If that would take
+    the total past the limit, the download waits until other payloads have been released. Payloads larger than
+    `SPOOL_FRACTION` of the limit, and payloads that turn out larger than their reservation, go to a temporary file
+    instead. One payload is always let through, so a payload larger than the budget cannot deadlock. Without a limit
+    nothing waits or spools, but the bytes held are still tracked for the run summary.
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.spooled = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, size: int, wait: bool = True) -> int:
+        """Reserve room for `size` bytes, waiting if need be. Returns the bytes reserved, 0 meaning spool to disk.
+
+        With `wait` false, a payload that does not fit is spooled to disk straight away instead.
+        """
+        with self.condition:
+            if self.limit is not None and size > self.limit * SPOOL_FRACTION:
+                self.spooled += 1
+                return 0
+            if self.limit is not None and self.in_use > 0 and self.in_use + size > self.limit:
+                if not wait:
+                    self.spooled += 1
+                    return 0
+                self.waits += 1
+                self.condition.wait_for(lambda: self.in_use == 0 or self.in_use + size <= self.limit)
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+            return size
+
+    def try_reserve(self, size: int, force: bool = False) -> bool:
+        """Reserve room for `size` bytes if there is room now, or regardless with `force`, without waiting."""
+        with self.condition:
+            if not force and self.limit is not None and self.in_use > 0 and self.in_use + size > self.limit:
+                return False
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self, size: int) -> None:
+        with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+    def payload(self, expected_size: int = None, wait: bool = True) -> "Payload":
+        """Reserve room for a payload of `expected_size` bytes (`DEFAULT_RESERVATION` if not declared) to write to."""
+        reserved = self.reserve(expected_size if expected_size is not None else DEFAULT_RESERVATION, wait)
+        return Payload(self, reserved)
+
+    @contextlib.contextmanager
+    def buffer(self, chunks: Iterable[bytes], expected_size: int = None) -> Iterator[IO[bytes]]:
+        """Read a payload into memory, or to disk if it does not fit, and yield it as a file positioned at the start.
+
+        The reservation is held until the context exits, so the payload should be consumed within it.
+        """
+        with self.payload(expected_size) as payload:
+            for chunk in chunks:
+                payload.write(chunk)
+            payload.file.seek(0)
+            yield payload.file
+
+    def summary(self) -> str:
+        text = f"peak buffered {format_size(self.peak)}"
+        if self.limit is not None:
+            text += f" of {format_size(self.limit)}, {self.waits} waits, {self.spooled} payloads spooled to disk"
+        rss = peak_rss()
+        if rss is not None:
+            text += f", peak RSS {format_size(rss)}"
+        return text
+
+
+class Payload:
+    """A payload being read within a `MemoryBudget`: in memory while it fits its reservation, otherwise on disk.
+
+    Closing it releases the reservation.
+    """
+
+    def __init__(self, budget: MemoryBudget, reserved: int):
+        self.budget = budget
+        self.reserved = reserved
+        self.file: IO[bytes] = io.BytesIO() if reserved else tempfile.TemporaryFile()
+
+    def write(self, chunk: bytes) -> None:
+        size = self.file.tell() + len(chunk)
+        if self.reserved and size > self.reserved:
+            if self.budget.limit is None:
+                # Nothing to protect, so just account for the extra bytes.
+                self.reserved += self.budget.reserve(size - self.reserved)
+            else:
+                # Larger than declared: move what there is to disk and carry on there.
+                logging.debug(f"Spooling a payload of over {format_size(self.reserved)} to disk")
+                spool_f = tempfile.TemporaryFile()
+                spool_f.write(self.file.getvalue())
+                self.file.close()
+                self.file = spool_f
+                self.budget.release(self.reserved)
+                self.reserved = 0
+                with self.budget.condition:
+                    self.budget.spooled += 1
+        self.file.write(chunk)
+
+    def close(self) -> None:
+        self.file.close()
+        self.budget.release(self.reserved)
+        self.reserved = 0
+
+    def __enter__(self) -> "Payload":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+# Shared by every download in the process. Limited by --max-memory.
+budget = MemoryBudget()
+
+
+def set_memory_limit(limit: int | None) -> None:
+    with budget.condition:
+        budget.limit = limit
+        budget.condition.notify_all()
@@ -0,0 +1,498 @@
+import dataclasses
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import IO, Any, Callable, Iterator
+
+import numpy as np
+
+from download_schemes import memory
+from download_schemes.manifest import HashingWriter
+from download_schemes.pipeline import Stage
+from download_schemes.profiles import encode_allele
+
+MINIMIZER_INDEX_FILE = "minimizers.bin"
+K = 21
+WINDOW = 11
+# Bases of sequence gathered before a batch is handed to a worker, unless the memory budget calls for smaller batches.
+BATCH_BASES = 1 << 22
+MIN_BATCH_BASES = 1 << 16
+# Working memory reserved for a batch while it is processed.
+BATCH_BYTES_PER_BASE = 50
+# Sorted records held at once while the batches are merged, unless the memory budget calls for fewer.
+MERGE_RECORDS = 1 << 19
+MIN_MERGE_RECORDS = 1 << 12
+# Working memory reserved for each of them while they are sorted and encoded.
+MERGE_BYTES_PER_RECORD = 200
+
+KEY_DTYPE = np.dtype("<u8")
+OFFSET_DTYPE = np.dtype("<u8")
+POSTING_DTYPE = np.dtype([("locus", "<u4"), ("allele", "<i4")])
+# One posting of a minimizer, as the batches are sorted and merged.
+RECORD_DTYPE = np.dtype([("key", "<u8"), ("locus", "<u4"), ("allele", "<i4")])
+POSTING_ENCODING = "LEB128 pairs per key: locus delta, then allele delta within a locus or zigzag allele"
+
+base_codes = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+    base_codes[base] = code
+
+
+def mix64(values: np.ndarray) -> np.ndarray:
+    """The splitmix64 finaliser, so that minimizers are not biased towards low complexity k-mers like poly-A."""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def kmer_hashes(codes: np.ndarray, k: int = K) -> np.ndarray:
+    """Hash every canonical k-mer (the lesser of it and its reverse complement) of a 2-bit encoded sequence."""
+    count = len(codes) - k + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    codes = codes.astype(np.uint64)
+    forward = np.zeros(count, dtype=np.uint64)
+    reverse = np.zeros(count, dtype=np.uint64)
+    for j in range(k):
+        forward = (forward << np.uint64(2)) | codes[j: j + count]
+        reverse |= (np.uint64(3) - codes[j: j + count]) << np.uint64(2 * j)
+    return mix64(np.minimum(forward, reverse))
+
+
+def batch_minimizers(
+    sequences: list[str], k: int = K, window: int = WINDOW
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find the (w, k) minimizers of a batch of sequences in one pass over their concatenation.
+
+    Returns the minimizer hashes and, for each, the position of its sequence in the batch. Each minimizer is listed
+    once per sequence. Sequences shorter than one window have none.
+    """
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    codes = base_codes[np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)]
+    if (codes == 255).any():
+        raise ValueError("Minimizers can only be computed for normalised ACGT sequences")
+    hashes = kmer_hashes(codes, k)
+    span = k + window - 1
+    if len(hashes) < window:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+
+    # Only windows that lie entirely within one sequence count.
+    starts = np.cumsum(lengths) - lengths
+    owner = np.repeat(np.arange(len(sequences)), lengths)[: len(hashes) - window + 1]
+    offset = np.arange(len(owner)) - starts[owner]
+    valid = offset <= lengths[owner] - span
+    minima = np.lib.stride_tricks.sliding_window_view(hashes, window).min(axis=1)[valid]
+    owner = owner[valid]
+    # Consecutive windows usually share their minimizer; drop the repeats before the full sort.
+    keep = np.ones(len(minima), dtype=bool)
+    keep[1:] = (minima[1:] != minima[:-1]) | (owner[1:] != owner[:-1])
+    minima, owner = minima[keep], owner[keep]
+    order = np.lexsort((minima, owner))
+    minima, owner = minima[order], owner[order]
+    keep = np.ones(len(minima), dtype=bool)
+    keep[1:] = (minima[1:] != minima[:-1]) | (owner[1:] != owner[:-1])
+    return minima[keep], owner[keep]
+
+
+def sequence_minimizers(sequence: str, k: int = K, window: int = WINDOW) -> np.ndarray:
+    """The distinct minimizer hashes of one sequence, computed as the index computes them."""
+    minima, _ = batch_minimizers([sequence.upper()], k, window)
+    return np.unique(minima)
+
+
+def available_cpus() -> int:
+    """The CPUs this process may run on, which under a container's CPU set can be fewer than the machine has."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS or Windows.
+        return os.cpu_count() or 1
+
+
+def zigzag(values: np.ndarray) -> np.ndarray:
+    """Map signed integers onto unsigned ones, small magnitudes first: 0, -1, 1, -2... become 0, 1, 2, 3..."""
+    values = values.astype(np.int64)
+    return ((values << np.int64(1)) ^ (values >> np.int64(63))).view(np.uint64)
+
+
+def unzigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.uint64)
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def encode_varints(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """LEB128-encode unsigned integers: 7 bits a byte, low bits first, the top bit set on all but the last byte.
+
+    Returns the encoded bytes and the length of each value's encoding.
+    """
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for i in range(1, 10):
+        lengths += values >= np.uint64(1 << (7 * i))
+    starts = np.cumsum(lengths) - lengths
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for i in range(int(lengths.max(initial=0))):
+        present = lengths > i
+        part = (values[present] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = (lengths[present] > i + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[present] + i] = part | more
+    return data, lengths
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = (np.arange(len(data)) - np.repeat(starts, ends - starts + 1)) * 7
+    parts = (data & np.uint8(0x7F)).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+def encode_postings(records: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Delta-encode sorted records, which must hold every posting of each of their keys.
+
+    Within a key the postings are sorted by locus and then allele, so each is written as the step from the previous
+    locus and, within a locus, the step from the previous allele. Both are usually small, and mostly fit in a byte.
+    Returns the distinct keys, the encoded size of each key's postings and the encoded bytes.
+    """
+    new_key = np.ones(len(records), dtype=bool)
+    new_key[1:] = records["key"][1:] != records["key"][:-1]
+    locus = records["locus"].astype(np.int64)
+    allele = records["allele"].astype(np.int64)
+    locus_step = np.diff(locus, prepend=0)
+    locus_step[new_key] = locus[new_key]
+    restart = new_key | (locus_step != 0)
+    allele_field = np.diff(allele, prepend=0).view(np.uint64)
+    allele_field[restart] = zigzag(allele[restart])
+    values = np.empty(2 * len(records), dtype=np.uint64)
+    values[0::2] = locus_step
+    values[1::2] = allele_field
+    data, lengths = encode_varints(values)
+    key_starts = np.flatnonzero(new_key)
+    key_sizes = np.add.reduceat(lengths[0::2] + lengths[1::2], key_starts)
+    return records["key"][key_starts], key_sizes, data
+
+
+def decode_postings(data: np.ndarray) -> np.ndarray:
+    """The (locus, allele) postings of one key, from the bytes `encode_postings` wrote for it."""
+    values = decode_varints(data)
+    locus_step, allele_field = values[0::2].view(np.int64), values[1::2]
+    postings = np.empty(len(locus_step), dtype=POSTING_DTYPE)
+    if len(postings) == 0:
+        return postings
+    restart = locus_step != 0
+    restart[0] = True
+    postings["locus"] = np.cumsum(locus_step)
+    steps = np.where(restart, unzigzag(allele_field), allele_field.view(np.int64))
+    totals = np.cumsum(steps)
+    # Each run of alleles adds up from the value its locus restarted at.
+    run_start = np.maximum.accumulate(np.where(restart, np.arange(len(steps)), 0))
+    postings["allele"] = totals - totals[run_start] + steps[run_start]
+    return postings
+
+
+def sort_records(records: np.ndarray) -> np.ndarray:
+    # The locus and allele packed into one word, in the same order, so that the sort takes two passes rather than three.
+    posting = (records["locus"].astype(np.uint64) << np.uint64(32)) | (
+        records["allele"].astype(np.int64) + (1 << 31)
+    ).astype(np.uint64)
+    return records[np.lexsort((posting, records["key"]))]
+
+
+def read_records(runs_f: IO[bytes], start: int, count: int) -> np.ndarray:
+    runs_f.seek(start * RECORD_DTYPE.itemsize)
+    return np.frombuffer(runs_f.read(count * RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE)
+
+
+def merge_runs(runs_f: IO[bytes], runs: list[tuple[int, int]], merge_records: int) -> Iterator[np.ndarray]:
+    """K-way merge sorted runs of records from a file, yielding sorted blocks that each hold whole keys.
+
+    A block of each run is read at a time. Every record below the last key buffered for any run that is not yet
+    fully read is final, so those are sorted together and yielded, and the runs are topped up as they empty.
+    """
+    block = max(1024, merge_records // max(1, len(runs)))
+    positions = [start for start, _ in runs]
+    ends = [start + count for start, count in runs]
+    buffers = [np.empty(0, dtype=RECORD_DTYPE) for _ in runs]
+
+    def read_more(i: int) -> None:
+        count = min(block, ends[i] - positions[i])
+        buffers[i] = np.concatenate([buffers[i], read_records(runs_f, positions[i], count)])
+        positions[i] += count
+
+    while True:
+        for i in range(len(runs)):
+            if len(buffers[i]) == 0 and positions[i] < ends[i]:
+                read_more(i)
+        live = [i for i in range(len(runs)) if len(buffers[i])]
+        if not live:
+            return
+        unread = [i for i in live if positions[i] < ends[i]]
+        if unread:
+            bound = min(buffers[i]["key"][-1] for i in unread)
+            cuts = {i: int(np.searchsorted(buffers[i]["key"], bound)) for i in live}
+        else:
+            cuts = {i: len(buffers[i]) for i in live}
+        if not any(cuts.values()):
+            # All that is buffered of the runs setting the bound is that one key: read further into them.
+            for i in unread:
+                if buffers[i]["key"][-1] == bound:
+                    read_more(i)
+            continue
+        if len(live) == 1:
+            # Nothing to interleave: the run is sorted already.
+            merged = buffers[live[0]][: cuts[live[0]]]
+        else:
+            merged = sort_records(np.concatenate([buffers[i][: cuts[i]] for i in live]))
+        for i in live:
+            buffers[i] = buffers[i][cuts[i]:]
+        yield merged
+
+
+class BatchPool:
+    """The worker threads shared by every minimizer index being built, one per CPU this process may use.
+
+    Each batch reserves its working memory in the memory budget before it is queued, and at most two per worker are
+    queued at once. A batch waits only for other batches to finish, never for downloads to release their payloads,
+    as the thread queueing it is usually holding a payload of its own. When no batch is in flight one is let through
+    regardless, as the budget lets one payload through.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="minimizers")
+        self.condition = threading.Condition()
+        self.in_flight = 0
+
+    def submit(self, size: int, func: Callable[..., Any], *args) -> Future:
+        with self.condition:
+            while self.in_flight >= 2 * self.workers or not memory.budget.try_reserve(
+                size, force=self.in_flight == 0
+            ):
+                self.condition.wait()
+            self.in_flight += 1
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(partial(self.__done, size))
+        return future
+
+    def __done(self, size: int, _future: Future) -> None:
+        memory.budget.release(size)
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+_batch_pool: BatchPool | None = None
+_batch_pool_lock = threading.Lock()
+
+
+def batch_pool() -> BatchPool:
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = BatchPool(available_cpus())
+        return _batch_pool
+
+
+def budget_share(default: int, minimum: int, bytes_each: int) -> int:
+    """`default` items, or fewer so that they take no more than a quarter of the memory budget."""
+    if memory.budget.limit is None:
+        return default
+    return max(minimum, min(default, int(memory.budget.limit * memory.SPOOL_FRACTION) // bytes_each))
+
+
+class MinimizerIndexStage(Stage):
+    """Builds a memory-mappable minimizer -> (locus, allele) index for the scheme.
+
+    `minimizers.bin` holds three sections back to back: the delta-encoded (locus, allele) postings (see
+    `encode_postings`), grouped by key, then the sorted distinct minimizer hashes, then an offset per key (plus one)
+    to the start of its postings. The byte position of each section is recorded under `minimizer_index` in the
+    metadata. Alleles are collected into batches of about `BATCH_BASES` bases, processed on a pool of threads shared
+    with the other schemes; the numpy work in each batch runs without the GIL. Each batch is sorted and written to a
+    temporary file as a run, and the runs are merged from disk when the scheme is complete, so the memory used is
+    bounded by the batches in flight and the merge rather than the size of the scheme. Both fit the memory budget.
+    """
+
+    def __init__(self, scheme_dir: Path, scheme_type: str):
+        super().__init__(scheme_dir, scheme_type)
+        self.loci: dict[str, int] = {}
+        self.allele_table: dict[str, int] = {}
+        self.pool = batch_pool()
+        self.max_batch_bases = budget_share(BATCH_BASES, MIN_BATCH_BASES, BATCH_BYTES_PER_BASE)
+        self.pending: list[Future] = []
+        self.runs: list[tuple[int, int]] = []
+        self.runs_f = tempfile.TemporaryFile()
+        self.runs_lock = threading.Lock()
+        self.sequences: list[str] = []
+        self.locus_ids: list[int] = []
+        self.allele_ids: list[int] = []
+        self.batch_bases = 0
+        self.alleles = 0
+        self.unindexed = 0
+        self.start = time.monotonic()
+
+    def add_allele(self, locus: str, allele_id: str, sequence: str) -> None:
+        self.sequences.append(sequence)
+        self.locus_ids.append(self.loci.setdefault(locus, len(self.loci)))
+        self.allele_ids.append(encode_allele(allele_id, self.allele_table))
+        self.batch_bases += len(sequence)
+        self.alleles += 1
+        if len(sequence) < K + WINDOW - 1:
+            self.unindexed += 1
+        if self.batch_bases >= self.max_batch_bases:
+            self.__submit()
+
+    def __submit(self) -> None:
+        if not self.sequences:
+            return
+        postings = np.empty(len(self.sequences), dtype=POSTING_DTYPE)
+        postings["locus"] = self.locus_ids
+        postings["allele"] = self.allele_ids
+        self.pending.append(
+            self.pool.submit(self.batch_bases * BATCH_BYTES_PER_BASE, self.__index_batch, self.sequences, postings)
+        )
+        self.sequences, self.locus_ids, self.allele_ids = [], [], []
+        self.batch_bases = 0
+        self.__collect(wait=False)
+
+    def __index_batch(self, sequences: list[str], postings: np.ndarray) -> tuple[int, int]:
+        """Index a batch and append it to the runs file, sorted. Returns the run's first record and record count."""
+        minima, owner = batch_minimizers(sequences)
+        records = np.empty(len(minima), dtype=RECORD_DTYPE)
+        records["key"] = minima
+        records["locus"] = postings["locus"][owner]
+        records["allele"] = postings["allele"][owner]
+        records = sort_records(records)
+        with self.runs_lock:
+            start = self.runs_f.seek(0, os.SEEK_END)
+            self.runs_f.write(records.data)
+        return start // RECORD_DTYPE.itemsize, len(records)
+
+    def __collect(self, wait: bool) -> None:
+        for future in [future for future in self.pending if wait or future.done()]:
+            self.pending.remove(future)
+            self.runs.append(future.result())
+
+    def finish(self, metadata: dict[str, Any]) -> None:
+        self.__submit()
+        self.__collect(wait=True)
+        merge_records = budget_share(MERGE_RECORDS, MIN_MERGE_RECORDS, MERGE_BYTES_PER_RECORD)
+        reserved = memory.budget.reserve(merge_records * MERGE_BYTES_PER_RECORD)
+        keys_count = postings_count = 0
+        # The keys and offsets are only known as the postings are written, so they are gathered on disk and
+        # appended after them.
+        keys_f, offsets_f = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        try:
+            with open(self.scheme_dir / MINIMIZER_INDEX_FILE, "wb") as raw_f:
+                out_f = HashingWriter(raw_f)
+                for records in merge_runs(self.runs_f, self.runs, merge_records):
+                    keys, key_sizes, data = encode_postings(records)
+                    offsets = out_f.size + np.cumsum(key_sizes) - key_sizes
+                    keys_f.write(keys.astype(KEY_DTYPE).data)
+                    offsets_f.write(offsets.astype(OFFSET_DTYPE).data)
+                    out_f.write(data.data)
+                    keys_count += len(keys)
+                    postings_count += len(records)
+                offsets_f.write(np.array([out_f.size], dtype=OFFSET_DTYPE).data)
+                keys_offset = out_f.size
+                for section_f in (keys_f, offsets_f):
+                    section_f.seek(0)
+                    shutil.copyfileobj(section_f, out_f)
+            offsets_offset = keys_offset + keys_count * KEY_DTYPE.itemsize
+        finally:
+            for temporary_f in (self.runs_f, keys_f, offsets_f):
+                temporary_f.close()
+            memory.budget.release(reserved)
+        self.files[MINIMIZER_INDEX_FILE] = out_f.entry(alleles=self.alleles)
+        logging.info(
+            f"Indexed {self.alleles} alleles in {self.scheme_dir} as {keys_count} minimizers and "
+            f"{postings_count} postings ({out_f.size} bytes) in {time.monotonic() - self.start:.1f}s"
+        )
+        if self.unindexed:
+            logging.warning(f"{self.unindexed} alleles in {self.scheme_dir} are too short to have a minimizer")
+        metadata["minimizer_index"] = {
+            "file": MINIMIZER_INDEX_FILE,
+            "k": K,
+            "window": WINDOW,
+            "hash": "splitmix64 of canonical 2-bit k-mer",
+            "keys": keys_count,
+            "postings": postings_count,
+            "postings_offset": 0,
+            "keys_offset": keys_offset,
+            "offsets_offset": offsets_offset,
+            "key_dtype": KEY_DTYPE.str,
+            "offset_dtype": OFFSET_DTYPE.str,
+            "posting_encoding": POSTING_ENCODING,
+            "loci": list(self.loci),
+            "allele_table": list(self.allele_table),
+            "unindexed_alleles": self.unindexed,
+        }
+
+
+@dataclasses.dataclass
+class MinimizerIndex:
+    """Minimizer lookups against a scheme's `minimizers.bin`. Loading it only maps the file."""
+
+    keys: np.ndarray
+    offsets: np.ndarray
+    postings: np.ndarray
+    k: int
+    window: int
+    loci: list[str]
+    allele_table: list[str]
+
+    @classmethod
+    def load(cls, scheme_dir: Path) -> "MinimizerIndex":
+        with open(scheme_dir / "metadata.json", "r") as f:
+            layout = json.load(f)["minimizer_index"]
+        path = scheme_dir / layout["file"]
+
+        def mmap(dtype: np.dtype, offset: int, count: int) -> np.ndarray:
+            # np.memmap refuses empty arrays, which an index of only very short alleles would have.
+            if count == 0:
+                return np.empty(0, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+        return cls(
+            mmap(np.dtype(layout["key_dtype"]), layout["keys_offset"], layout["keys"]),
+            mmap(np.dtype(layout["offset_dtype"]), layout["offsets_offset"], layout["keys"] + 1),
+            mmap(np.dtype(np.uint8), layout["postings_offset"], layout["keys_offset"] - layout["postings_offset"]),
+            layout["k"],
+            layout["window"],
+            layout["loci"],
+            layout["allele_table"],
+        )
+
+    def __postings(self, i: int) -> np.ndarray:
+        return decode_postings(self.postings[self.offsets[i]: self.offsets[i + 1]])
+
+    def lookup(self, minimizer: int) -> np.ndarray:
+        """The (locus, allele) postings of one minimizer hash."""
+        i = int(np.searchsorted(self.keys, np.uint64(minimizer)))
+        if i == len(self.keys) or self.keys[i] != np.uint64(minimizer):
+            return np.empty(0, dtype=POSTING_DTYPE)
+        return self.__postings(i)
+
+    def query(self, sequence: str) -> Counter[tuple[str, str]]:
+        """Count the minimizers of `sequence` shared with each (locus, allele ID) in the index."""
+        minimizers = sequence_minimizers(sequence, self.k, self.window)
+        found = np.searchsorted(self.keys, minimizers)
+        found = found[found < len(self.keys)]
+        found = found[np.isin(self.keys[found], minimizers)]
+        hits: Counter[tuple[str, str]] = Counter()
+        for i in found:
+            for locus, allele in self.__postings(i).tolist():
+                allele_id = str(allele) if allele >= 0 else self.allele_table[-allele - 1]
+                hits[(self.loci[locus], allele_id)] += 1
+        return hits
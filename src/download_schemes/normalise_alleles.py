@@ -1,41 +1,184 @@
+import dataclasses
+import hashlib
 import io
 import re
-from typing import IO
-
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
+import statistics
+import tempfile
+from array import array
+from typing import IO, Any, Callable, Iterable, Iterator
 
 bad_char = re.compile(r'[^ACGT]')
 
-def normalise_fasta(input_text: str, output_stream: IO[str]):
+
+@dataclasses.dataclass
+class LocusStats:
+    """Allele counts and lengths gathered while a locus is normalised."""
+
+    lengths: array = dataclasses.field(default_factory=lambda: array("I"))
+    max_allele_id: str = None
+    skipped_bad_name: int = 0
+    skipped_bad_chars: int = 0
+    skipped_empty: int = 0
+    # Allele ID -> the allele ID kept with the same sequence. Only set when duplicates are being removed.
+    duplicates: dict[str, str] | None = None
+
+    def add(self, allele_id: str, length: int) -> None:
+        self.lengths.append(length)
+        self.add_id(allele_id)
+
+    def add_id(self, allele_id: str) -> None:
+        """Count an accepted ID towards `max_allele_id`, including a duplicate that is not written."""
+        if self.max_allele_id is None or allele_sort_key(allele_id) > allele_sort_key(self.max_allele_id):
+            self.max_allele_id = allele_id
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "alleles": len(self.lengths),
+            "min_length": min(self.lengths, default=0),
+            "max_length": max(self.lengths, default=0),
+            "median_length": statistics.median(self.lengths) if self.lengths else 0,
+            "max_allele_id": self.max_allele_id,
+            "skipped_bad_name": self.skipped_bad_name,
+            "skipped_bad_chars": self.skipped_bad_chars,
+            "skipped_empty": self.skipped_empty,
+        } | ({} if self.duplicates is None else {"duplicates": len(self.duplicates)})
+
+
+def read_normalised_fasta(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """Yield (allele ID, sequence) pairs from a FASTA file written by `normalise_fasta`."""
+    allele_id = None
+    sequence: list[str] = []
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith(">"):
+            if allele_id is not None:
+                yield allele_id, "".join(sequence)
+            allele_id = line[1:]
+            sequence = []
+        elif line:
+            sequence.append(line)
+    if allele_id is not None:
+        yield allele_id, "".join(sequence)
+
+
+def allele_sort_key(allele_id: str) -> tuple[int, int, str]:
+    """Order allele IDs by their integer part and then their decimal part, each as a number, so 1.9 sorts before 1.10.
+
+    An ID with no decimal part sorts before those with one, and the ID itself breaks any remaining tie (e.g. 01 and 1).
+    """
+    integer, _, decimal = allele_id.partition(".")
+    return int(integer), int(decimal) if decimal else -1, allele_id
+
+
+def normalise_fasta(
+    input_text: str | IO[str],
+    output_stream: IO[str] | None,
+    on_allele: Callable[[str, str], None] = None,
+    stats: LocusStats = None,
+    deduplicate: bool = False,
+    canonical_order: bool = False,
+):
+    """Write the valid alleles of a locus as upper case FASTA with numeric IDs, returning the IDs written.
+
+    With `deduplicate`, alleles whose sequence has already been written are left out and recorded in
+    `stats.duplicates` instead. Only a 128-bit digest of each sequence is kept to find them. With `canonical_order`,
+    alleles are written in numeric ID order; the sequences wait in a temporary file rather than in memory, and a
+    duplicated sequence is kept under its lowest ID.
+    """
+    # Biopython is slow to import, so it is only loaded once there is something to normalise.
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+
     contig_names = []
+    duplicates: dict[str, str] = {}
+    if deduplicate and stats is not None:
+        stats.duplicates = duplicates
+    # Sequence digest -> the allele ID kept for it (or, in canonical order, its entry).
+    seen: dict[bytes, Any] = {}
+    # [sort key, allele ID, offset, length] of each allele in the spool, for canonical order.
+    entries: list[list[Any]] = []
+    spool = tempfile.TemporaryFile() if canonical_order else None
+
+    def write_allele(allele_id: str, sequence: str) -> None:
+        if output_stream is not None:
+            SeqIO.write(SeqRecord(Seq(sequence), id=allele_id, description=""), output_stream, "fasta")
+        contig_names.append(allele_id)
+        if stats is not None:
+            stats.add(allele_id, len(sequence))
+        if on_allele is not None:
+            on_allele(allele_id, sequence)
 
-    for record in SeqIO.parse(io.StringIO(input_text), "fasta"):
+    # Large loci can be passed as a stream, so that the whole file is never held as one string.
+    input_stream = io.StringIO(input_text) if isinstance(input_text, str) else input_text
+    for record in SeqIO.parse(input_stream, "fasta"):
         name = record.id
         sequence = str(record.seq).upper()
 
         m = re.match(r'^(.+[_-])?([0-9]+(\.[0-9]+)?)$', name)
         if m is None:
             print(f"Skipping badly formatted allele '{name}'")
+            if stats is not None:
+                stats.skipped_bad_name += 1
             continue
 
         if bad_char.search(sequence):
             # Some schemes had non-ACGT characters
+            if stats is not None:
+                stats.skipped_bad_chars += 1
             continue
 
         if len(sequence.strip()) == 0:
             # pubmlst_neisseria_62/NEIS1690.fa.gz has an allele with
             # no content. I assume it is because it needs to be removed
+            if stats is not None:
+                stats.skipped_empty += 1
             continue
 
-        normalized_record = SeqRecord(
-            Seq(sequence),
-            id=m[2],
-            description=""
-        )
-        SeqIO.write(normalized_record, output_stream, "fasta")
-        contig_names.append(m[2])
+        allele_id = m[2]
+        digest = None
+        if deduplicate:
+            digest = hashlib.blake2b(sequence.encode("ascii"), digest_size=16).digest()
+            kept = seen.get(digest)
+            if kept is not None:
+                kept_id = kept[1] if canonical_order else kept
+                if allele_id == kept_id:
+                    continue
+                if canonical_order and allele_sort_key(allele_id) < kept[0]:
+                    # Keep the lower ID, which takes over the spooled sequence.
+                    duplicates[kept_id] = allele_id
+                    kept[0], kept[1] = allele_sort_key(allele_id), allele_id
+                    dropped_id = kept_id
+                else:
+                    duplicates[allele_id] = kept_id
+                    dropped_id = allele_id
+                if stats is not None:
+                    # Not written, but the ID exists upstream, so new alleles must not be numbered into it.
+                    stats.add_id(dropped_id)
+                continue
+
+        if canonical_order:
+            entry = [allele_sort_key(allele_id), allele_id, spool.tell(), len(sequence)]
+            spool.write(sequence.encode("ascii"))
+            entries.append(entry)
+            if digest is not None:
+                seen[digest] = entry
+        else:
+            if digest is not None:
+                seen[digest] = allele_id
+            write_allele(allele_id, sequence)
+
+    if spool is not None:
+        with spool:
+            entries.sort()
+            for _, allele_id, offset, length in entries:
+                spool.seek(offset)
+                write_allele(allele_id, spool.read(length).decode("ascii"))
+    # An ID that gave way to a lower one may already have had duplicates pointed at it.
+    for allele_id, kept_id in duplicates.items():
+        while kept_id in duplicates:
+            kept_id = duplicates[kept_id]
+        duplicates[allele_id] = kept_id
 
     if len(contig_names) == 0:
         raise ValueError("Expected there to be some contigs")
@@ -0,0 +1,218 @@
+import dataclasses
+import gzip
+import importlib
+import io
+import json
+import logging
+from functools import partial
+from pathlib import Path
+from typing import IO, Any
+
+from download_schemes.manifest import (
+    MANIFEST_FILE,
+    HashingWriter,
+    read_manifest,
+    write_manifest,
+)
+from download_schemes.normalise_alleles import (
+    LocusStats,
+    normalise_fasta,
+    read_normalised_fasta,
+)
+from download_schemes.profiles import check_profile_alleles, write_profile_matrix
+
+# Optional stages, loaded by name so that their dependencies are only imported when they are used.
+STAGES: dict[str, str] = {
+    "hash-index": "download_schemes.hash_index:HashIndexStage",
+    "archive": "download_schemes.archive:ArchiveStage",
+    "minimizer-index": "download_schemes.minimizer_index:MinimizerIndexStage",
+}
+
+
+@dataclasses.dataclass
+class PipelineOptions:
+    """How each scheme directory should be written."""
+
+    stages: list[str] = dataclasses.field(default_factory=list)
+    # Write a `<locus>.fa.gz` file per locus. Can be turned off when the archive stage is used instead.
+    locus_files: bool = True
+    # Leave out alleles whose sequence repeats an earlier allele of the locus, recording them in the metadata.
+    deduplicate: bool = False
+    # Write each locus's alleles in numeric ID order rather than in the order the host serves them.
+    canonical_order: bool = False
+
+
+class Stage:
+    """A per-scheme processing step that runs alongside the download.
+
+    Stages are handed every allele as it comes out of `normalise_fasta`, and once the scheme is complete they can
+    write their own files into the scheme directory and add to the scheme's metadata before it is saved. The
+    manifest entries of those files (see `HashingWriter`) go in `files`, keyed by file name.
+    """
+
+    def __init__(self, scheme_dir: Path, scheme_type: str):
+        self.scheme_dir = scheme_dir
+        self.scheme_type = scheme_type
+        self.files: dict[str, dict[str, Any]] = {}
+
+    def add_allele(self, locus: str, allele_id: str, sequence: str) -> None:
+        pass
+
+    def finish(self, metadata: dict[str, Any]) -> None:
+        pass
+
+
+def load_stage(name: str) -> type[Stage]:
+    if name not in STAGES:
+        raise ValueError(f"Unknown stage '{name}'. Available: {', '.join(STAGES)}")
+    module_name, class_name = STAGES[name].split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class SchemeWriter:
+    """Writes the normalised contents of one scheme directory and drives its stages."""
+
+    NORMALISATION_DEFAULT = {"deduplicate": False, "canonical_order": False}
+
+    def __init__(
+        self, scheme_dir: Path, scheme_type: str, options: PipelineOptions = None
+    ):
+        if options is None:
+            options = PipelineOptions()
+        self.scheme_dir = scheme_dir
+        self.locus_files = options.locus_files
+        self.normalisation = {"deduplicate": options.deduplicate, "canonical_order": options.canonical_order}
+        # Duplicate allele ID -> the allele ID it was merged into, per locus.
+        self.duplicates: dict[str, dict[str, str]] = {}
+        self.gene_stats: dict[str, dict[str, Any]] = {}
+        # Size, checksum and allele count of every file written, computed as it is written.
+        self.files: dict[str, dict[str, Any]] = {}
+        # Allele IDs per locus for checking the profile table against. cgMLST schemes have no profiles, and their
+        # loci can hold hundreds of thousands of alleles, so they are not kept.
+        self.allele_ids: dict[str, set[str]] | None = (
+            {} if scheme_type != "cgmlst" else None
+        )
+        self.stages: list[Stage] = [
+            load_stage(name)(scheme_dir, scheme_type) for name in options.stages
+        ]
+        # The previous build of this scheme, so that unchanged loci can be kept. Its manifest is removed until the
+        # new one is written, so that files from an interrupted build are never mistaken for verified ones.
+        self.previous_metadata: dict[str, Any] = {}
+        metadata_file = scheme_dir / "metadata.json"
+        if metadata_file.exists():
+            with open(metadata_file, "r") as f:
+                self.previous_metadata = json.load(f)
+        self.previous_files = read_manifest(scheme_dir)
+        (scheme_dir / MANIFEST_FILE).unlink(missing_ok=True)
+
+    def write_locus(self, locus: str, fasta: str | IO[str]) -> list[str]:
+        allele_file = self.scheme_dir / f"{locus}.fa.gz"
+        # Remove any existing file to deal with failed downloads.
+        allele_file.unlink(missing_ok=True)
+        on_allele = partial(self.__add_allele, locus) if self.stages else None
+        stats = LocusStats()
+        if self.locus_files:
+            # No timestamp in the gzip header, so that unchanged loci have unchanged checksums.
+            with open(allele_file, "wb") as raw_f:
+                hashing_f = HashingWriter(raw_f)
+                with gzip.GzipFile(fileobj=hashing_f, mode="wb", mtime=0) as gzip_f:
+                    with io.TextIOWrapper(gzip_f, encoding="utf-8") as out_f:
+                        allele_ids = normalise_fasta(fasta, out_f, on_allele, stats, **self.normalisation)
+            self.files[allele_file.name] = hashing_f.entry(alleles=len(allele_ids))
+        else:
+            allele_ids = normalise_fasta(fasta, None, on_allele, stats, **self.normalisation)
+        self.gene_stats[locus] = stats.summary()
+        if stats.duplicates:
+            self.duplicates[locus] = stats.duplicates
+            # Duplicates are still alleles of the locus as far as profiles are concerned.
+            allele_ids = allele_ids + list(stats.duplicates)
+        if self.allele_ids is not None:
+            self.allele_ids[locus] = set(allele_ids)
+        return allele_ids
+
+    def reuse_locus(self, locus: str) -> bool:
+        """Keep the locus file from the previous build instead of writing it again.
+
+        Only possible if the previous build wrote the file and it is still the size recorded in its manifest. The
+        alleles are read back for the stages and the profile check, but are not normalised or compressed again.
+        Returns whether the file was kept; if not, the caller should write the locus as usual.
+        """
+        allele_file = self.scheme_dir / f"{locus}.fa.gz"
+        entry = self.previous_files.get(allele_file.name)
+        stats = self.previous_metadata.get("gene_stats", {}).get(locus)
+        if (
+            not self.locus_files
+            or entry is None
+            or stats is None
+            or not allele_file.exists()
+            or allele_file.stat().st_size != entry["size"]
+            or self.previous_metadata.get("normalisation", self.NORMALISATION_DEFAULT) != self.normalisation
+        ):
+            return False
+        duplicates = self.previous_metadata.get("duplicate_alleles", {}).get(locus)
+        if duplicates:
+            self.duplicates[locus] = duplicates
+        if self.stages or self.allele_ids is not None:
+            allele_ids = list(duplicates or [])
+            with gzip.open(allele_file, "rt") as in_f:
+                for allele_id, sequence in read_normalised_fasta(in_f):
+                    allele_ids.append(allele_id)
+                    self.__add_allele(locus, allele_id, sequence)
+            if self.allele_ids is not None:
+                self.allele_ids[locus] = set(allele_ids)
+        self.files[allele_file.name] = entry
+        self.gene_stats[locus] = stats
+        return True
+
+    def __add_allele(self, locus: str, allele_id: str, sequence: str) -> None:
+        for stage in self.stages:
+            stage.add_allele(locus, allele_id, sequence)
+
+    def close(self, metadata: dict[str, Any]) -> None:
+        for gene in set(self.previous_metadata.get("genes", [])) - set(metadata["genes"]):
+            # Loci dropped from the scheme since the previous build.
+            (self.scheme_dir / f"{gene}.fa.gz").unlink(missing_ok=True)
+        metadata["gene_stats"] = {
+            gene: self.gene_stats[gene]
+            for gene in metadata["genes"]
+            if gene in self.gene_stats
+        }
+        if self.normalisation != self.NORMALISATION_DEFAULT:
+            metadata["normalisation"] = self.normalisation
+        if self.normalisation["deduplicate"]:
+            metadata["duplicate_alleles"] = {
+                gene: self.duplicates[gene]
+                for gene in metadata["genes"]
+                if gene in self.duplicates
+            }
+        if "profiles" in metadata:
+            profiles = metadata["profiles"]
+            self.files[profiles["file"]] = {
+                "size": profiles["size"],
+                "sha256": profiles["sha256"],
+                "profiles": profiles["profiles"],
+            }
+            profiles_file = self.scheme_dir / "profiles.tsv"
+            metadata["profile_matrix"] = write_profile_matrix(
+                profiles_file, metadata["genes"]
+            )
+            if metadata["profile_matrix"] is not None:
+                matrix = metadata["profile_matrix"]
+                self.files[matrix["file"]] = {
+                    "size": matrix["size"],
+                    "sha256": matrix["sha256"],
+                    "profiles": matrix["profiles"],
+                }
+            if self.allele_ids is not None:
+                metadata["profile_check"] = check_profile_alleles(
+                    profiles_file, self.allele_ids
+                )
+        for stage in self.stages:
+            stage.finish(metadata)
+            self.files.update(stage.files)
+        logging.debug(f"Writing metadata to {self.scheme_dir}")
+        with open(self.scheme_dir / "metadata.json", "wb") as raw_f:
+            out_f = HashingWriter(raw_f)
+            out_f.write(json.dumps(metadata, indent=4).encode("utf-8"))
+        self.files["metadata.json"] = out_f.entry()
+        write_manifest(self.scheme_dir, self.files)
@@ -0,0 +1,280 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+from array import array
+from pathlib import Path
+from typing import Any, Iterable
+
+from download_schemes.manifest import HashingWriter
+
+CHUNK_SIZE = 1 << 20
+
+
+def iter_chunks(stream, chunk_size: int = CHUNK_SIZE) -> Iterable[bytes]:
+    """Read a binary file-like object in fixed size chunks."""
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+def write_profiles(
+    chunks: Iterable[bytes], out_file: Path, expected_size: int = None
+) -> dict[str, Any]:
+    """Stream a tab-delimited profile table to disk in bounded memory.
+
+    Each row is checked against the column count of the header as it arrives, and the SHA-256 of the file is
+    computed over the bytes as they are written. The data is written to a partial file that is only moved into
+    place once the whole table has been received, so a failed or truncated transfer never leaves a plausible
+    looking `profiles.tsv` behind. Returns a summary suitable for `metadata.json`.
+    """
+    partial_file = out_file.with_name(f"{out_file.name}.partial")
+    checksum = hashlib.sha256()
+    size = 0
+    rows = 0
+    columns = None
+    remainder = b""
+
+    def check_row(line: bytes) -> None:
+        nonlocal columns, rows
+        if not line.strip():
+            return
+        rows += 1
+        width = line.rstrip(b"\r").count(b"\t") + 1
+        if columns is None:
+            columns = width
+        elif width != columns:
+            raise ValueError(
+                f"Row {rows} of {out_file} has {width} columns, expected {columns}"
+            )
+
+    try:
+        with open(partial_file, "wb") as out_f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                out_f.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                for line in lines:
+                    check_row(line)
+            if remainder:
+                # A final row without a line ending is only acceptable if it is complete.
+                check_row(remainder)
+        if expected_size is not None and size != expected_size:
+            raise IOError(
+                f"Truncated profiles download for {out_file}: received {size} of {expected_size} bytes"
+            )
+        if columns is None:
+            raise ValueError(f"No profiles received for {out_file}")
+        os.replace(partial_file, out_file)
+    except BaseException:
+        partial_file.unlink(missing_ok=True)
+        raise
+
+    logging.debug(f"Wrote {rows - 1} profiles ({size} bytes) to {out_file}")
+    return {
+        "file": out_file.name,
+        "sha256": checksum.hexdigest(),
+        "size": size,
+        "profiles": rows - 1,
+        "columns": columns,
+    }
+
+
+PROFILE_MATRIX_FILE = "profiles.bin"
+PROFILE_MATRIX_DTYPE = "<i4"
+INT32_MAX = 2**31 - 1
+
+
+def encode_allele(value: str, allele_table: dict[str, int]) -> int:
+    """Encode an allele ID as an int32.
+
+    Plain integer IDs are stored as themselves. Anything else (e.g. `1.5`, `N` or an empty cell) is stored as a
+    negative reference into the side table, with -1 being the first entry.
+    """
+    if value.isascii() and value.isdigit() and int(value) <= INT32_MAX:
+        return int(value)
+    if value not in allele_table:
+        allele_table[value] = len(allele_table)
+    return -(allele_table[value] + 1)
+
+
+def write_profile_matrix(profiles_file: Path, genes: list[str]) -> dict[str, Any] | None:
+    """Write a column-major int32 copy of the profile table next to `profiles.tsv`.
+
+    The file holds one contiguous column of allele codes per gene (in `genes` order), followed by the ST codes and
+    the row order that sorts the STs. The returned layout, with offsets and shapes counted in int32 elements, is
+    stored in `metadata.json` so that consumers can `numpy.memmap` the file rather than parsing the text table (see
+    `load_profile_matrix`).
+    """
+    with open(profiles_file, "r") as in_f:
+        header = [column.replace("'", "") for column in in_f.readline().rstrip("\r\n").split("\t")]
+        missing = [column for column in ["ST", *genes] if column not in header]
+        if missing:
+            logging.warning(
+                f"Not writing a profile matrix for {profiles_file}, missing columns: {', '.join(missing)}"
+            )
+            return None
+        st_index = header.index("ST")
+        gene_indices = [header.index(gene) for gene in genes]
+
+        allele_table: dict[str, int] = {}
+        st = array("i")
+        columns = [array("i") for _ in genes]
+        for line in in_f:
+            if not line.strip():
+                continue
+            row = line.rstrip("\r\n").split("\t")
+            st.append(encode_allele(row[st_index], allele_table))
+            for column, index in zip(columns, gene_indices):
+                column.append(encode_allele(row[index], allele_table))
+
+    st_order = array("i", sorted(range(len(st)), key=st.__getitem__))
+    matrix_file = profiles_file.with_name(PROFILE_MATRIX_FILE)
+    with open(matrix_file, "wb") as raw_f:
+        out_f = HashingWriter(raw_f)
+        for values in [*columns, st, st_order]:
+            if sys.byteorder != "little":
+                values = array("i", values)
+                values.byteswap()
+            out_f.write(values)
+
+    profiles = len(st)
+    return {
+        "file": matrix_file.name,
+        "dtype": PROFILE_MATRIX_DTYPE,
+        "profiles": profiles,
+        "loci": genes,
+        "alleles": {"offset": 0, "shape": [len(genes), profiles]},
+        "st": {"offset": len(genes) * profiles, "shape": [profiles]},
+        "st_order": {"offset": (len(genes) + 1) * profiles, "shape": [profiles]},
+        "allele_table": list(allele_table),
+        "size": out_f.size,
+        "sha256": out_f.checksum.hexdigest(),
+    }
+
+
+# Profile cells that mean "no allele" rather than referring to one.
+MISSING_ALLELE_VALUES = {"", "0", "N", "-"}
+MAX_REPORTED_IDS = 20
+
+
+def check_profile_alleles(
+    profiles_file: Path, allele_ids: dict[str, set[str]]
+) -> dict[str, Any]:
+    """Check in a single pass that every allele referenced in the profile table exists in its allele file.
+
+    `allele_ids` holds the IDs written for each locus during normalisation, so the allele files are not re-read.
+    """
+    with open(profiles_file, "r") as in_f:
+        header = [column.replace("'", "") for column in in_f.readline().rstrip("\r\n").split("\t")]
+        loci = [(i, column, allele_ids[column]) for i, column in enumerate(header) if column in allele_ids]
+        missing_columns = [locus for locus in allele_ids if locus not in header]
+        dangling: dict[str, dict[str, int]] = {}
+        profiles = 0
+        for line in in_f:
+            if not line.strip():
+                continue
+            profiles += 1
+            row = line.rstrip("\r\n").split("\t")
+            for i, locus, known in loci:
+                value = row[i]
+                if value not in known and value not in MISSING_ALLELE_VALUES:
+                    counts = dangling.setdefault(locus, {})
+                    counts[value] = counts.get(value, 0) + 1
+
+    if missing_columns:
+        logging.warning(f"{profiles_file} has no column for: {', '.join(missing_columns)}")
+    for locus, counts in dangling.items():
+        logging.warning(
+            f"{profiles_file}: {sum(counts.values())} references to {len(counts)} {locus} alleles "
+            "that are not in the allele file"
+        )
+    return {
+        "profiles": profiles,
+        "missing_columns": missing_columns,
+        "dangling": {
+            locus: {
+                "references": sum(counts.values()),
+                "alleles": len(counts),
+                "examples": sorted(counts, key=counts.get, reverse=True)[:MAX_REPORTED_IDS],
+            }
+            for locus, counts in dangling.items()
+        },
+    }
+
+
+@dataclasses.dataclass
+class ProfileMatrix:
+    """A memory-mapped view of `profiles.bin`. Requires NumPy."""
+
+    loci: list[str]
+    alleles: Any
+    st: Any
+    st_order: Any
+    allele_table: list[str]
+
+    def __post_init__(self):
+        self.__codes = {value: -(i + 1) for i, value in enumerate(self.allele_table)}
+        self.__sorted_st = None
+
+    def encode(self, value: str) -> int | None:
+        if value.isascii() and value.isdigit() and int(value) <= INT32_MAX:
+            return int(value)
+        return self.__codes.get(value)
+
+    def decode(self, code: int) -> str:
+        return str(code) if code >= 0 else self.allele_table[-code - 1]
+
+    def find_st(self, profile: dict[str, str]) -> str | None:
+        """Return the ST with exactly this allele at every locus, if there is one."""
+        import numpy as np
+
+        matches = np.ones(self.st.shape[0], dtype=bool)
+        for i, locus in enumerate(self.loci):
+            code = self.encode(profile[locus])
+            if code is None:
+                return None
+            matches &= self.alleles[i] == code
+        hits = np.flatnonzero(matches)
+        return self.decode(int(self.st[hits[0]])) if len(hits) else None
+
+    def row_for_st(self, st: str) -> int | None:
+        """Binary search the ST index for the row holding `st`."""
+        import numpy as np
+
+        code = self.encode(st)
+        if code is None:
+            return None
+        if self.__sorted_st is None:
+            self.__sorted_st = self.st[self.st_order]
+        sorted_st = self.__sorted_st
+        position = int(np.searchsorted(sorted_st, code))
+        if position < len(sorted_st) and sorted_st[position] == code:
+            return int(self.st_order[position])
+        return None
+
+
+def load_profile_matrix(scheme_dir: Path) -> ProfileMatrix:
+    import numpy as np
+
+    with open(scheme_dir / "metadata.json", "r") as f:
+        layout = json.load(f)["profile_matrix"]
+    data = np.memmap(scheme_dir / layout["file"], dtype=layout["dtype"], mode="r")
+
+    def view(name: str):
+        offset = layout[name]["offset"]
+        shape = layout[name]["shape"]
+        return data[offset : offset + math.prod(shape)].reshape(shape)
+
+    return ProfileMatrix(
+        layout["loci"],
+        view("alleles"),
+        view("st"),
+        view("st_order"),
+        layout["allele_table"],
+    )
@@ -0,0 +1,49 @@
+import importlib
+import logging
+import time
+from importlib.metadata import entry_points
+from typing import Any
+
+from download_schemes.keycache import KeyCache
+
+# The downloader for each host, loaded by name so that a host's libraries are only imported once one of its schemes
+# is downloaded. Other packages can add hosts under the `download_schemes.downloaders` entry point group, naming a
+# class with the same `from_metadata` constructor as the built-in downloaders.
+DOWNLOADERS: dict[str, str] = {
+    "pubmlst": "download_schemes.downloaders:PubmlstDownloader",
+    "pasteur": "download_schemes.downloaders:PubmlstDownloader",
+    "enterobase": "download_schemes.downloaders:EnterobaseFtpDownloader",
+    "ridom": "download_schemes.downloaders:RidomCgmlstDownloader",
+    "ngstar": "download_schemes.downloaders:NgstarDownloader",
+    "mirror": "download_schemes.downloaders:MirrorDownloader",
+}
+ENTRY_POINT_GROUP = "download_schemes.downloaders"
+# Seconds taken to import each host's downloader the first time, for the run summary.
+load_seconds: dict[str, float] = {}
+
+
+def load_downloader(host: str) -> type:
+    start = time.monotonic()
+    if host in DOWNLOADERS:
+        module_name, class_name = DOWNLOADERS[host].split(":")
+        downloader = getattr(importlib.import_module(module_name), class_name)
+    else:
+        plugins = entry_points(group=ENTRY_POINT_GROUP, name=host)
+        if not plugins:
+            raise ValueError(f"Unsupported host: {host}")
+        downloader = next(iter(plugins)).load()
+    load_seconds.setdefault(host, time.monotonic() - start)
+    logging.debug(f"Loaded the {host} downloader in {time.monotonic() - start:.3f}s")
+    return downloader
+
+
+def initialise(
+    metadata: dict[str, Any],
+    keycache: KeyCache = None,
+) -> Any:
+    try:
+        downloader = load_downloader(metadata.get("host"))
+    except ValueError:
+        logging.info(f"Skipping {metadata['shortname']}")
+        raise
+    return downloader.from_metadata(metadata, keycache)
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+
+class ResultsStream:
+    """Appends one JSON line per finished scheme as soon as it is done.
+
+    Each line is flushed and fsynced before the next scheme is recorded, so the results of the schemes that have
+    finished survive a crash, and other processes can follow the file to pick up schemes as they complete.
+    """
+
+    def __init__(self, results_file: Path):
+        self.results_file = results_file
+        self.file = open(results_file, "w")
+
+    def write(self, record: dict[str, Any]) -> None:
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "ResultsStream":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def scheme_result(
+    scheme: dict[str, Any],
+    status: str,
+    seconds: float,
+    size: int = None,
+    error: str = None,
+) -> dict[str, Any]:
+    """A results line. Completed schemes carry their full record, ready for `selected_schemes.json`."""
+    result = {
+        "shortname": scheme["shortname"],
+        "status": status,
+        "finished": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "seconds": round(seconds, 3),
+    }
+    if status == "ok":
+        result["bytes"] = size
+        result["scheme"] = scheme
+    else:
+        result["error"] = error
+    return result
+
+
+def read_results(results_file: Path) -> list[dict[str, Any]]:
+    results = []
+    with open(results_file, "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # The last line is still being written.
+                break
+            results.append(json.loads(line))
+    return results
+
+
+def schemes_from_results(
+    results: list[dict[str, Any]], schemes: list[dict[str, Any]]
+) -> list[dict[str, Any]]:
+    """The records of the completed schemes, in the order the schemes were given."""
+    completed = {
+        result["shortname"]: result["scheme"]
+        for result in results
+        if result["status"] == "ok"
+    }
+    return [completed[scheme["shortname"]] for scheme in schemes if scheme["shortname"] in completed]
+
+
+def write_schemes_file(schemes_file: Path, schemes: list[dict[str, Any]]) -> None:
+    """Write `selected_schemes.json` atomically, so a reader never sees a partial file."""
+    partial_file = schemes_file.with_name(f"{schemes_file.name}.partial")
+    with open(partial_file, "w") as f_out:
+        json.dump({"schemes": schemes}, f_out)
+    os.replace(partial_file, schemes_file)
+    logging.debug(json.dumps({"schemes": schemes}))
@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import statistics
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+# Only the most recent runs of a scheme are used to predict the next one, so that changes in scheme size or server
+# speed are picked up quickly.
+HISTORY_LENGTH = 5
+# Expected durations in seconds for schemes that have not been downloaded before. These are deliberately generous so
+# that unknown schemes are started early rather than turning out to be the long tail.
+DEFAULT_SECONDS = {
+    "cgmlst": 1800.0,
+    "mlst": 60.0,
+}
+
+
+def directory_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def read_run_stats(stats_file: Path) -> dict[str, list[dict[str, Any]]]:
+    """Read the run history, grouped by scheme short name, oldest first."""
+    history: dict[str, list[dict[str, Any]]] = {}
+    if stats_file is None or not stats_file.exists():
+        return history
+    with open(stats_file, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a partial last line behind.
+                logging.warning(f"Ignoring unreadable line {line_number} in {stats_file}")
+                continue
+            history.setdefault(record["shortname"], []).append(record)
+    return history
+
+
+def append_run_stats(stats_file: Path, record: dict[str, Any]) -> None:
+    """Append one scheme's result to the run history."""
+    with open(stats_file, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def scheme_record(shortname: str, seconds: float, size: int) -> dict[str, Any]:
+    return {
+        "shortname": shortname,
+        "finished": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "seconds": round(seconds, 3),
+        "bytes": size,
+    }
+
+
+def expected_durations(
+    schemes: list[dict[str, Any]], history: dict[str, list[dict[str, Any]]]
+) -> dict[str, float]:
+    """Predict how long each scheme will take from the median of its recent runs."""
+    durations = {}
+    for scheme in schemes:
+        runs = history.get(scheme["shortname"], [])[-HISTORY_LENGTH:]
+        if runs:
+            durations[scheme["shortname"]] = statistics.median(run["seconds"] for run in runs)
+        else:
+            durations[scheme["shortname"]] = DEFAULT_SECONDS.get(
+                scheme["type"], DEFAULT_SECONDS["mlst"]
+            )
+    return durations
+
+
+def longest_first(
+    schemes: list[dict[str, Any]], durations: dict[str, float]
+) -> list[dict[str, Any]]:
+    """Order the schemes by expected duration, longest first. Ties keep the config file order."""
+    return sorted(schemes, key=lambda scheme: -durations[scheme["shortname"]])
@@ -0,0 +1,101 @@
+import heapq
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Upper bound on the number of schemes downloaded at once from each host, to stay polite.
+DEFAULT_HOST_LIMITS: dict[str, int] = {
+    "pubmlst": 2,
+    "pasteur": 2,
+    "enterobase": 2,
+    "ridom": 2,
+    "ngstar": 1,
+}
+
+
+def run_with_host_limits(
+    items: Iterable[T],
+    host_of: Callable[[T], str],
+    task: Callable[[T], Any],
+    jobs: int = 1,
+    host_limits: dict[str, int] = None,
+) -> Iterator[tuple[T, Future]]:
+    """Run `task` over `items` on up to `jobs` threads, yielding each item with its future as it completes.
+
+    Items are started in the order given, except that an item is passed over while its host already has as many
+    tasks running as its limit allows. Hosts without a limit are only bounded by `jobs`. Once a task fails, no new
+    items are started; the running ones are allowed to finish.
+    """
+    if host_limits is None:
+        host_limits = DEFAULT_HOST_LIMITS
+    jobs = max(1, jobs)
+    pending = list(items)
+    running: dict[Future, T] = {}
+    per_host: dict[str, int] = {}
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if not failed:
+                for item in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    host = host_of(item)
+                    if per_host.get(host, 0) >= host_limits.get(host, jobs):
+                        continue
+                    pending.remove(item)
+                    per_host[host] = per_host.get(host, 0) + 1
+                    running[executor.submit(task, item)] = item
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                per_host[host_of(item)] -= 1
+                if future.exception() is not None and not failed:
+                    failed = True
+                    if pending:
+                        logging.info(f"Not starting {len(pending)} remaining items after a failure")
+                yield item, future
+
+
+def plan_with_host_limits(
+    items: Iterable[T],
+    host_of: Callable[[T], str],
+    duration_of: Callable[[T], float],
+    jobs: int = 1,
+    host_limits: dict[str, int] = None,
+) -> list[tuple[T, float, float]]:
+    """Predict the schedule `run_with_host_limits` would follow, given the expected duration of each item.
+
+    Returns each item with its predicted start and end time in seconds, in the order the items would be started.
+    """
+    if host_limits is None:
+        host_limits = DEFAULT_HOST_LIMITS
+    jobs = max(1, jobs)
+    pending = list(items)
+    running: list[tuple[float, int, T]] = []
+    per_host: dict[str, int] = {}
+    schedule = []
+    now = 0.0
+
+    while pending or running:
+        for item in list(pending):
+            if len(running) >= jobs:
+                break
+            host = host_of(item)
+            if per_host.get(host, 0) >= host_limits.get(host, jobs):
+                continue
+            pending.remove(item)
+            per_host[host] = per_host.get(host, 0) + 1
+            end = now + duration_of(item)
+            # The schedule position breaks ties so that items themselves never need comparing.
+            heapq.heappush(running, (end, len(schedule), item))
+            schedule.append((item, now, end))
+        if not running:
+            break
+        now, _, item = heapq.heappop(running)
+        per_host[host_of(item)] -= 1
+    return schedule
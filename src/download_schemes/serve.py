@@ -0,0 +1,195 @@
+import json
+import logging
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+from download_schemes.profiles import CHUNK_SIZE
+
+SCHEMES_PATH = "/selected_schemes.json"
+range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """A validator that changes whenever a file is rewritten. Mirrors compute the same value for their copies."""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parse a single byte range into an inclusive (start, end) pair.
+
+    Returns None for ranges this server does not support (such as multiple ranges), which are answered with the whole
+    file. Raises ValueError if the range cannot be satisfied.
+    """
+    match = range_pattern.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # A suffix range: the last `last` bytes.
+        if int(last) == 0:
+            raise ValueError(f"Unsatisfiable range {header}")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(f"Unsatisfiable range {header}")
+    return start, end
+
+
+class OutputTreeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], root: Path, schemes_file: Path = None):
+        super().__init__(address, OutputTreeHandler)
+        self.root = root.resolve()
+        self.schemes_file = schemes_file
+
+
+class OutputTreeHandler(BaseHTTPRequestHandler):
+    """Serves the files in an output tree, with byte ranges and conditional requests.
+
+    A directory URL (ending in `/`) returns a JSON listing of the files in it, which mirrors use to find the files
+    that have changed. The run's schemes file is served at `/selected_schemes.json`.
+    """
+
+    server: OutputTreeServer
+
+    def do_GET(self) -> None:
+        self.__serve(send_body=True)
+
+    def do_HEAD(self) -> None:
+        self.__serve(send_body=False)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.info(f"{self.address_string()} {format % args}")
+
+    def __resolve(self, url_path: str) -> Path | None:
+        if url_path == SCHEMES_PATH and self.server.schemes_file is not None:
+            return self.server.schemes_file
+        path = (self.server.root / url_path.lstrip("/")).resolve()
+        # Never serve anything outside the output tree.
+        if path != self.server.root and self.server.root not in path.parents:
+            return None
+        return path
+
+    def __serve(self, send_body: bool) -> None:
+        url_path = unquote(urlsplit(self.path).path)
+        path = self.__resolve(url_path)
+        if path is None or not path.exists():
+            self.send_error(HTTPStatus.NOT_FOUND)
+        elif path.is_dir():
+            if not url_path.endswith("/"):
+                self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+                self.send_header("Location", url_path + "/")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.__send_listing(path, send_body)
+        else:
+            self.__send_file(path, send_body)
+
+    def __send_listing(self, directory: Path, send_body: bool) -> None:
+        files = []
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append(
+                    {
+                        "name": entry.name,
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "etag": file_etag(stat),
+                    }
+                )
+        body = json.dumps({"files": files}).encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def __not_modified(self, etag: str, mtime: float) -> bool:
+        if "If-None-Match" in self.headers:
+            candidates = [tag.strip() for tag in self.headers["If-None-Match"].split(",")]
+            return "*" in candidates or etag in candidates
+        if "If-Modified-Since" in self.headers:
+            try:
+                since = parsedate_to_datetime(self.headers["If-Modified-Since"])
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def __range_applies(self, etag: str, last_modified: str) -> bool:
+        if_range = self.headers.get("If-Range")
+        return if_range is None or if_range.strip() in (etag, last_modified)
+
+    def __send_file(self, path: Path, send_body: bool) -> None:
+        stat = path.stat()
+        etag = file_etag(stat)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        if self.__not_modified(etag, stat.st_mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+
+        start, end = 0, stat.st_size - 1
+        status = HTTPStatus.OK
+        if "Range" in self.headers and self.__range_applies(etag, last_modified):
+            try:
+                byte_range = parse_range(self.headers["Range"], stat.st_size)
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                status = HTTPStatus.PARTIAL_CONTENT
+
+        self.send_response(status)
+        self.send_header(
+            "Content-Type", mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        )
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+def serve_output(output_dir: Path, schemes_file: Path = None, bind: str = "0.0.0.0", port: int = 8000) -> None:
+    server = OutputTreeServer((bind, port), output_dir, schemes_file)
+    logging.info(f"Serving {output_dir} on http://{bind}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,78 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any
+
+from download_schemes.run_stats import expected_durations, read_run_stats
+
+# Shards must be split from inputs that every node shares: the config, and optionally a run stats file given to all of
+# them. Anything a node finds in its own output directory only covers its own earlier shard, so nodes would disagree.
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parse an `i/N` shard specification, where `i` counts from 1."""
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be given as i/N, e.g. 1/4, not '{shard}'")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Shard {shard} is out of range")
+    return index, count
+
+
+def estimate_costs(schemes: list[dict[str, Any]], costs_file: Path = None) -> dict[str, float]:
+    """Estimate the seconds each scheme takes to download.
+
+    With a shared `costs_file` in the run stats format (e.g. the run stats of every node from the previous release,
+    concatenated), each scheme costs the median of its recent runs. Schemes it does not cover, or every scheme
+    without one, get the typical duration for their type.
+    """
+    history = {}
+    if costs_file is not None:
+        if not costs_file.is_file():
+            raise ValueError(f"Shard costs file '{costs_file}' does not exist")
+        history = read_run_stats(costs_file)
+    return expected_durations(schemes, history)
+
+
+def assign_shards(
+    schemes: list[dict[str, Any]], costs: dict[str, float], count: int
+) -> list[list[dict[str, Any]]]:
+    """Split the schemes into `count` shards of similar total cost.
+
+    Schemes are placed largest first onto the currently cheapest shard. Ties are broken by short name and shard
+    number, so every node given the same schemes and costs computes the same split.
+    """
+    shards: list[list[dict[str, Any]]] = [[] for _ in range(count)]
+    totals = [0] * count
+    for scheme in sorted(schemes, key=lambda s: (-costs[s["shortname"]], s["shortname"])):
+        target = min(range(count), key=lambda i: (totals[i], i))
+        shards[target].append(scheme)
+        totals[target] += costs[scheme["shortname"]]
+    for i, (shard, total) in enumerate(zip(shards, totals), start=1):
+        logging.debug(f"Shard {i}/{count}: {len(shard)} schemes, estimated {total:.0f}s")
+    # Keep the config file order within each shard.
+    order = {scheme["shortname"]: i for i, scheme in enumerate(schemes)}
+    return [sorted(shard, key=lambda s: order[s["shortname"]]) for shard in shards]
+
+
+def select_shard(
+    schemes: list[dict[str, Any]], shard: str, costs_file: Path = None
+) -> list[dict[str, Any]]:
+    index, count = parse_shard(shard)
+    costs = estimate_costs(schemes, costs_file)
+    return assign_shards(schemes, costs, count)[index - 1]
+
+
+def merge_schemes_files(schemes_files: list[Path]) -> dict[str, Any]:
+    """Combine the `selected_schemes.json` files written by each shard into one."""
+    merged: dict[str, dict[str, Any]] = {}
+    for schemes_file in schemes_files:
+        with open(schemes_file, "r") as f:
+            for scheme in json.load(f)["schemes"]:
+                if scheme["shortname"] in merged:
+                    raise ValueError(
+                        f"{scheme['shortname']} appears in more than one shard ({schemes_file})"
+                    )
+                merged[scheme["shortname"]] = scheme
+    return {"schemes": list(merged.values())}
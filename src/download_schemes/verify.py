@@ -0,0 +1,145 @@
+import contextlib
+import gzip
+import json
+import logging
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from download_schemes.archive import ARCHIVE_FILE, ARCHIVE_INDEX
+
+header_pattern = re.compile(rb"^>[0-9]+(\.[0-9]+)?$")
+sequence_pattern = re.compile(rb"^[ACGT]+$")
+
+
+def verify_allele_file(allele_file: Path) -> tuple[Path, int, str | None]:
+    """Stream through one `.fa.gz`, checking it decompresses and holds normalised records.
+
+    Returns the file, the number of alleles and a description of the first problem found (or None).
+    """
+    alleles = 0
+    expect_sequence = False
+    try:
+        with gzip.open(allele_file, "rb") as in_f:
+            for line_number, line in enumerate(in_f, start=1):
+                line = line.rstrip(b"\n")
+                if line.startswith(b">"):
+                    if expect_sequence:
+                        return allele_file, alleles, f"allele without a sequence at line {line_number}"
+                    if not header_pattern.match(line):
+                        return allele_file, alleles, f"header is not a numeric ID at line {line_number}: {line[:50]!r}"
+                    alleles += 1
+                    expect_sequence = True
+                elif sequence_pattern.match(line) and alleles > 0:
+                    expect_sequence = False
+                else:
+                    return allele_file, alleles, f"invalid sequence line at line {line_number}"
+    except (OSError, EOFError, zlib.error) as e:
+        return allele_file, alleles, f"failed to decompress: {e}"
+    if expect_sequence:
+        return allele_file, alleles, "last allele has no sequence"
+    if alleles == 0:
+        return allele_file, alleles, "no alleles"
+    return allele_file, alleles, None
+
+
+def check_scheme_dir(scheme_dir: Path) -> tuple[list[str], list[Path], dict[str, Any]]:
+    """Cross-check `metadata.json` against the files in a scheme directory.
+
+    Returns the problems found, the allele files to verify and the metadata.
+    """
+    metadata_file = scheme_dir / "metadata.json"
+    if not metadata_file.exists():
+        return [f"{scheme_dir}: missing metadata.json"], [], {}
+    with open(metadata_file, "r") as f:
+        metadata = json.load(f)
+
+    problems = []
+    genes = set(metadata.get("genes", []))
+    allele_files = {
+        path.name[: -len(".fa.gz")]: path
+        for path in scheme_dir.glob("*.fa.gz")
+        if path.name != ARCHIVE_FILE
+    }
+    if allele_files or "archive" not in metadata:
+        for gene in sorted(genes - allele_files.keys()):
+            problems.append(f"{scheme_dir}: no allele file for gene {gene}")
+        for locus in sorted(allele_files.keys() - genes):
+            problems.append(f"{scheme_dir}: {locus}.fa.gz is not listed in metadata.json")
+    if "archive" in metadata:
+        with open(scheme_dir / ARCHIVE_INDEX, "r") as index:
+            archived = {line.split("\t", 1)[0] for line in index}
+        for gene in sorted(genes - archived):
+            problems.append(f"{scheme_dir}: gene {gene} is missing from the archive")
+    for name in ["profiles", "profile_matrix", "allele_hash_index"]:
+        if metadata.get(name) and not (scheme_dir / metadata[name]["file"]).exists():
+            problems.append(f"{scheme_dir}: missing {metadata[name]['file']}")
+    files = [allele_files[gene] for gene in sorted(genes & allele_files.keys())]
+    if "archive" in metadata:
+        files.append(scheme_dir / ARCHIVE_FILE)
+    return problems, files, metadata
+
+
+def scheme_dirs_from_schemes_file(output_dir: Path, schemes_file: Path) -> tuple[list[str], list[Path]]:
+    problems = []
+    scheme_dirs = []
+    with open(schemes_file, "r") as f:
+        schemes = json.load(f)["schemes"]
+    for scheme in schemes:
+        if "db_path" not in scheme:
+            problems.append(f"{schemes_file}: {scheme['shortname']} has no db_path")
+            continue
+        scheme_dir = output_dir / scheme["db_path"]
+        if not (scheme_dir / "metadata.json").exists():
+            problems.append(
+                f"{schemes_file}: db_path '{scheme['db_path']}' for {scheme['shortname']} does not resolve"
+            )
+            continue
+        scheme_dirs.append(scheme_dir)
+    return problems, scheme_dirs
+
+
+def verify_output(output_dir: Path, schemes_file: Path = None, workers: int = None) -> list[str]:
+    """Verify a completed output tree, returning a list of problems (empty if it is sound)."""
+    problems = []
+    if schemes_file is not None:
+        problems, scheme_dirs = scheme_dirs_from_schemes_file(output_dir, schemes_file)
+    else:
+        scheme_dirs = sorted(path.parent for path in output_dir.glob("*_schemes/*/metadata.json"))
+    return problems + verify_scheme_dirs(scheme_dirs, workers)
+
+
+def verify_scheme_dirs(scheme_dirs: list[Path], workers: int = None) -> list[str]:
+    """Verify the given scheme directories, returning a list of problems (empty if they are sound)."""
+    problems = []
+    allele_files = []
+    expected_counts: dict[Path, int] = {}
+    for scheme_dir in scheme_dirs:
+        scheme_problems, files, metadata = check_scheme_dir(scheme_dir)
+        problems.extend(scheme_problems)
+        allele_files.extend(files)
+        for gene, stats in metadata.get("gene_stats", {}).items():
+            expected_counts[scheme_dir / f"{gene}.fa.gz"] = stats["alleles"]
+    logging.info(f"Verifying {len(allele_files)} allele files in {len(scheme_dirs)} schemes")
+
+    workers = workers or os.cpu_count()
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            # No pool, which is safer when called from a process that is running other threads.
+            results = map(verify_allele_file, allele_files)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            # Files are small and numerous, so hand them out in batches to keep the pool busy.
+            chunksize = max(1, len(allele_files) // (workers * 16))
+            results = executor.map(verify_allele_file, allele_files, chunksize=chunksize)
+        for allele_file, alleles, problem in results:
+            if problem is not None:
+                problems.append(f"{allele_file}: {problem}")
+            elif allele_file in expected_counts and expected_counts[allele_file] != alleles:
+                problems.append(
+                    f"{allele_file}: {alleles} alleles but metadata.json lists {expected_counts[allele_file]}"
+                )
+    return problems
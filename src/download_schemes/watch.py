@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import random
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+from download_schemes import registry
+from download_schemes.keycache import KeyCache
+from download_schemes.manifest import read_manifest
+from download_schemes.pipeline import PipelineOptions
+from download_schemes.results import write_schemes_file
+from download_schemes.scheduler import run_with_host_limits
+from download_schemes.verify import verify_scheme_dirs
+
+# Scheme versions, and the scratch space they are downloaded into. Both are inside the output tree, so that a
+# finished download can be renamed into place, and are hidden so that they are not mistaken for schemes.
+VERSIONS_DIR = ".versions"
+STAGING_DIR = ".staging"
+# The live version plus the previous one, which readers that started before a swap may still be reading.
+KEEP_VERSIONS = 2
+
+
+def next_poll(interval: float, jitter: float, rng: random.Random) -> float:
+    """When to poll a scheme next, spread by up to `jitter` of the interval so that schemes drift apart."""
+    return time.monotonic() + interval * (1 + rng.uniform(-jitter, jitter))
+
+
+def read_schemes_file(schemes_file: Path) -> dict[str, dict[str, Any]]:
+    if not schemes_file.exists():
+        return {}
+    with open(schemes_file, "r") as f:
+        return {scheme["shortname"]: scheme for scheme in json.load(f)["schemes"]}
+
+
+def poll_timestamp(scheme: dict[str, Any], keycache: KeyCache) -> str | None:
+    """The scheme's current last updated date at its host, or None if the host cannot say without a download."""
+    downloader = registry.initialise(scheme, keycache)
+    fetch_timestamp = getattr(downloader, "fetch_timestamp", None)
+    return fetch_timestamp() if fetch_timestamp is not None else None
+
+
+def scheme_contents(scheme_dir: Path) -> tuple[dict[str, dict[str, Any]], dict[str, Any]] | None:
+    """A scheme's manifest and metadata, less the last updated date, or None if it has no manifest.
+
+    Hosts that cannot report when a scheme changed (NG-STAR, Ridom) may date each download, so two downloads of the
+    same scheme can differ in that date alone.
+    """
+    files = read_manifest(scheme_dir)
+    if not files:
+        return None
+    files.pop("metadata.json", None)
+    with open(scheme_dir / "metadata.json", "r") as f:
+        metadata = json.load(f)
+    metadata.pop("last_updated", None)
+    return files, metadata
+
+
+def swap_in(output_dir: Path, db_path: str, staged_dir: Path) -> Path:
+    """Make a staged scheme directory the live one at `output_dir / db_path`, atomically.
+
+    The live path is a relative symlink into `VERSIONS_DIR`, which is replaced in a single rename, so a reader sees
+    either the whole old version or the whole new one. A plain directory left by a normal run is first moved into
+    `VERSIONS_DIR` itself; that is the only moment at which the path briefly does not exist.
+    """
+    versions = output_dir / VERSIONS_DIR / db_path
+    versions.mkdir(parents=True, exist_ok=True)
+    version_dir = versions / str(time.time_ns())
+    os.rename(staged_dir, version_dir)
+
+    live = output_dir / db_path
+    live.parent.mkdir(parents=True, exist_ok=True)
+    swap_link = live.with_name(f".{live.name}.swap")
+    swap_link.unlink(missing_ok=True)
+    os.symlink(os.path.relpath(version_dir, live.parent), swap_link)
+    if live.is_dir() and not live.is_symlink():
+        os.rename(live, versions / "0")
+    os.replace(swap_link, live)
+
+    for old_version in sorted(versions.iterdir(), key=lambda path: int(path.name))[:-KEEP_VERSIONS]:
+        shutil.rmtree(old_version)
+    return version_dir
+
+
+def seed_staging(live_dir: Path, staged_dir: Path) -> None:
+    """Copy a live scheme directory into the staging area.
+
+    Locus files are hard linked rather than copied: `SchemeWriter` replaces a locus file rather than writing into
+    it, so the live copy is never touched. Everything else may be rewritten in place, so is copied.
+    """
+    with open(live_dir / "metadata.json", "r") as f:
+        locus_files = {f"{gene}.fa.gz" for gene in json.load(f).get("genes", [])}
+    staged_dir.mkdir(parents=True)
+    for entry in live_dir.iterdir():
+        if not entry.is_file():
+            continue
+        if entry.name in locus_files:
+            try:
+                os.link(entry, staged_dir / entry.name)
+                continue
+            except OSError:
+                pass
+        shutil.copy2(entry, staged_dir / entry.name)
+
+
+def refresh_scheme(
+    scheme: dict[str, Any],
+    current: dict[str, Any] | None,
+    output_dir: Path,
+    keycache: KeyCache,
+    options: PipelineOptions = None,
+) -> tuple[str, str] | None:
+    """Download a scheme into the staging area, verify it and swap it in.
+
+    Returns the new db_path and last updated date, or None if the download turned out identical to the live copy
+    apart from its last updated date.
+    """
+    staging_root = output_dir / STAGING_DIR / uuid.uuid4().hex
+    staging_root.mkdir(parents=True)
+    try:
+        live_dir = output_dir / current["db_path"] if current and "db_path" in current else None
+        if live_dir is not None and live_dir.is_dir():
+            # Start from the live scheme, so that downloaders that keep unchanged loci (Ridom) can.
+            seed_staging(live_dir, staging_root / current["db_path"])
+        downloader = registry.initialise(scheme, keycache)
+        db_path, last_updated = downloader.download(staging_root, options)
+        db_path = str(db_path)
+        staged_dir = staging_root / db_path
+        problems = verify_scheme_dirs([staged_dir], workers=1)
+        if problems:
+            raise Exception(f"Staged download failed verification: {'; '.join(problems[:5])}")
+        live_dir = output_dir / db_path
+        if live_dir.is_dir() and scheme_contents(live_dir) == scheme_contents(staged_dir) is not None:
+            return None
+        swap_in(output_dir, db_path, staged_dir)
+        return db_path, last_updated
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+
+def update_schemes_file(
+    schemes_file: Path, schemes: list[dict[str, Any]], records: dict[str, dict[str, Any]]
+) -> None:
+    """Rewrite the schemes file with the current records, in config order, atomically."""
+    write_schemes_file(
+        schemes_file,
+        [records[scheme["shortname"]] for scheme in schemes if scheme["shortname"] in records],
+    )
+
+
+def watch_schemes(
+    output_dir: Path,
+    schemes: list[dict[str, Any]],
+    keycache: KeyCache,
+    schemes_file: Path,
+    options: PipelineOptions = None,
+    interval: float = 6 * 60 * 60,
+    jitter: float = 0.1,
+    jobs: int = 1,
+    once: bool = False,
+) -> None:
+    """Keep the output tree up to date, refreshing each scheme when its host reports a change.
+
+    Every scheme is polled when the watch starts and then about every `interval` seconds. Changed schemes are
+    downloaded into a staging directory, verified and swapped into the output tree, and the schemes file is
+    rewritten after each swap. Hosts that cannot report a last updated date (NG-STAR, Ridom) are downloaded on every
+    poll, and only swapped in if the result differs from the live copy. Failures are logged and retried at the next
+    poll.
+    """
+    rng = random.Random()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    shutil.rmtree(output_dir / STAGING_DIR, ignore_errors=True)
+    records = read_schemes_file(schemes_file)
+    due_at = {scheme["shortname"]: time.monotonic() for scheme in schemes}
+    # The host's last updated date when a refresh last found the content unchanged. Some hosts change the date without
+    # changing the scheme, and without this such a scheme would be downloaded again at every poll.
+    polled_at: dict[str, str] = {}
+
+    def poll(scheme: dict[str, Any]) -> tuple[bool, str | None, Exception | None]:
+        current = records.get(scheme["shortname"])
+        try:
+            timestamp = poll_timestamp(scheme, keycache)
+        except Exception as e:
+            return False, None, e
+        changed = (
+            timestamp is None
+            or current is None
+            or polled_at.get(scheme["shortname"], current.get("last_updated")) != timestamp
+            or "db_path" not in current
+            or not (output_dir / current["db_path"]).is_dir()
+        )
+        return changed, timestamp, None
+
+    def refresh(scheme: dict[str, Any]) -> tuple[tuple[str, str] | None, Exception | None]:
+        try:
+            return refresh_scheme(scheme, records.get(scheme["shortname"]), output_dir, keycache, options), None
+        except Exception as e:
+            return None, e
+
+    while True:
+        now = time.monotonic()
+        due = [scheme for scheme in schemes if due_at[scheme["shortname"]] <= now]
+        changed = []
+        timestamps: dict[str, str | None] = {}
+        # Tasks report their own errors, so that one failing host does not stop the others being polled.
+        for scheme, result in run_with_host_limits(due, lambda s: s.get("host"), poll, jobs):
+            is_changed, timestamp, error = result.result()
+            due_at[scheme["shortname"]] = next_poll(interval, jitter, rng)
+            if error is not None:
+                logging.error(f"Failed to poll {scheme['shortname']}: {error}")
+            elif is_changed:
+                logging.info(f"{scheme['shortname']} has changed (last updated {timestamp or 'unknown'})")
+                changed.append(scheme)
+                timestamps[scheme["shortname"]] = timestamp
+
+        for scheme, result in run_with_host_limits(changed, lambda s: s.get("host"), refresh, jobs):
+            refreshed, error = result.result()
+            if error is not None:
+                logging.error(f"Failed to refresh {scheme['shortname']}: {error}")
+            elif refreshed is None:
+                logging.info(f"{scheme['shortname']} is unchanged")
+                if timestamps[scheme["shortname"]] is not None:
+                    polled_at[scheme["shortname"]] = timestamps[scheme["shortname"]]
+            else:
+                polled_at.pop(scheme["shortname"], None)
+                db_path, last_updated = refreshed
+                records[scheme["shortname"]] = scheme | {"db_path": db_path, "last_updated": last_updated}
+                update_schemes_file(schemes_file, schemes, records)
+                logging.info(f"Swapped in {scheme['shortname']} (last updated {last_updated})")
+
+        if once:
+            return
+        wait = max(0.0, min(due_at.values()) - time.monotonic())
+        logging.debug(f"Next poll in {wait:.0f}s")
+        time.sleep(wait)